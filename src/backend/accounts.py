@@ -0,0 +1,108 @@
+import re
+import threading
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from clients import ClientRegistry
+from email_store import EmailStore
+from single_flight import SingleFlight
+
+DEFAULT_ACCOUNT = 'default'
+# Account ids become directory names, so no path separators; an email address is fine
+ACCOUNT_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.@+-]{0,127}$')
+TOKEN_FILE = 'emails.token'
+
+
+def shard_of(account_id: str, shards: int) -> int:
+    """The shard, out of ``shards``, an account belongs to; the same in every process and run."""
+    return zlib.crc32(account_id.encode('utf-8')) % shards
+
+
+class Account:
+    """One mailbox: its Gmail token, email store, sync history and coalesced runs.
+
+    Everything lives in ``data_dir`` under the file names the app has always
+    used, so the default account, whose directory is the data directory
+    itself, picks up an existing single-mailbox install as it is.
+    """
+
+    def __init__(self, account_id: str, data_dir: Path, store: Optional[EmailStore] = None,
+                 clients: Optional[ClientRegistry] = None, fresh_for: float = 0.0):
+        self.id = account_id
+        self.data_dir = Path(data_dir)
+        self.token_path = str(self.data_dir / TOKEN_FILE)
+        self.history_file = str(self.data_dir / 'emails.history')
+        # Emails live in SQLite; the old flat emails.json is imported on first start.
+        self.store = store or EmailStore(self.data_dir / 'emails.db',
+                                         legacy_json=self.data_dir / 'emails.json')
+        self.clients = clients
+        # Concurrent refresh/detect requests share one run, and its result is reused for a few seconds
+        self.flights = SingleFlight(fresh_for=fresh_for)
+
+    def close(self) -> None:
+        if self.clients is not None:
+            self.clients.close()
+        self.store.close()
+
+
+class AccountManager:
+    """The accounts kept under ``data_dir``, opened on first use.
+
+    The default account uses ``data_dir`` itself; every other account has
+    its own namespace in ``data_dir/accounts/<id>/``. ``make_clients``
+    builds the client registry of an account as it is opened.
+    """
+
+    def __init__(self, data_dir: Path, make_clients: Callable[[Account], ClientRegistry],
+                 fresh_for: float = 0.0):
+        self.data_dir = Path(data_dir)
+        self.make_clients = make_clients
+        self.fresh_for = fresh_for
+        self._open: Dict[str, Account] = {}
+        self._lock = threading.Lock()
+
+    def namespace(self, account_id: str) -> Path:
+        if account_id == DEFAULT_ACCOUNT:
+            return self.data_dir
+        return self.data_dir / 'accounts' / account_id
+
+    def ids(self) -> List[str]:
+        """Every account with a namespace, the default account first."""
+        root = self.data_dir / 'accounts'
+        others = sorted(path.name for path in root.iterdir()
+                        if path.is_dir() and ACCOUNT_ID.match(path.name)) if root.is_dir() else []
+        return [DEFAULT_ACCOUNT] + [account_id for account_id in others if account_id != DEFAULT_ACCOUNT]
+
+    def has_token(self, account_id: str) -> bool:
+        """Whether the account has been authorized with Gmail, so it can sync without a user present."""
+        return (self.namespace(account_id) / TOKEN_FILE).exists()
+
+    def get(self, account_id: str, create: bool = False) -> Account:
+        """The account, opened on first use.
+
+        Raises ValueError for a malformed id, and KeyError for an account
+        without a namespace unless ``create`` is set.
+        """
+        with self._lock:
+            account = self._open.get(account_id)
+            if account is None:
+                if not ACCOUNT_ID.match(account_id):
+                    raise ValueError(f"Invalid account id: {account_id!r}")
+                path = self.namespace(account_id)
+                if not path.is_dir():
+                    if not create:
+                        raise KeyError(account_id)
+                    path.mkdir(parents=True)
+                account = Account(account_id, path, fresh_for=self.fresh_for)
+                account.clients = self.make_clients(account)
+                self._open[account_id] = account
+        return account
+
+    def opened(self) -> List[Account]:
+        with self._lock:
+            return list(self._open.values())
+
+    def close(self) -> None:
+        for account in self.opened():
+            account.close()
@@ -0,0 +1,211 @@
+"""Background sync of many accounts, one with a huge backlog: first come first served vs taking turns.
+
+``accounts`` small mailboxes and one big one live on a single fake Gmail
+server, each a separate user with its own quota, and share the fake Gemini
+model and one pool of worker threads through the app's account manager and
+sync worker. The big account starts with ``backlog`` stored emails still
+missing a summary and draft, as after importing a large mailbox, and is
+synced first. "fifo" generates queued emails in the order they were queued,
+whatever their account, as one shared queue would; "fair" is the sync
+worker as shipped, taking turns between accounts. Meanwhile ``users``
+dashboard users keep loading /api/unreplied-detect for random synced small
+accounts.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_accounts [--accounts 200] [--backlog 2000] [--workers 16]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import deque
+from functools import partial
+
+import httpx
+
+from accounts import AccountManager
+from benchmarks.fake_clients import FakeClientRegistry
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+from clients import SharedResources
+from sync_worker import SyncWorker
+
+BIG = 'big'
+
+
+class FifoSyncWorker(SyncWorker):
+    """Generates queued emails in the order they were queued, whatever their account."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._arrivals = deque()
+
+    def add(self, account_id, emails, urgent=False):
+        queue = self._accounts[account_id]
+        before = len(queue.queued)
+        super().add(account_id, emails, urgent)
+        self._arrivals.extend([account_id] * (len(queue.queued) - before))
+        if self._arrivals:
+            self._ready.set()
+
+    def _schedule(self, queue):
+        pass
+
+    def _next(self):
+        while self._arrivals:
+            queue = self._accounts[self._arrivals.popleft()]
+            if queue.peek() is not None:
+                return queue
+        return None
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_mib() -> float:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def backlog_emails(count: int):
+    rng = random.Random(1)
+    words = ['meeting', 'invoice', 'update', 'please', 'review', 'deadline', 'thanks', 'project']
+    return [{'id': f'b{i:06d}', 'thread_id': f'b{i:06d}', 'sender': f'Old {i} <old{i}@example.org>',
+             'subject': f'Imported {i}', 'timestamp': str(1700000000000 + i * 1000),
+             'body': ' '.join(rng.choice(words) for _ in range(80)), 'summary': '', 'replied': False,
+             'draft': ''} for i in range(count)]
+
+
+async def run(app_main, args, worker_class):
+    workdir = tempfile.mkdtemp(prefix='bench_accounts_')
+    small = [f'acct{i:04d}' for i in range(args.accounts)]
+    mailboxes = {account_id: FakeMailbox(size=args.mailbox, seed=i)
+                 for i, account_id in enumerate([BIG] + small)}
+    with FakeGmailServer(mailboxes[BIG], latency=args.gmail_latency,
+                         quota_units_per_second=args.gmail_quota) as server:
+        for account_id, mailbox in mailboxes.items():
+            server.add_mailbox(account_id, mailbox)
+        model = FakeGenerativeModel(latency=args.gemini_latency)
+        shared = SharedResources(threads=args.threads)
+
+        def make_clients(account):
+            return FakeClientRegistry(server, model, mailbox=account.id, shared=shared, account=account.id,
+                                      gmail_units_per_second=args.gmail_quota,
+                                      on_retry_result=partial(app_main.save_retried_email, account))
+        accounts = app_main.app.state.accounts = AccountManager(workdir, make_clients)
+        accounts.get(BIG, create=True).store.upsert_many(backlog_emails(args.backlog))
+        for account_id in small:
+            accounts.get(account_id, create=True)
+        app_main.SYNC_BACKFILL_LIMIT = args.backlog + args.mailbox
+        sync = app_main.app.state.sync = worker_class(
+            sync=partial(app_main._background_sync, accounts),
+            load_pending=partial(app_main._load_pending, accounts),
+            generate=partial(app_main._generate_stored, accounts),
+            interval=3600, workers=args.workers, sync_concurrency=args.sync_concurrency)
+        for account_id in [BIG] + small:
+            sync.add_account(account_id)
+
+        latencies, pending_loads = [], 0
+        done = asyncio.Event()
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=300) as client:
+            async def user(seed: int):
+                nonlocal pending_loads
+                rng = random.Random(seed)
+                while not done.is_set():
+                    synced = [account_id for account_id in small if sync.synced(account_id)]
+                    if not synced:
+                        await asyncio.sleep(0.05)
+                        continue
+                    start = time.perf_counter()
+                    response = await client.get('/api/unreplied-detect',
+                                                params={'count': 5, 'account': rng.choice(synced)})
+                    latencies.append(time.perf_counter() - start)
+                    pending_loads += any(email.get('pending') for email in response.json()['emails'])
+                    await asyncio.sleep(args.think)
+
+            start = time.perf_counter()
+            sync.start()
+            users = [asyncio.create_task(user(seed)) for seed in range(args.users)]
+            ready, peak_rss, peak_threads = {}, rss_mib(), threading.active_count()
+            while len(ready) < len(small) + 1:
+                await asyncio.sleep(0.05)
+                now = time.perf_counter() - start
+                for account_id in [BIG] + small:
+                    if account_id not in ready:
+                        status = sync.status(account_id)
+                        if status['syncs'] and not status['queue_depth'] and not status['in_progress']:
+                            ready[account_id] = now
+                peak_rss = max(peak_rss, rss_mib())
+                peak_threads = max(peak_threads, threading.active_count())
+            elapsed = time.perf_counter() - start
+            done.set()
+            await asyncio.gather(*users)
+        sync.close()
+        usage = {account.id: account.clients.usage() for account in accounts.opened()}
+        accounts.close()
+        shared.close()
+
+    totals = sync.status()
+    small_ready = [ready[account_id] for account_id in small]
+    units = [usage[account_id]['gmail_units'] for account_id in small]
+    return {
+        'small p50': statistics.median(small_ready), 'small p95': percentile(small_ready, 0.95),
+        'small max': max(small_ready), 'big': ready[BIG], 'elapsed': elapsed,
+        'rate': totals['generated'] / elapsed, 'generated': totals['generated'], 'failed': totals['failed'],
+        'user p50': statistics.median(latencies) if latencies else 0.0,
+        'user p95': percentile(latencies, 0.95) if latencies else 0.0,
+        'loads': len(latencies), 'pending loads': pending_loads,
+        'units': (min(units), statistics.median(units), max(units), usage[BIG]['gmail_units']),
+        'gemini': (statistics.median(usage[account_id]['gemini_requests'] for account_id in small),
+                   usage[BIG]['gemini_requests']),
+        'throttled': server.throttled, 'rss': peak_rss, 'threads': peak_threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=200, help='small accounts')
+    parser.add_argument('--mailbox', type=int, default=8, help='emails in each mailbox')
+    parser.add_argument('--backlog', type=int, default=2000, help="emails the big account starts with")
+    parser.add_argument('--workers', type=int, default=16, help='background generation workers')
+    parser.add_argument('--sync-concurrency', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=64, help='shared worker threads')
+    parser.add_argument('--users', type=int, default=4, help='concurrent dashboard users')
+    parser.add_argument('--think', type=float, default=0.2, help='seconds between a user\'s loads')
+    parser.add_argument('--gmail-latency', type=float, default=0.02)
+    parser.add_argument('--gmail-quota', type=float, default=250, help='units per second per mailbox')
+    parser.add_argument('--gemini-latency', type=float, default=0.1)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_accounts_'))
+    import main as app_main
+
+    print(f'{args.accounts} accounts of {args.mailbox} emails and one with a backlog of {args.backlog}, '
+          f'{args.workers} workers, Gmail {args.gmail_latency * 1000:.0f} ms, '
+          f'Gemini {args.gemini_latency * 1000:.0f} ms')
+    for name, worker_class in (('fifo', FifoSyncWorker), ('fair', SyncWorker)):
+        r = asyncio.run(run(app_main, args, worker_class))
+        print(f"\n{name}: {r['generated']} emails generated ({r['failed']} failed) in {r['elapsed']:.1f} s, "
+              f"{r['rate']:.0f}/s")
+        print(f"  small accounts ready: p50 {r['small p50']:.1f} s, p95 {r['small p95']:.1f} s, "
+              f"max {r['small max']:.1f} s; big account {r['big']:.1f} s")
+        print(f"  dashboard: {r['loads']} loads, p50 {r['user p50'] * 1000:.1f} ms, "
+              f"p95 {r['user p95'] * 1000:.1f} ms, {r['pending loads']} still showing pending rows")
+        print(f"  Gmail units per small account min/median/max {r['units'][0]}/{r['units'][1]:.0f}/"
+              f"{r['units'][2]}, big {r['units'][3]}; 429s {r['throttled']}")
+        print(f"  Gemini calls per small account (median) {r['gemini'][0]:.0f}, big {r['gemini'][1]}")
+        print(f"  peak {r['threads']} threads, {r['rss']:.0f} MiB RSS")
+
+
+if __name__ == '__main__':
+    main()
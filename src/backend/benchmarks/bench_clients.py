@@ -0,0 +1,88 @@
+"""Per-request client overhead: fresh clients per request vs the shared registry.
+
+"per-request" builds a GmailAPI (unpickle token, build the service from the
+discovery document) and a GeminiAPI (``genai.configure``) for every request,
+then makes one Gmail call on a new connection, as the endpoints used to.
+"registry" takes the clients from a ClientRegistry and reuses the calling
+thread's pooled connection. Nothing leaves the machine: the token is a stub
+and the Gmail call goes to the local fake server. Run from ``src/backend``::
+
+    python -m benchmarks.bench_clients [--requests 200]
+"""
+import argparse
+import os
+import pickle
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httplib2
+from google.oauth2.credentials import Credentials
+
+import benchmarks.fake_gemini  # noqa: F401  (sets a fake GEMINI_API_KEY)
+from clients import ClientRegistry
+from gemini_api import GeminiAPI
+from gmail_api import GmailAPI
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+
+
+def write_stub_credentials(workdir: str) -> str:
+    creds_path = os.path.join(workdir, 'gmail-creds.json')
+    with open(creds_path, 'w') as f:
+        f.write('{}')
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = creds_path
+    token_path = os.path.join(workdir, 'emails.token')
+    creds = Credentials(token='stub', refresh_token='stub', client_id='stub',
+                        client_secret='stub', token_uri='https://oauth2.googleapis.com/token',
+                        expiry=datetime.utcnow() + timedelta(hours=1))
+    with open(token_path, 'wb') as f:
+        pickle.dump(creds, f)
+    return token_path
+
+
+def per_request(token_path: str, fake_service):
+    start = time.perf_counter()
+    gmail = GmailAPI()
+    gmail.authenticate(token_path=token_path)
+    GeminiAPI()
+    setup = time.perf_counter() - start
+    fake_service.users().getProfile(userId='me').execute(http=httplib2.Http())
+    return setup, time.perf_counter() - start
+
+
+def from_registry(registry: ClientRegistry, fake_gmail: GmailAPI):
+    start = time.perf_counter()
+    registry.gmail()
+    registry.gemini()
+    setup = time.perf_counter() - start
+    fake_gmail.get_profile()
+    return setup, time.perf_counter() - start
+
+
+def report(name: str, samples):
+    setup = [s[0] * 1000 for s in samples]
+    total = [s[1] * 1000 for s in samples]
+    print(f'{name:<12} {statistics.median(setup):>12.3f} {statistics.median(total):>12.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_clients_')
+    token_path = write_stub_credentials(workdir)
+    with FakeGmailServer(FakeMailbox(size=1)) as server:
+        fake_service = server.build_service()
+        fake_gmail = GmailAPI()
+        fake_gmail.service = fake_service
+        registry = ClientRegistry(token_path=token_path)
+
+        print(f"{'mode':<12} {'setup (ms)':>12} {'total (ms)':>12}")
+        report('per-request', [per_request(token_path, fake_service) for _ in range(args.requests)])
+        report('registry', [from_registry(registry, fake_gmail) for _ in range(args.requests)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Duplicate work when several tabs refresh at once, with and without coalescing.
+
+``tabs`` clients call /api/unreplied-detect together, the last ones
+arriving ``stagger`` seconds apart like a double click, against the fake
+Gmail server and fake Gemini model with the result cache off. "separate"
+runs every request on its own, as before; "llm dedup" only shares the
+summaries and drafts of identical emails in flight; "single-flight" also
+joins whole runs. One more request right after the others shows the
+freshness window.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_coalesce [--tabs 4] [--count 20] [--stagger 0.3]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from accounts import Account
+from benchmarks.fake_clients import FakeClientRegistry
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+
+
+class SeparateRuns:
+    """Stands in for SingleFlight and runs every request's work on its own."""
+
+    async def run(self, key, work, emit=None):
+        async def ignore(event):
+            pass
+        return await work(emit or ignore)
+
+    def forget(self):
+        pass
+
+
+async def run_tabs(app_main, args, coalesce: bool, llm_dedup: bool):
+    from single_flight import SingleFlight
+
+    with FakeGmailServer(FakeMailbox(size=args.count), latency=args.gmail_latency) as server:
+        model = FakeGenerativeModel(latency=args.gemini_latency)
+        registry = FakeClientRegistry(server, model)
+        if not llm_dedup:
+            registry.pipeline()._generations = SeparateRuns()
+        account = Account('default', tempfile.mkdtemp(prefix='bench_coalesce_'), clients=registry)
+        account.flights = SingleFlight(fresh_for=args.fresh) if coalesce else SeparateRuns()
+        app_main.app.dependency_overrides[app_main.get_account] = lambda: account
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=300) as client:
+            async def tab(delay: float) -> float:
+                await asyncio.sleep(delay)
+                start = time.perf_counter()
+                response = await client.get('/api/unreplied-detect', params={'count': args.count})
+                assert len(response.json()['emails']) == args.count, response.text
+                return time.perf_counter() - start
+
+            delays = [0.0] * (args.tabs - 1) + [args.stagger]
+            latencies = await asyncio.gather(*(tab(delay) for delay in delays))
+            late = await tab(0.0)
+        registry.close()
+    return model.calls, server.calls, statistics.median(latencies), max(latencies), late
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tabs', type=int, default=4)
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--stagger', type=float, default=0.3,
+                        help='seconds between the first requests and the last concurrent one')
+    parser.add_argument('--fresh', type=float, default=5.0, help='freshness window in seconds')
+    parser.add_argument('--gmail-latency', type=float, default=0.05)
+    parser.add_argument('--gemini-latency', type=float, default=0.3)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_coalesce_'))
+    import main as app_main
+
+    print(f'{args.tabs} concurrent requests for {args.count} emails, then one more right after')
+    print(f"{'mode':<14} {'gemini calls':>13} {'gmail calls':>12} {'p50 (s)':>8} "
+          f"{'max (s)':>8} {'next (s)':>9}")
+    for mode, coalesce, llm_dedup in (('separate', False, False), ('llm dedup', False, True),
+                                      ('single-flight', True, True)):
+        gemini_calls, gmail_calls, p50, worst, late = asyncio.run(
+            run_tabs(app_main, args, coalesce, llm_dedup))
+        print(f'{mode:<14} {gemini_calls:>13} {gmail_calls:>12} {p50:>8.2f} {worst:>8.2f} {late:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Peak memory and time of /api/export, whole-file CSV vs the streaming export.
+
+The app is called directly over ASGI with a ``send`` that counts and drops
+the body, because TestClient buffers whole responses. Peak memory is traced
+with tracemalloc while the export runs. The whole-file numbers come from a
+copy of the old endpoint, which built the CSV in a StringIO from every row.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_export [--sizes 1000 10000 100000 1000000]
+"""
+import argparse
+import asyncio
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+# The old endpoint is only run up to this size; beyond it, it needs gigabytes.
+LEGACY_MAX_SIZE = 100000
+
+
+def generate_emails(count: int):
+    for i in range(count):
+        yield {
+            'id': f'm{i:07d}',
+            'thread_id': f't{i:07d}',
+            'sender': f'Sender {i % 500} <sender{i % 500}@example.org>',
+            'subject': f'Subject {i}',
+            'timestamp': str(1755000000000 - i * 60000),
+            'body': 'Hello, please review the attached schedule before Friday. ' * 4,
+            'summary': '- Review the schedule\n- Due Friday',
+            'replied': i % 3 == 0,
+            'draft': None if i % 3 == 0 else 'Hi, thanks - will do.',
+        }
+
+
+def fill_store(store, count: int, chunk: int = 10000) -> None:
+    emails = generate_emails(count)
+    while True:
+        batch = [email for _, email in zip(range(chunk), emails)]
+        if not batch:
+            return
+        store.upsert_many(batch)
+
+
+def legacy_app(store) -> FastAPI:
+    """The export endpoint as it was: the whole CSV built in memory first."""
+    from email_store import COLUMNS
+    app = FastAPI()
+
+    @app.get("/api/export")
+    def export_emails():
+        output = StringIO()
+        writer = csv.DictWriter(output, fieldnames=COLUMNS)
+        writer.writeheader()
+        for email in store.recent():
+            writer.writerow(email)
+        output.seek(0)
+        return StreamingResponse(output, media_type="text/csv")
+
+    return app
+
+
+async def call(app: FastAPI, query: str = ''):
+    """GET /api/export over ASGI, returning (status, body bytes)."""
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+             'method': 'GET', 'scheme': 'http', 'path': '/api/export', 'raw_path': b'/api/export',
+             'query_string': query.encode(), 'headers': [], 'client': ('bench', 0),
+             'server': ('bench', 80), 'root_path': ''}
+    result = {'status': 0, 'bytes': 0}
+    requested = False
+    finished = asyncio.Event()
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The response listens for a disconnect; only send one once it's done
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            result['bytes'] += len(message.get('body', b''))
+
+    await app(scope, receive, send)
+    finished.set()
+    return result['status'], result['bytes']
+
+
+def measure(app: FastAPI, query: str = ''):
+    tracemalloc.start()
+    start = time.perf_counter()
+    status, size = asyncio.run(call(app, query))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert status == 200, status
+    return elapsed, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='bench_export_'))
+    os.chdir(workdir)
+    import main as app_main
+    from accounts import Account
+    from email_store import EmailStore
+
+    print(f"{'emails':>8} {'export':<16} {'time (s)':>9} {'peak MiB':>9} {'out MiB':>8}")
+    for size in args.sizes:
+        store = EmailStore(workdir / f'emails_{size}.db')
+        fill_store(store, size)
+        account = Account('default', workdir, store=store)
+        app_main.app.dependency_overrides[app_main.get_account] = lambda: account
+        runs = [('streaming', app_main.app, ''), ('streaming gzip', app_main.app, 'gzip=true')]
+        if size <= LEGACY_MAX_SIZE:
+            runs.insert(0, ('whole file', legacy_app(store), ''))
+        for name, app, query in runs:
+            elapsed, peak, out = measure(app, query)
+            print(f'{size:>8} {name:<16} {elapsed:>9.2f} {peak / 2**20:>9.1f} {out / 2**20:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Model calls and latency per email: one prompt per email and task vs batched prompts.
+
+Uses the fake Gemini model, whose latency is a fixed cost per call plus a
+cost per prompt character, so batching only wins by saving fixed overhead.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_gemini_batch [--emails 20] [--latency 0.4]
+"""
+import argparse
+import random
+import time
+
+from benchmarks.fake_gemini import FakeGenerativeModel
+from gemini_api import GeminiAPI
+
+
+def make_emails(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    words = ['meeting', 'invoice', 'update', 'please', 'review', 'deadline', 'thanks', 'project']
+    return [{'id': f'm{i:04d}',
+             'content': ' '.join(rng.choice(words) for _ in range(rng.randint(40, 400))),
+             'needs_draft': i % 3 != 0} for i in range(count)]
+
+
+def per_email(gemini: GeminiAPI, emails):
+    for email in emails:
+        gemini.summarize_email(email['content'], use_cache=False)
+        if email['needs_draft']:
+            gemini.generate_draft_reply(email['content'], use_cache=False)
+
+
+def batched(gemini: GeminiAPI, emails):
+    gemini.summarize_and_draft_many(emails, use_cache=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--emails', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.4, help='fixed seconds per model call')
+    parser.add_argument('--latency-per-char', type=float, default=0.00002)
+    parser.add_argument('--drop-rate', type=float, default=0.05,
+                        help='fraction of emails missing from a batched answer')
+    args = parser.parse_args()
+
+    emails = make_emails(args.emails)
+    print(f"{'mode':<10} {'model calls':>12} {'wall (s)':>10} {'per email (s)':>14}")
+    for name, run in (('per-email', per_email), ('batched', batched)):
+        model = FakeGenerativeModel(latency=args.latency, latency_per_char=args.latency_per_char,
+                                    batch_drop_rate=args.drop_rate)
+        gemini = GeminiAPI()
+        gemini.model = model
+        start = time.perf_counter()
+        run(gemini, emails)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<10} {model.calls:>12} {elapsed:>10.2f} {elapsed / len(emails):>14.3f}')
+
+
+if __name__ == '__main__':
+    main()
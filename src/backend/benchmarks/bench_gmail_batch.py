@@ -0,0 +1,43 @@
+"""Compare per-message and batched Gmail fetches against the local fake server.
+
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_gmail_batch [--latency 0.02]
+"""
+import argparse
+import time
+
+from gmail_api import GmailAPI
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+
+
+def run(server: FakeGmailServer, count: int, batch_size: int):
+    gmail = GmailAPI(batch_size=batch_size)
+    gmail.service = server.build_service()
+    server.reset_counters()
+    start = time.perf_counter()
+    emails = gmail.get_recent_emails(max_results=count)
+    gmail.check_if_replied_many([email['thread_id'] for email in emails])
+    elapsed = time.perf_counter() - start
+    return server.round_trips, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='simulated seconds per HTTP round trip')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--counts', type=int, nargs='+', default=[5, 50, 500])
+    args = parser.parse_args()
+
+    mailbox = FakeMailbox(size=max(args.counts))
+    with FakeGmailServer(mailbox, latency=args.latency) as server:
+        print(f"{'count':>6} {'mode':>10} {'round trips':>12} {'wall (s)':>10}")
+        for count in args.counts:
+            for mode, batch_size in (('sequential', 1), ('batched', args.batch_size)):
+                trips, elapsed = run(server, count, batch_size)
+                print(f'{count:>6} {mode:>10} {trips:>12} {elapsed:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
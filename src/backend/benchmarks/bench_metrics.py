@@ -0,0 +1,111 @@
+"""Where /api/unreplied-detect spends its time, and what recording that costs.
+
+The first table reads the per-stage and per-call histograms after one run
+against the fake Gmail server and fake Gemini model with realistic latency.
+The second times the endpoint with no simulated latency, so only the app's
+own work is measured, with metrics off, metrics on, and metrics plus JSON
+trace spans (written to /dev/null). The last line is the cost of one timed
+block on its own.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_metrics [--count 50] [--gmail-latency 0.05] [--gemini-latency 0.3]
+"""
+import argparse
+import contextlib
+import os
+import statistics
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+
+from accounts import Account
+from benchmarks.fake_clients import FakeClientRegistry
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+
+
+@contextlib.contextmanager
+def detect_client(app_main, count: int, gmail_latency: float, gemini_latency: float):
+    """A TestClient whose /api/unreplied-detect talks to fresh fakes; yields a call function."""
+    mailbox = FakeMailbox(size=count)
+    with FakeGmailServer(mailbox, latency=gmail_latency) as server:
+        registry = FakeClientRegistry(server, FakeGenerativeModel(latency=gemini_latency))
+        account = Account('default', tempfile.mkdtemp(prefix='bench_metrics_'), clients=registry)
+        app_main.app.dependency_overrides[app_main.get_account] = lambda: account
+        client = TestClient(app_main.app)
+
+        def detect() -> float:
+            start = time.perf_counter()
+            response = client.get('/api/unreplied-detect', params={'count': count})
+            elapsed = time.perf_counter() - start
+            assert len(response.json()['emails']) == count, response.text
+            return elapsed
+
+        yield detect
+        registry.close()
+
+
+def print_breakdown(metrics):
+    print(f"{'stage / call':<34} {'count':>6} {'total (s)':>10} {'mean (ms)':>10}")
+    for histogram, label in ((metrics.STAGE_SECONDS, '{0}'),
+                             (metrics.PROVIDER_CALL_SECONDS, '{0} {1}')):
+        for key, (total, count) in sorted(histogram.series().items(), key=lambda item: -item[1][0]):
+            print(f'{label.format(*key):<34} {count:>6} {total:>10.2f} {total / count * 1000:>10.1f}')
+    tokens = metrics.GEMINI_TOKENS
+    print(f"gemini tokens: {tokens.value(kind='prompt'):.0f} prompt, "
+          f"{tokens.value(kind='output'):.0f} output")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--gmail-latency', type=float, default=0.05,
+                        help='simulated seconds per Gmail round trip')
+    parser.add_argument('--gemini-latency', type=float, default=0.3,
+                        help='simulated seconds per Gemini call')
+    parser.add_argument('--repeat', type=int, default=40)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_metrics_'))
+    import main as app_main
+    import metrics
+
+    metrics.REGISTRY.configure(enabled=True, tracing=False)
+    with detect_client(app_main, args.count, args.gmail_latency, args.gemini_latency) as detect:
+        elapsed = detect()
+    print(f'{args.count} emails in {elapsed:.2f} s '
+          f'(Gmail {args.gmail_latency * 1000:.0f} ms, Gemini {args.gemini_latency * 1000:.0f} ms)')
+    print_breakdown(metrics)
+
+    # Modes take turns so drift in machine load affects them all alike
+    modes = {'off': (False, False), 'metrics': (True, False), 'metrics + traces': (True, True)}
+    samples = {mode: [] for mode in modes}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            detect_client(app_main, args.count, 0, 0) as detect:
+        detect()
+        for _ in range(args.repeat):
+            for mode, (enabled, tracing) in modes.items():
+                metrics.REGISTRY.configure(enabled=enabled, tracing=tracing)
+                samples[mode].append(detect())
+    print(f"\n{'mode':<18} {'ms/request':>11} {'overhead':>9}")
+    baseline = statistics.median(samples['off'])
+    for mode, times in samples.items():
+        elapsed = statistics.median(times)
+        print(f'{mode:<18} {elapsed * 1000:>11.1f} {elapsed / baseline - 1:>9.1%}')
+
+    histogram = metrics.Histogram('bench_seconds', 'Timed block cost.', ['stage'],
+                                  registry=metrics.MetricsRegistry())
+    costs = []
+    for enabled in (False, True):
+        histogram.registry.enabled = enabled
+        start = time.perf_counter()
+        for _ in range(100000):
+            with metrics.timed(histogram, stage='x'):
+                pass
+        costs.append((time.perf_counter() - start) / 100000 * 1e9)
+    print(f'one timed block: {costs[0]:.0f} ns with metrics off, {costs[1]:.0f} ns on')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Prompt tokens per email, raw bodies vs preprocessed ones, on real-world-shaped fixtures.
+
+``fixtures/bodies`` holds replies from Gmail, Outlook and Apple Mail with
+their quoted history, signatures, legal footers, HTML newsletters with
+tracking links, a forward and a long report. ``fixtures/bodies.json`` lists
+phrases preprocessing must keep, the new content, and phrases it must drop;
+the run fails if one is not honoured. Then every fixture is summarized and
+drafted through the fake Gemini model, whose latency grows with the prompt,
+with bodies sent as they are and preprocessed.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_preprocess [--budget 1500] [--latency-per-char 0.00002]
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.fake_gemini import FakeGenerativeModel
+from email_text import DEFAULT_BODY_TOKEN_BUDGET, prepare_body
+from gemini_api import GeminiAPI, estimate_tokens
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+def load_fixtures():
+    expected = json.loads((FIXTURES / 'bodies.json').read_text(encoding='utf-8'))
+    return [(name, (FIXTURES / 'bodies' / name).read_text(encoding='utf-8'), checks)
+            for name, checks in sorted(expected.items())]
+
+
+def check(prepared: str, checks) -> list:
+    """What preprocessing got wrong for one fixture."""
+    return [f'lost "{phrase}"' for phrase in checks['keep'] if phrase not in prepared] + \
+           [f'kept "{phrase}"' for phrase in checks['drop'] if phrase in prepared]
+
+
+def generate(fixtures, budget, latency, latency_per_char):
+    model = FakeGenerativeModel(latency=latency, latency_per_char=latency_per_char)
+    gemini = GeminiAPI(body_token_budget=budget)
+    gemini.model = model
+    start = time.perf_counter()
+    # The per-email savings lines would drown the table
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, body, _ in fixtures:
+            gemini.summarize_email(body, use_cache=False)
+            gemini.generate_draft_reply(body, use_cache=False)
+    return gemini.usage, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=int, default=DEFAULT_BODY_TOKEN_BUDGET,
+                        help='estimated tokens per body, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=0.05, help='fixed seconds per model call')
+    parser.add_argument('--latency-per-char', type=float, default=0.00002)
+    parser.add_argument('--repeat', type=int, default=200, help='preprocessing runs per fixture when timing')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    failures = 0
+    total_before = total_after = 0
+    print(f"{'fixture':<22} {'tokens':>7} {'after':>6} {'saved':>6} {'prep (ms)':>10}  checks")
+    for name, body, checks in fixtures:
+        prepared = prepare_body(body, args.budget)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            prepare_body(body, args.budget)
+        prep_ms = (time.perf_counter() - start) / args.repeat * 1000
+        before, after = estimate_tokens(body), estimate_tokens(prepared)
+        total_before, total_after = total_before + before, total_after + after
+        problems = check(prepared, checks)
+        # Preprocessing twice must not strip more
+        if prepare_body(prepared, args.budget) != prepared:
+            problems.append('not stable when run again')
+        failures += bool(problems)
+        print(f"{name:<22} {before:>7} {after:>6} {1 - after / before:>6.0%} {prep_ms:>10.3f}  "
+              f"{'; '.join(problems) or 'ok'}")
+    print(f"{'total':<22} {total_before:>7} {total_after:>6} {1 - total_after / total_before:>6.0%}")
+
+    print(f"\nsummary and draft of every fixture, fake Gemini {args.latency * 1000:.0f} ms "
+          f"+ {args.latency_per_char * 1e6:.0f} us per prompt character")
+    print(f"{'bodies':<13} {'calls':>6} {'prompt tokens':>14} {'saved (est.)':>13} {'wall (s)':>9}")
+    for label, budget in (('as they are', None), ('preprocessed', args.budget)):
+        usage, elapsed = generate(fixtures, budget, args.latency, args.latency_per_char)
+        print(f"{label:<13} {usage['requests']:>6} {usage['prompt_tokens']:>14} "
+              f"{usage['body_tokens_saved']:>13} {elapsed:>9.2f}")
+    if failures:
+        print(f"\n{failures} fixture(s) failed their checks")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
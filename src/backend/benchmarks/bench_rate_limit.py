@@ -0,0 +1,87 @@
+"""Throughput against a provider quota with and without the client-side rate limiter.
+
+The fake Gmail server charges Gmail's per-method quota units and answers 429
+with Retry-After over its per-user limit; the fake Gemini model does the same
+per request. Several worker threads hammer each one, first with no limiter
+(only backoff on 429) and then with a token bucket sized to the quota.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_rate_limit [--quota 250] [--messages 300] [--workers 4]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+from gemini_api import GeminiAPI
+from gmail_api import GMAIL_QUOTA_COSTS, GmailAPI
+
+
+def run_workers(workers: int, jobs):
+    """Run the callables in ``jobs`` on ``workers`` threads; returns (seconds, failures)."""
+    failures = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(job) for job in jobs]:
+            try:
+                future.result()
+            except Exception:
+                failures += 1
+    return time.perf_counter() - start, failures
+
+
+def bench_gmail(limited: bool, args):
+    mailbox = FakeMailbox(size=args.messages)
+    with FakeGmailServer(mailbox, latency=args.latency,
+                         quota_units_per_second=args.quota) as server:
+        gmail = GmailAPI(batch_size=10, units_per_second=args.quota if limited else None)
+        gmail.service = server.build_service()
+        ids = mailbox.order
+        chunks = [ids[start:start + 10] for start in range(0, len(ids), 10)]
+        jobs = [lambda chunk=chunk: (gmail.get_messages(chunk), gmail.get_threads(chunk))
+                for chunk in chunks]
+        elapsed, failures = run_workers(args.workers, jobs)
+        units = len(ids) * (GMAIL_QUOTA_COSTS['gmail.users.messages.get']
+                            + GMAIL_QUOTA_COSTS['gmail.users.threads.get'])
+        return elapsed, failures, server.throttled, server.calls, units / elapsed
+
+
+def bench_gemini(limited: bool, args):
+    model = FakeGenerativeModel(latency=args.latency, requests_per_second=args.gemini_rps)
+    gemini = GeminiAPI(requests_per_minute=args.gemini_rps * 60 if limited else None)
+    gemini.model = model
+    jobs = [lambda i=i: gemini.summarize_email(f'email {i}', use_cache=False)
+            for i in range(args.gemini_calls)]
+
+    def job(call):
+        if not call().get('success'):
+            raise RuntimeError('summary failed')
+
+    elapsed, failures = run_workers(args.workers * 2, [lambda call=call: job(call) for call in jobs])
+    return elapsed, failures, model.throttled, model.calls, args.gemini_calls / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quota', type=float, default=250, help='Gmail quota units per second')
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--gemini-rps', type=float, default=20, help='Gemini requests per second')
+    parser.add_argument('--gemini-calls', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(f"{'provider':<8} {'limiter':<8} {'wall (s)':>9} {'failed':>7} {'429s':>6} "
+          f"{'calls':>6} {'throughput':>14}")
+    for provider, bench, unit, ceiling in (('gmail', bench_gmail, 'units/s', args.quota),
+                                           ('gemini', bench_gemini, 'req/s', args.gemini_rps)):
+        for limited in (False, True):
+            elapsed, failures, throttled, calls, rate = bench(limited, args)
+            print(f"{provider:<8} {'on' if limited else 'off':<8} {elapsed:>9.2f} {failures:>7} "
+                  f"{throttled:>6} {calls:>6} {rate:>7.1f} {unit:<8}"
+                  f"({rate / ceiling:.0%} of quota)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Query latency of /api/search (SQLite FTS5) on a large store, vs a LIKE scan.
+
+The store is filled with synthetic emails drawn from a Zipf-like vocabulary,
+plus topic words planted in a known share of them. Each query runs through
+the endpoint with a TestClient. The LIKE column is what an unranked search
+without an index costs: it stops after 20 hits, so it is only cheap when the
+word is common, and it scans every row when the word is rare.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_search [--emails 100000]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+
+VOCABULARY_SIZE = 20000
+# Topic words planted in a known share of emails, for queries of known selectivity
+TOPICS = {'meeting': 0.2, 'review': 0.1, 'invoice': 0.05, 'budget': 0.001}
+
+
+def make_vocabulary(rng: random.Random):
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'da', 'pe', 'gu']
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(3, 5))))
+    words = sorted(words)
+    rng.shuffle(words)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return words, weights
+
+
+def generate_emails(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    words, weights = make_vocabulary(rng)
+    for i in range(count):
+        text = rng.choices(words, weights, k=120)
+        for topic, share in TOPICS.items():
+            if rng.random() < share:
+                text[rng.randrange(len(text))] = topic
+        yield {
+            'id': f'm{i:07d}',
+            'thread_id': f't{i:07d}',
+            'sender': f'Sender {i % 2000} <sender{i % 2000}@example.org>',
+            'subject': ' '.join(text[:6]).capitalize(),
+            'timestamp': str(1755000000000 - i * 60000),
+            'body': ' '.join(text[6:]),
+            'summary': '- ' + ' '.join(text[10:20]),
+            'replied': i % 3 == 0,
+        }
+
+
+def timed(func, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def like_scan(store, term: str):
+    pattern = f'%{term}%'
+    with store._conn() as conn:
+        return conn.execute(
+            "SELECT id FROM emails WHERE sender LIKE ? OR subject LIKE ? OR body LIKE ? OR summary LIKE ?"
+            " ORDER BY timestamp DESC LIMIT 20", (pattern,) * 4).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--emails', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='bench_search_'))
+    os.chdir(workdir)
+    import main as app_main
+    from accounts import Account
+    from email_store import EmailStore, fts_query
+
+    store = EmailStore(workdir / 'emails.db')
+    account = Account('default', workdir, store=store)
+    app_main.app.dependency_overrides[app_main.get_account] = lambda: account
+    emails = generate_emails(args.emails)
+    start = time.perf_counter()
+    while True:
+        batch = [email for _, email in zip(range(10000), emails)]
+        if not batch:
+            break
+        store.upsert_many(batch)
+    print(f'indexed {args.emails} emails in {time.perf_counter() - start:.1f} s')
+
+    client = TestClient(app_main.app)
+    page = client.get('/api/search', params={'q': 'meeting'}).json()
+    for _ in range(9):
+        page = client.get('/api/search', params={'q': 'meeting', 'cursor': page['next_cursor']}).json()
+    queries = [
+        ('20% of emails', {'q': 'meeting'}, 'meeting'),
+        ('5% of emails', {'q': 'invoice'}, 'invoice'),
+        ('0.1% of emails', {'q': 'budget'}, 'budget'),
+        ('no match', {'q': 'nonexistent'}, 'nonexistent'),
+        ('two words', {'q': 'meeting review'}, None),
+        ('prefix', {'q': 'invo*'}, 'invo'),
+        ('sender', {'q': 'sender1234'}, 'sender1234'),
+        ('unreplied, 1 day', {'q': 'meeting', 'replied': 'false',
+                              'since': 1755000000000 - 86400000}, None),
+        ('newest first', {'q': 'invoice', 'sort': 'date'}, None),
+        ('page 11', {'q': 'meeting', 'cursor': page['next_cursor']}, None),
+    ]
+    print(f"{'query':<18} {'matches':>8} {'fts5 (ms)':>10} {'LIKE scan (ms)':>15}")
+    for name, params, term in queries:
+        with store._conn() as conn:
+            matches = conn.execute(
+                "SELECT COUNT(*) FROM emails_fts WHERE emails_fts MATCH ?",
+                (fts_query(params['q']),)).fetchone()[0]
+        fts = timed(lambda: client.get('/api/search', params=params), args.repeat)
+        scan = f'{timed(lambda: like_scan(store, term), 3):>15.1f}' if term else f"{'-':>15}"
+        print(f'{name:<18} {matches:>8} {fts:>10.1f} {scan}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Endpoint latency with the old flat emails.json file vs the SQLite store.
+
+The JSON numbers come from a copy of the old endpoints' storage code; the
+SQLite numbers go through the real endpoints. Both are driven through a
+TestClient. Run from
+``src/backend``::
+
+    python -m benchmarks.bench_store [--sizes 100 10000 100000]
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from fastapi import Body, FastAPI, Request
+from fastapi.testclient import TestClient
+
+
+def make_emails(count: int):
+    return [{
+        'id': f'm{i:07d}',
+        'thread_id': f't{i:07d}',
+        'sender': f'Sender {i} <sender{i}@example.org>',
+        'subject': f'Subject {i}',
+        'timestamp': str(1755000000000 - i * 60000),
+        'body': 'Hello, please review the attached schedule before Friday. ' * 8,
+        'summary': '- Review the schedule\n- Due Friday',
+        'replied': i % 3 == 0,
+        'draft': '' if i % 3 == 0 else 'Hi, thanks - will do.',
+    } for i in range(count)]
+
+
+def timed(func, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def legacy_app(path: Path) -> FastAPI:
+    """The storage parts of the endpoints as they were with emails.json."""
+    app = FastAPI()
+
+    @app.get("/api/emails")
+    def get_emails():
+        with open(path) as f:
+            data = json.load(f)
+        return {"emails": data.get("emails", [])}
+
+    @app.get("/api/unreplied-emails")
+    def get_unreplied_emails():
+        with open(path) as f:
+            data = json.load(f)
+        emails = data.get("emails", [])
+        unreplied = [email for email in emails if not email.get("replied")]
+        unreplied = sorted(unreplied, key=lambda e: int(e.get("timestamp", 0)), reverse=True)[:5]
+        return {"emails": unreplied}
+
+    @app.post("/api/reply")
+    def send_reply(email_id: str = Body(...), reply_text: str = Body(...)):
+        with open(path) as f:
+            data = json.load(f)
+        for email in data.get('emails', []):
+            if email['id'] == email_id:
+                email['replied'] = True
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return {"success": True}
+
+    @app.post("/api/save-emails")
+    async def save_emails(request: Request):
+        data = await request.json()
+        with open(path, "w") as f:
+            json.dump({"emails": data.get("emails", [])}, f)
+        return {"success": True}
+
+    return app
+
+
+def bench_endpoints(client: TestClient, emails, repeat: int):
+    return {
+        'GET /api/emails': timed(lambda: client.get('/api/emails'), repeat),
+        'GET /api/unreplied-emails': timed(lambda: client.get('/api/unreplied-emails'), repeat),
+        'POST /api/reply': timed(lambda: client.post(
+            '/api/reply', json={'email_id': 'm0000001', 'reply_text': 'ok'}), repeat),
+        'POST /api/save-emails': timed(lambda: client.post(
+            '/api/save-emails', json={'emails': emails[:20]}), repeat),
+    }
+
+
+def bench_json(path: Path, emails, repeat: int):
+    with open(path, 'w') as f:
+        json.dump({'emails': emails}, f)
+    # save-emails runs last because it shrinks the legacy file to 20 emails.
+    return bench_endpoints(TestClient(legacy_app(path)), emails, repeat)
+
+
+def bench_sqlite(main, client: TestClient, path: Path, emails, repeat: int):
+    from accounts import Account
+    from email_store import EmailStore
+    store = EmailStore(path)
+    store.upsert_many(emails)
+    account = Account('default', path.parent, store=store, clients=_StubClients())
+    main.app.dependency_overrides[main.get_account] = lambda: account
+    return bench_endpoints(client, emails, repeat)
+
+
+class _SentGmail:
+    def send_reply(self, thread_id, message_text):
+        return True
+
+
+class _StubClients:
+    def gmail(self):
+        return _SentGmail()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='bench_store_'))
+    os.chdir(workdir)
+    import main as app_main
+    client = TestClient(app_main.app)
+
+    print(f"{'emails':>8} {'endpoint':<26} {'json (ms)':>10} {'sqlite (ms)':>12}")
+    for size in args.sizes:
+        emails = make_emails(size)
+        old = bench_json(workdir / f'emails_{size}.json', emails, args.repeat)
+        new = bench_sqlite(app_main, client, workdir / f'emails_{size}.db', emails, args.repeat)
+        for endpoint in old:
+            print(f'{size:>8} {endpoint:<26} {old[endpoint]:>10.2f} {new[endpoint]:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
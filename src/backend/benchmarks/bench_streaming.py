@@ -0,0 +1,112 @@
+"""Regenerating a draft: /api/generate-draft vs /api/generate-draft/stream.
+
+The app is served by uvicorn on a local port, since streaming and client
+disconnects only show over a real connection, with the fake Gemini model
+writing a draft of about ``--draft-words`` words at ``--latency-per-token``
+seconds per output token. Each mode regenerates ``--requests`` drafts one
+after another, timing the first text on screen and the whole draft, then
+abandons as many after ``--abandon-after`` seconds, as a user closing the
+tab would, counting the output tokens the model still writes.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_streaming [--requests 20] [--latency-per-token 0.008]
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import httpx
+import uvicorn
+
+from accounts import AccountManager
+from benchmarks.fake_clients import FakeClientRegistry
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def blocking(client: httpx.Client, body: str, timeout: float = None):
+    """Seconds to the first draft text and to the whole draft, which are the same here."""
+    start = time.perf_counter()
+    response = client.post('/api/generate-draft', json={'email_id': 'e', 'body': body}, timeout=timeout)
+    assert response.json()['draft']
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+def streaming(client: httpx.Client, body: str, timeout: float = None):
+    start, first = time.perf_counter(), None
+    with client.stream('POST', '/api/generate-draft/stream', json={'email_id': 'e', 'body': body},
+                       timeout=timeout) as response:
+        for line in response.iter_lines():
+            if first is None and '"token"' in line:
+                first = time.perf_counter() - start
+            if timeout is not None and time.perf_counter() - start > timeout:
+                break
+    return first, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds to the first output token')
+    parser.add_argument('--latency-per-token', type=float, default=0.008)
+    parser.add_argument('--draft-words', type=int, default=180)
+    parser.add_argument('--abandon-after', type=float, default=0.5, help='seconds before a user gives up')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_streaming_'))
+    import main as app_main
+
+    words = ['thanks', 'for', 'the', 'update', 'on', 'the', 'project', 'timeline', 'and', 'budget']
+    draft = 'Hi Sam, ' + ' '.join(words[i % len(words)] for i in range(args.draft_words))
+    model = FakeGenerativeModel(latency=args.latency, latency_per_token=args.latency_per_token, draft=draft)
+    with FakeGmailServer(FakeMailbox(size=5)) as gmail:
+        app_main.app.state.accounts = AccountManager(
+            tempfile.mkdtemp(prefix='bench_streaming_'),
+            lambda account: FakeClientRegistry(gmail, model, account=account.id))
+        app_main.app.state.sync = None
+        server = uvicorn.Server(uvicorn.Config(app_main.app, host='127.0.0.1', port=args.port,
+                                               log_level='warning', lifespan='off'))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+
+        print(f"fake Gemini: {args.latency * 1000:.0f} ms to the first token, then "
+              f"{args.latency_per_token * 1000:.0f} ms per token; a draft of ~{len(draft) // 4 + 1} tokens")
+        print(f"\n{'endpoint':<10} {'first text p50':>15} {'p95':>7} {'whole draft p50':>16} {'p95':>7} "
+              f"{'tokens written per abandoned request':>38}")
+        with httpx.Client(base_url=f'http://127.0.0.1:{args.port}', timeout=60) as client:
+            for name, run in (('blocking', blocking), ('streaming', streaming)):
+                firsts, wholes = [], []
+                for i in range(args.requests):
+                    first, whole = run(client, f'{name} request {i}: can you send the updated plan?')
+                    firsts.append(first)
+                    wholes.append(whole)
+
+                before = model.output_tokens
+                for i in range(args.requests):
+                    try:
+                        run(client, f'{name} abandoned {i}: can you send the updated plan?',
+                            timeout=args.abandon_after)
+                    except httpx.TimeoutException:
+                        pass
+                # Let generations nobody waits for any more finish, or be cancelled
+                time.sleep(args.latency + args.latency_per_token * (len(draft) // 4 + 1) + 1)
+                wasted = (model.output_tokens - before) / args.requests
+                print(f"{name:<10} {statistics.median(firsts):>14.2f}s {percentile(firsts, 0.95):>6.2f}s "
+                      f"{statistics.median(wholes):>15.2f}s {percentile(wholes, 0.95):>6.2f}s {wasted:>38.0f}")
+        print(f"\nstreams cancelled by a disconnect: {model.streams_cancelled}")
+        server.should_exit = True
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Dashboard latency with all work in the request vs a background sync worker.
+
+"in request" is /api/unreplied-detect running the pipeline itself against
+the fake Gmail server and fake Gemini model: the first call is cold, later
+ones hit the Gemini result cache but still fetch from Gmail. "background"
+starts the sync worker, waits until it has pre-computed every summary and
+draft, then times the same endpoint reading the store. Last, new mail is
+delivered and a push notification sent, to time how long the worker takes
+to have it ready.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_sync [--mailbox 50] [--count 20] [--requests 50]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from functools import partial
+
+import httpx
+
+from accounts import DEFAULT_ACCOUNT, AccountManager
+from benchmarks.fake_clients import FakeClientRegistry
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+from llm_cache import LLMCache
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def wait_idle(client: httpx.AsyncClient, syncs: int = 1) -> None:
+    while True:
+        status = (await client.get('/api/sync/status')).json()
+        if status['syncs'] >= syncs and status['state'] == 'idle':
+            return
+        await asyncio.sleep(0.01)
+
+
+async def bench(app_main, args, background: bool):
+    workdir = tempfile.mkdtemp(prefix='bench_sync_')
+    with FakeGmailServer(FakeMailbox(size=args.mailbox), latency=args.gmail_latency) as server:
+        model = FakeGenerativeModel(latency=args.gemini_latency)
+        llm_cache = LLMCache(os.path.join(workdir, 'cache.db'))
+
+        def make_clients(account):
+            return FakeClientRegistry(server, model, llm_cache=llm_cache,
+                                      on_retry_result=partial(app_main.save_retried_email, account))
+        accounts = app_main.app.state.accounts = AccountManager(workdir, make_clients)
+        app_main.app.state.sync = None
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=300) as client:
+            async def detect() -> float:
+                start = time.perf_counter()
+                response = await client.get('/api/unreplied-detect', params={'count': args.count})
+                assert len(response.json()['emails']) == args.count, response.text
+                return time.perf_counter() - start
+
+            lines = []
+            if background:
+                start = time.perf_counter()
+                sync = app_main.app.state.sync = app_main.make_sync_worker(accounts, 3600)
+                sync.add_account(DEFAULT_ACCOUNT)
+                sync.start()
+                await wait_idle(client)
+                lines.append(f'pre-computed {sync.status()["generated"]} emails '
+                             f'in {time.perf_counter() - start:.2f} s')
+            else:
+                lines.append(f'first request (cold) {await detect() * 1000:.0f} ms')
+            samples = [await detect() for _ in range(args.requests)]
+            lines.append(f'p50 {statistics.median(samples) * 1000:.1f} ms, '
+                         f'p95 {percentile(samples, 0.95) * 1000:.1f} ms over {args.requests} requests')
+            if background:
+                start = time.perf_counter()
+                for i in range(5):
+                    server.mailbox.deliver('New Sender <new@example.org>', f'New mail {i}',
+                                           'Can we move the review to Friday?')
+                await client.post('/api/gmail/push')
+                await wait_idle(client, syncs=2)
+                lines.append(f'5 new emails pushed and ready in {time.perf_counter() - start:.2f} s')
+                sync.close()
+        accounts.close()
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mailbox', type=int, default=50)
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--gmail-latency', type=float, default=0.05)
+    parser.add_argument('--gemini-latency', type=float, default=0.3)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_sync_'))
+    import main as app_main
+
+    print(f'/api/unreplied-detect?count={args.count}, {args.mailbox} emails in the mailbox, '
+          f'Gmail {args.gmail_latency * 1000:.0f} ms, Gemini {args.gemini_latency * 1000:.0f} ms')
+    for name, background in (('in request', False), ('background', True)):
+        for line in asyncio.run(bench(app_main, args, background)):
+            print(f'{name:<11} {line}')
+
+
+if __name__ == '__main__':
+    main()
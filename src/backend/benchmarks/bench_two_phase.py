@@ -0,0 +1,68 @@
+"""Bytes and latency of listing recent emails: format='full' vs metadata-first.
+
+"full" is how every listing worked before: whole MIME trees for the
+messages and their threads. "metadata" fetches only the From and Subject
+headers plus the snippet, checks replies with From-only thread metadata,
+and downloads one body on demand the way /api/emails/{id}/body does.
+The fake server adds per-round-trip latency and a bandwidth limit.
+Run from ``src/backend``::
+
+    python -m benchmarks.bench_two_phase [--count 50] [--latency 0.05] [--bandwidth 2000000]
+"""
+import argparse
+import statistics
+import time
+
+from benchmarks.fake_gmail import FakeGmailServer, FakeMailbox
+from gmail_api import GmailAPI
+
+
+def measure(server: FakeGmailServer, step, repeat: int):
+    samples, sizes = [], []
+    for _ in range(repeat):
+        server.reset_counters()
+        start = time.perf_counter()
+        step()
+        samples.append(time.perf_counter() - start)
+        sizes.append(server.bytes_sent)
+    return statistics.median(samples), statistics.median(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated seconds per HTTP round trip')
+    parser.add_argument('--bandwidth', type=float, default=2000000, help='bytes per second')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    mailbox = FakeMailbox(size=args.count)
+    with FakeGmailServer(mailbox, latency=args.latency, bandwidth=args.bandwidth) as server:
+        gmail = GmailAPI()
+        gmail.service = server.build_service()
+        gmail.get_identity()
+        ids = gmail.list_message_ids(args.count)
+        threads = [message['threadId'] for message in map(mailbox.messages.get, ids)]
+
+        steps = [
+            ('messages, full', lambda: gmail.get_messages(ids)),
+            ('messages, metadata', lambda: gmail.get_messages(ids, format='metadata')),
+            ('threads, full', lambda: gmail.get_threads(threads)),
+            ('threads, metadata', lambda: gmail.get_threads(threads, format='metadata')),
+            ('one body on demand', lambda: gmail.get_bodies(ids[:1])),
+            ('listing, full', lambda: (gmail.get_recent_emails(args.count),
+                                       gmail.get_threads(threads))),
+            ('listing, metadata', lambda: (gmail.get_recent_emails(args.count, format='metadata'),
+                                           gmail.check_if_replied_many(threads))),
+        ]
+        print(f"{args.count} messages, {args.latency * 1000:.0f} ms per round trip, "
+              f"{args.bandwidth / 1e6:.1f} MB/s")
+        print(f"{'fetch':<20} {'KiB':>9} {'latency (ms)':>13}")
+        for name, step in steps:
+            elapsed, size = measure(server, step, args.repeat)
+            print(f'{name:<20} {size / 1024:>9.1f} {elapsed * 1000:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""A ClientRegistry wired to the fake Gmail server and fake Gemini model."""
+from typing import Optional
+
+from clients import ClientRegistry
+from gemini_api import GeminiAPI
+from gmail_api import GmailAPI
+from llm_cache import LLMCache
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import FakeGmailServer
+
+
+class FakeClientRegistry(ClientRegistry):
+    """Hands out clients that talk to local fakes instead of Google; ``mailbox`` picks one
+    of the server's mailboxes."""
+
+    def __init__(self, server: FakeGmailServer, model: FakeGenerativeModel,
+                 llm_cache: Optional[LLMCache] = None, mailbox: Optional[str] = None, **kwargs):
+        super().__init__(token_path='', llm_cache=llm_cache, **kwargs)
+        self.server = server
+        self.model = model
+        self.mailbox = mailbox
+
+    def _new_gmail(self) -> GmailAPI:
+        gmail = GmailAPI(units_per_second=self.gmail_units_per_second)
+        gmail.service = self.server.build_service(self.mailbox)
+        return gmail
+
+    def _new_gemini(self) -> GeminiAPI:
+        gemini = GeminiAPI(cache=self.llm_cache,
+                           requests_per_minute=self.gemini_requests_per_minute,
+                           tokens_per_minute=self.gemini_tokens_per_minute,
+                           body_token_budget=self.body_token_budget)
+        gemini.model = self.model
+        return gemini
@@ -0,0 +1,167 @@
+"""In-process stand-in for ``genai.GenerativeModel`` used by the benchmarks."""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+from google.api_core.exceptions import ResourceExhausted
+
+# GeminiAPI refuses to start without a key; the fake never sends it anywhere.
+os.environ.setdefault("GEMINI_API_KEY", "fake-key")
+
+
+SUMMARY = "- Sender asks for a review\n- Deadline is Friday"
+DRAFT = "Hi,\n\nThanks for your email - I'll get back to you shortly.\n\nBest"
+BATCH_MARKER = "Emails (JSON):"
+
+
+class FakeGenerativeModel:
+    """Answers ``generate_content`` after ``latency`` seconds plus
+    ``latency_per_char`` for every prompt character.
+
+    ``error_rate`` makes that fraction of calls raise the 429 the real SDK
+    raises, and so do calls beyond ``requests_per_second``. Batched JSON
+    prompts get one entry per email, except that ``batch_drop_rate`` of them
+    are left out. With ``stream=True`` the answer comes a few words per chunk,
+    ``latency_per_token`` apart for every output token; ``draft`` is the reply
+    it writes.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 latency_per_char: float = 0.0, batch_drop_rate: float = 0.0,
+                 requests_per_second: Optional[float] = None,
+                 latency_per_token: float = 0.0, draft: str = DRAFT):
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.error_rate = error_rate
+        self.batch_drop_rate = batch_drop_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.latency_per_token = latency_per_token
+        self.draft = draft
+        self.calls = 0
+        # Output tokens written, streamed or not, and streams closed before the end
+        self.output_tokens = 0
+        self.streams_cancelled = 0
+        self.prompt_chars = 0
+        self.throttled = 0
+        self.requests_per_second = requests_per_second
+        self._quota = requests_per_second or 0.0
+        self._quota_updated = time.monotonic()
+
+    def _over_quota(self) -> bool:
+        if not self.requests_per_second:
+            return False
+        now = time.monotonic()
+        rate = self.requests_per_second
+        self._quota = min(rate, self._quota + (now - self._quota_updated) * rate)
+        self._quota_updated = now
+        if self._quota < 1:
+            self.throttled += 1
+            return True
+        self._quota -= 1
+        return False
+
+    def generate_content(self, prompt, stream: bool = False, **kwargs):
+        with self.lock:
+            self.calls += 1
+            self.prompt_chars += len(prompt)
+            failed = self.error_rate and self.rng.random() < self.error_rate
+            if self._over_quota():
+                raise ResourceExhausted("Resource has been exhausted (e.g. check quota). "
+                                        "Please retry in 1s.")
+        delay = self.latency + self.latency_per_char * len(prompt)
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise ResourceExhausted("Resource has been exhausted (e.g. check quota).")
+        if BATCH_MARKER in prompt:
+            emails = json.loads(prompt.split(BATCH_MARKER, 1)[1])
+            with self.lock:
+                kept = [e for e in emails if not (self.batch_drop_rate
+                                                  and self.rng.random() < self.batch_drop_rate)]
+            text = json.dumps({e["id"]: {"summary": SUMMARY, "draft": DRAFT if e["needs_draft"] else None}
+                               for e in kept})
+        elif "reply" in prompt.split("\n", 3)[1]:
+            text = self.draft
+        else:
+            text = SUMMARY
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 4 + 1,
+                                candidates_token_count=len(text) // 4 + 1)
+        if stream:
+            return FakeStream(self, text, usage)
+        if self.latency_per_token:
+            time.sleep(self.latency_per_token * usage.candidates_token_count)
+        with self.lock:
+            self.output_tokens += usage.candidates_token_count
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+
+class FakeCall:
+    """The model's side of a streaming answer, like the gRPC call behind the SDK's
+    response: it writes chunks whether or not anyone reads them until it is
+    cancelled, which, as with gRPC, happens when it is garbage collected unfinished."""
+
+    def __init__(self, model: FakeGenerativeModel, text: str, tokens: int, pieces):
+        self.model = model
+        self._chunks: queue.Queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        # The writer gets only what it needs, not the call, so the call can be collected while it runs
+        threading.Thread(target=self._write, daemon=True,
+                         args=(model, text, tokens, pieces, self._chunks, self._cancelled, self._done)).start()
+
+    @staticmethod
+    def _write(model, text, tokens, pieces, chunks, cancelled, done):
+        for piece in pieces:
+            if cancelled.is_set():
+                break
+            # The whole answer's tokens, spread over its chunks by length
+            share = len(piece) / len(text) * tokens
+            if model.latency_per_token:
+                time.sleep(model.latency_per_token * share)
+            with model.lock:
+                model.output_tokens += share
+            chunks.put(SimpleNamespace(text=piece))
+        else:
+            done.set()
+        chunks.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self._chunks.get()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def cancel(self):
+        if not self._done.is_set() and not self._cancelled.is_set():
+            self._cancelled.set()
+            with self.model.lock:
+                self.model.streams_cancelled += 1
+
+    def __del__(self):
+        self.cancel()
+
+
+class FakeStream:
+    """A streaming response shaped like the SDK's: iterating wraps its call's
+    chunks in a generator, so closing that iterator only stops reading; the
+    call goes on until the response is garbage collected."""
+
+    def __init__(self, model: FakeGenerativeModel, text: str, usage, words_per_chunk: int = 3):
+        self.usage_metadata = usage
+        words = text.split(' ')
+        pieces = [' '.join(words[i:i + words_per_chunk]) + ' '
+                  for i in range(0, len(words), words_per_chunk)]
+        self._iterator = FakeCall(model, text, usage.candidates_token_count, pieces)
+
+    def __iter__(self):
+        for chunk in self._iterator:
+            yield chunk
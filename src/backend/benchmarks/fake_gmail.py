@@ -0,0 +1,418 @@
+"""Local fake of the Gmail REST API used by the benchmarks.
+
+The server speaks just enough of the Gmail v1 wire format (including the
+multipart batch endpoint) for ``GmailAPI`` to run unchanged against it, and
+counts HTTP round trips so batching and caching changes can be measured
+without touching a real mailbox.
+"""
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+
+import googleapiclient
+import httplib2
+from googleapiclient.discovery import build_from_document
+
+from gmail_api import DEFAULT_QUOTA_COST, GMAIL_QUOTA_COSTS
+
+USER_EMAIL = 'me@example.com'
+DISCOVERY_DOC = os.path.join(
+    os.path.dirname(googleapiclient.__file__), 'discovery_cache', 'documents', 'gmail.v1.json')
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def _transport_headers(msg_id: str, internal_date: int) -> List[Dict]:
+    """The relay and signature headers a real message carries, which format='full' returns."""
+    signature = base64.b64encode(msg_id.encode('ascii') * 40).decode('ascii')
+    return [
+        {'name': 'Delivered-To', 'value': USER_EMAIL},
+        {'name': 'Received', 'value': f'by 2002:a05:6a10:{msg_id} with SMTP id ab12cd; {internal_date}'},
+        {'name': 'X-Received', 'value': f'by 2002:a17:90a:{msg_id} with SMTP id ef34gh; {internal_date}'},
+        {'name': 'ARC-Seal', 'value': f'i=1; a=rsa-sha256; t={internal_date}; cv=none; b={signature}'},
+        {'name': 'DKIM-Signature', 'value': f'v=1; a=rsa-sha256; c=relaxed/relaxed; b={signature}'},
+        {'name': 'Return-Path', 'value': '<bounce@example.org>'},
+        {'name': 'MIME-Version', 'value': '1.0'},
+        {'name': 'Date', 'value': f'{internal_date}'},
+    ]
+
+
+class FakeMailbox:
+    """In-memory mailbox of ``size`` threads, every third one answered by the user.
+
+    Most messages are multipart/alternative (text and HTML); every fourth is
+    multipart/mixed with a nested alternative part and a PDF attachment, and
+    every fifth is HTML only.
+    """
+
+    def __init__(self, size: int = 50, seed: int = 0):
+        rng = random.Random(seed)
+        self.messages: Dict[str, Dict] = {}
+        self.threads: Dict[str, List[str]] = {}
+        self.order: List[str] = []
+        self.history: List[Dict] = []
+        self.history_id = 1000
+        self.oldest_history_id = self.history_id
+        self.now_ms = now_ms = 1755000000000
+        for i in range(size):
+            thread_id = f'm{i:06d}'  # like Gmail, a thread's id is its first message's id
+            sender = f'Sender {i} <sender{i}@example.org>'
+            body = ' '.join(rng.choice(['meeting', 'invoice', 'update', 'please', 'review',
+                                        'deadline', 'thanks', 'project', 'schedule'])
+                            for _ in range(80))
+            kind = 'html' if i % 5 == 4 else 'mixed' if i % 4 == 1 else 'alternative'
+            first = self._make_message(f'm{i:06d}', thread_id, sender, f'Subject {i}',
+                                       body, now_ms - i * 60000, kind)
+            self.threads[thread_id] = [first['id']]
+            if i % 3 == 0:
+                reply = self._make_message(f'r{i:06d}', thread_id, f'Me <{USER_EMAIL}>',
+                                           f'Re: Subject {i}', 'Thanks, will do.',
+                                           now_ms - i * 60000 + 1000)
+                self.threads[thread_id].append(reply['id'])
+            self.order.append(first['id'])
+
+    def _make_message(self, msg_id: str, thread_id: str, sender: str, subject: str,
+                      body: str, internal_date: int, kind: str = 'alternative') -> Dict:
+        text = {'mimeType': 'text/plain', 'filename': '',
+                'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="UTF-8"'}],
+                'body': {'size': len(body), 'data': _b64(body)}}
+        html_body = f'<html><head><style>p {{margin: 0}}</style></head><body><p>{body}</p></body></html>'
+        html = {'mimeType': 'text/html', 'filename': '',
+                'headers': [{'name': 'Content-Type', 'value': 'text/html; charset="UTF-8"'}],
+                'body': {'size': len(html_body), 'data': _b64(html_body)}}
+        if kind == 'html':
+            mime_type, parts = 'text/html', None
+        elif kind == 'mixed':
+            attachment = {'mimeType': 'application/pdf', 'filename': 'report.pdf',
+                          'headers': [{'name': 'Content-Disposition',
+                                       'value': 'attachment; filename="report.pdf"'}],
+                          'body': {'size': 48213, 'attachmentId': f'ANGjdJ_{msg_id}' * 8}}
+            mime_type, parts = 'multipart/mixed', [
+                {'mimeType': 'multipart/alternative', 'filename': '', 'headers': [],
+                 'body': {'size': 0}, 'parts': [text, html]},
+                attachment]
+        else:
+            mime_type, parts = 'multipart/alternative', [text, html]
+        payload = {
+            'mimeType': mime_type,
+            'filename': '',
+            'headers': _transport_headers(msg_id, internal_date) + [
+                {'name': 'From', 'value': sender},
+                {'name': 'To', 'value': USER_EMAIL},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Message-ID', 'value': f'<{msg_id}@example.org>'},
+                {'name': 'Content-Type', 'value': f'{mime_type}; boundary="{msg_id}"'},
+            ],
+            'body': {'size': 0},
+        }
+        if parts is None:
+            payload['body'] = html['body']
+        else:
+            payload['parts'] = parts
+        message = {
+            'id': msg_id,
+            'threadId': thread_id,
+            'labelIds': ['INBOX'],
+            'snippet': body[:100],
+            'internalDate': str(internal_date),
+            'historyId': str(self.history_id),
+            'sizeEstimate': len(json.dumps(payload)),
+            'payload': payload,
+        }
+        self.messages[msg_id] = message
+        return message
+
+    def _record(self, **change) -> None:
+        self.history_id += 1
+        self.history.append({'id': str(self.history_id), **change})
+
+    def deliver(self, sender: str, subject: str, body: str) -> Dict:
+        """Add a new incoming message in a new thread, as the newest in the inbox."""
+        index = len(self.threads)
+        thread_id = f'n{index:06d}'
+        self.now_ms += 60000
+        message = self._make_message(f'n{index:06d}', thread_id, sender, subject, body, self.now_ms)
+        self.threads[thread_id] = [message['id']]
+        self.order.insert(0, message['id'])
+        self._record(messagesAdded=[{'message': {'id': message['id'], 'threadId': thread_id,
+                                                 'labelIds': ['INBOX', 'UNREAD']}}])
+        return message
+
+    def reply(self, thread_id: str, body: str) -> Dict:
+        """Add a message sent by the user to an existing thread."""
+        self.now_ms += 1000
+        message = self._make_message(f'r{len(self.messages):06d}', thread_id, f'Me <{USER_EMAIL}>',
+                                     're', body, self.now_ms)
+        message['labelIds'] = ['SENT']
+        self.threads[thread_id].append(message['id'])
+        self._record(messagesAdded=[{'message': {'id': message['id'], 'threadId': thread_id,
+                                                 'labelIds': ['SENT']}}])
+        return message
+
+    def expire_history(self) -> None:
+        """Drop all history so older startHistoryIds get a 404, as Gmail does after about a week."""
+        self.history.clear()
+        self.oldest_history_id = self.history_id
+
+    def history_since(self, start_history_id: int) -> Optional[List[Dict]]:
+        if start_history_id < self.oldest_history_id:
+            return None
+        return [record for record in self.history if int(record['id']) > start_history_id]
+
+    def message(self, msg_id: str, format: str = 'full',
+                metadata_headers: Optional[List[str]] = None) -> Dict:
+        """A message resource as Gmail returns it in ``format`` ('full' or 'metadata')."""
+        message = self.messages[msg_id]
+        if format != 'metadata':
+            return message
+        wanted = {name.lower() for name in metadata_headers or []}
+        payload = message['payload']
+        return {**{k: v for k, v in message.items() if k != 'payload'},
+                'payload': {'mimeType': payload['mimeType'], 'filename': '',
+                            'headers': [h for h in payload['headers']
+                                        if not wanted or h['name'].lower() in wanted]}}
+
+    def thread(self, thread_id: str, format: str = 'full',
+               metadata_headers: Optional[List[str]] = None) -> Dict:
+        return {'id': thread_id,
+                'messages': [self.message(m, format, metadata_headers)
+                             for m in self.threads[thread_id]]}
+
+
+class FakeGmailServer:
+    """Threaded HTTP server serving a FakeMailbox on localhost.
+
+    ``latency`` is added to every HTTP round trip and ``error_rate`` makes that
+    fraction of individual API calls (batched or not) answer 503. With
+    ``quota_units_per_second`` calls are charged Gmail's per-method quota
+    units, and calls over the per-user limit answer 429 with Retry-After.
+    ``bandwidth`` (bytes per second) adds transfer time for each response.
+    More mailboxes, each a separate user with its own quota, can be added
+    with ``add_mailbox`` and reached through ``build_service(key)``.
+    """
+
+    def __init__(self, mailbox: FakeMailbox, latency: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 0,
+                 quota_units_per_second: Optional[float] = None,
+                 bandwidth: Optional[float] = None):
+        self.mailbox = mailbox
+        self.mailboxes: Dict[Optional[str], FakeMailbox] = {None: mailbox}
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.calls = 0
+        self.bytes_sent = 0
+        self.throttled = 0
+        self.calls_by_mailbox: Dict[Optional[str], int] = {}
+        self.quota_units_per_second = quota_units_per_second
+        # Per mailbox: [units left, when last refilled]
+        self._quota: Dict[Optional[str], List[float]] = {}
+        self.sent: List[Dict] = []
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'FakeGmailServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.round_trips = 0
+            self.calls = 0
+            self.bytes_sent = 0
+            self.throttled = 0
+            self.calls_by_mailbox.clear()
+
+    def add_mailbox(self, key: str, mailbox: FakeMailbox) -> None:
+        """Serve ``mailbox`` as another user, under the /u/<key>/ prefix."""
+        self.mailboxes[key] = mailbox
+
+    def __enter__(self) -> 'FakeGmailServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def build_service(self, key: Optional[str] = None):
+        """Build a googleapiclient Gmail service pointed at this server, for mailbox ``key``."""
+        with open(DISCOVERY_DOC) as f:
+            doc = json.load(f)
+        doc['rootUrl'] = doc['baseUrl'] = self.base_url + (f'u/{key}/' if key is not None else '')
+        return build_from_document(doc, http=httplib2.Http())
+
+    @staticmethod
+    def _split_mailbox(path: str) -> Tuple[Optional[str], List[str]]:
+        """The mailbox key in a request path, and the path's remaining segments."""
+        parts = path.strip('/').split('/')
+        if parts[0] == 'u' and len(parts) > 1:
+            return parts[1], parts[2:]
+        return None, parts
+
+    @staticmethod
+    def _method_id(method: str, resource: List[str]) -> str:
+        if resource in (['profile'], ['history'], ['settings', 'sendAs']):
+            name = {'profile': 'getProfile', 'history': 'history.list',
+                    'settings': 'settings.sendAs.list'}[resource[0]]
+        elif resource == ['messages']:
+            name = 'messages.list' if method == 'GET' else 'messages.insert'
+        elif resource == ['messages', 'send']:
+            name = 'messages.send'
+        else:
+            name = f'{resource[0]}.get' if resource else ''
+        return f'gmail.users.{name}'
+
+    def _charge(self, key: Optional[str], cost: int) -> bool:
+        """Take ``cost`` quota units if mailbox ``key``'s user has them; call with the lock held."""
+        now = time.monotonic()
+        rate = self.quota_units_per_second
+        quota = self._quota.setdefault(key, [rate, now])
+        quota[0] = min(rate, quota[0] + (now - quota[1]) * rate)
+        quota[1] = now
+        if quota[0] < cost:
+            self.throttled += 1
+            return False
+        quota[0] -= cost
+        return True
+
+    def dispatch(self, method: str, path: str, body: bytes = b'') -> Tuple[int, Dict]:
+        """Answer a single Gmail API call."""
+        parsed = urlparse(path)
+        query_lists = parse_qs(parsed.query)
+        query = {k: v[-1] for k, v in query_lists.items()}
+        format_args = (query.get('format', 'full'), query_lists.get('metadataHeaders'))
+        key, parts = self._split_mailbox(parsed.path)
+        # parts: gmail, v1, users, me, <resource>, ...
+        resource = parts[4:] if parts[:2] == ['gmail', 'v1'] else []
+        mailbox = self.mailboxes.get(key)
+        if mailbox is None:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        with self.lock:
+            self.calls += 1
+            self.calls_by_mailbox[key] = self.calls_by_mailbox.get(key, 0) + 1
+            failed = self.error_rate and self.rng.random() < self.error_rate
+            allowed = not self.quota_units_per_second or self._charge(key, GMAIL_QUOTA_COSTS.get(
+                self._method_id(method, resource), DEFAULT_QUOTA_COST))
+        if not allowed:
+            return 429, {'error': {'code': 429, 'message': 'User-rate limit exceeded.'}}
+        if failed:
+            return 503, {'error': {'code': 503, 'message': 'Backend Error'}}
+        if resource == ['profile']:
+            return 200, {'emailAddress': USER_EMAIL, 'messagesTotal': len(mailbox.messages),
+                         'historyId': str(mailbox.history_id)}
+        if resource == ['history']:
+            records = mailbox.history_since(int(query.get('startHistoryId', 0)))
+            if records is None:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            page_size = int(query.get('maxResults', 100))
+            offset = int(query.get('pageToken', 0))
+            response = {'history': records[offset:offset + page_size],
+                        'historyId': str(mailbox.history_id)}
+            if offset + page_size < len(records):
+                response['nextPageToken'] = str(offset + page_size)
+            return 200, response
+        if resource == ['settings', 'sendAs']:
+            return 200, {'sendAs': [{'sendAsEmail': USER_EMAIL, 'isPrimary': True}]}
+        if resource == ['messages'] and method == 'GET':
+            count = int(query.get('maxResults', 100))
+            ids = mailbox.order[:count]
+            return 200, {'messages': [{'id': m, 'threadId': mailbox.messages[m]['threadId']}
+                                      for m in ids],
+                         'resultSizeEstimate': len(ids)}
+        if resource == ['messages', 'send'] and method == 'POST':
+            payload = json.loads(body or b'{}')
+            with self.lock:
+                self.sent.append(payload)
+            return 200, {'id': f's{len(self.sent):06d}', 'threadId': payload.get('threadId')}
+        if len(resource) == 2 and resource[0] == 'messages' and resource[1] in mailbox.messages:
+            return 200, mailbox.message(resource[1], *format_args)
+        if len(resource) == 2 and resource[0] == 'threads' and resource[1] in mailbox.threads:
+            return 200, mailbox.thread(resource[1], *format_args)
+        return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+
+    def _dispatch_batch(self, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        message = Parser().parsestr(f'Content-Type: {content_type}\r\n\r\n' + body.decode('utf-8'))
+        boundary = 'batch_fake_gmail_boundary'
+        chunks = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            method, path, _ = request_line.split(' ', 2)
+            sub_body = rest.split('\r\n\r\n', 1)[1] if '\r\n\r\n' in rest else ''
+            status, payload = self.dispatch(method, path, sub_body.encode('utf-8'))
+            content_id = part['Content-ID'].replace('<', '<response-', 1)
+            retry_after = 'Retry-After: 1\r\n' if status == 429 else ''
+            chunks.append(
+                f'--{boundary}\r\n'
+                'Content-Type: application/http\r\n'
+                f'Content-ID: {content_id}\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n'
+                f'{retry_after}\r\n'
+                f'{json.dumps(payload)}\r\n')
+        chunks.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(chunks).encode('utf-8')
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method: str):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with server.lock:
+                    server.round_trips += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if server._split_mailbox(urlparse(self.path).path)[1] == ['batch']:
+                    status = 200
+                    content_type, content = server._dispatch_batch(
+                        self.headers['Content-Type'], body)
+                else:
+                    status, payload = server.dispatch(method, self.path, body)
+                    content_type, content = 'application/json; charset=UTF-8', json.dumps(payload).encode('utf-8')
+                with server.lock:
+                    server.bytes_sent += len(content)
+                if server.bandwidth:
+                    time.sleep(len(content) / server.bandwidth)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                if status == 429:
+                    self.send_header('Retry-After', '1')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
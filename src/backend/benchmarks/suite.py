@@ -0,0 +1,313 @@
+"""Every endpoint of the app against the fake Gmail server and Gemini model: latency, throughput, memory.
+
+Nothing leaves the machine: Gmail is the local fake server, with
+``--gmail-latency`` per round trip and ``--gmail-error-rate`` of them failing
+with 429/503, serving a mailbox of ``--mailbox`` threads; Gemini is the fake
+model with its own latency and error rate. Requests go through the ASGI app
+in process, so streaming endpoints are timed to their last event.
+
+Each endpoint gets ``--rounds`` rounds of ``--requests`` requests,
+``--concurrency`` at a time, after a warm-up request, first with background
+sync off and then, for the sync endpoints and the paths it changes, with the
+sync worker running. The report has p50/p95 latency, requests per second,
+the process's peak RSS while the endpoint ran and how many responses failed,
+each the median over the rounds so one hiccup does not make a regression.
+
+``--save`` writes the results as the baseline; later runs compare against it
+and exit with status 1 when an endpoint got slower, hungrier or less
+reliable by more than ``--tolerance`` (twice that for p95). Baselines depend on the machine, so
+save one before a change and compare after it on the same machine.
+Run from ``src/backend``::
+
+    python -m benchmarks.suite [--save] [--only detect] [--mailbox 200] [--requests 30]
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import httpx
+
+from accounts import AccountManager
+from benchmarks.fake_clients import FakeClientRegistry
+from benchmarks.fake_gemini import FakeGenerativeModel
+from benchmarks.fake_gmail import USER_EMAIL, FakeGmailServer, FakeMailbox
+from clients import SharedResources
+
+DEFAULT_BASELINE = Path(__file__).parent / 'baselines' / 'suite.json'
+# Differences below these are noise, whatever the tolerance says
+MIN_SECONDS = 0.005
+MIN_MIB = 20.0
+_unique = itertools.count()
+
+
+class Case(NamedTuple):
+    """One endpoint: ``request(i, ctx)`` gives the keyword arguments of its ``i``-th request."""
+    name: str
+    method: str
+    path: str
+    request: Callable[[int, Dict], Dict] = lambda i, ctx: {}
+    sync: bool = False
+
+
+def _body(i: int, ctx: Dict) -> Dict:
+    email = ctx['emails'][i % len(ctx['emails'])]
+    # A different body every time, so the LLM cache does not answer for the model
+    return {'email_id': email['id'], 'body': f"{email.get('body') or email['subject']} (request {next(_unique)})"}
+
+
+def _push(i: int, ctx: Dict) -> Dict:
+    data = json.dumps({'emailAddress': USER_EMAIL, 'historyId': 1000 + i}).encode()
+    return {'json': {'message': {'data': base64.b64encode(data).decode(), 'messageId': str(i)}}}
+
+
+CASES = [
+    Case('health', 'GET', '/'),
+    Case('metrics', 'GET', '/metrics'),
+    Case('metrics config', 'GET', '/api/metrics/config'),
+    Case('metrics config set', 'POST', '/api/metrics/config', lambda i, ctx: {'json': {}}),
+    Case('refresh', 'POST', '/api/refresh'),
+    Case('refresh stream', 'POST', '/api/refresh/stream'),
+    Case('last5', 'GET', '/api/last5'),
+    Case('emails', 'GET', '/api/emails'),
+    Case('email body', 'GET', '/api/emails/{id}/body',
+         lambda i, ctx: {'path': {'id': ctx['emails'][i % len(ctx['emails'])]['id']}}),
+    Case('search', 'GET', '/api/search',
+         lambda i, ctx: {'params': {'q': ['meeting', 'invoice', 'deadline', 'project'][i % 4]}}),
+    Case('generate summary', 'POST', '/api/generate-summary', lambda i, ctx: {'json': _body(i, ctx)}),
+    Case('generate summary stream', 'POST', '/api/generate-summary/stream',
+         lambda i, ctx: {'json': _body(i, ctx)}),
+    Case('generate draft', 'POST', '/api/generate-draft', lambda i, ctx: {'json': _body(i, ctx)}),
+    Case('generate draft stream', 'POST', '/api/generate-draft/stream', lambda i, ctx: {'json': _body(i, ctx)}),
+    Case('cache stats', 'GET', '/api/cache-stats'),
+    Case('gemini test', 'GET', '/api/gemini-test'),
+    Case('unreplied emails', 'GET', '/api/unreplied-emails'),
+    Case('unreplied detect', 'GET', '/api/unreplied-detect', lambda i, ctx: {'params': {'count': 5}}),
+    Case('unreplied detect stream', 'GET', '/api/unreplied-detect/stream', lambda i, ctx: {'params': {'count': 5}}),
+    Case('save emails', 'POST', '/api/save-emails',
+         lambda i, ctx: {'json': {'emails': ctx['emails'][i % len(ctx['emails']):][:5]}}),
+    Case('reply', 'POST', '/api/reply', lambda i, ctx: {'json': {
+        'email_id': ctx['emails'][i % len(ctx['emails'])]['id'], 'reply_text': f'Thanks, will do ({i}).'}}),
+    Case('export', 'GET', '/api/export'),
+    Case('accounts', 'GET', '/api/accounts'),
+    Case('create account', 'POST', '/api/accounts', lambda i, ctx: {'json': {'id': f'suite{next(_unique):05d}'}}),
+    Case('account usage', 'GET', '/api/account'),
+    Case('sync status', 'GET', '/api/sync/status', sync=True),
+    Case('sync trigger', 'POST', '/api/sync', sync=True),
+    Case('gmail push', 'POST', '/api/gmail/push', _push, sync=True),
+    Case('refresh (synced)', 'POST', '/api/refresh', sync=True),
+    Case('unreplied detect (synced)', 'GET', '/api/unreplied-detect',
+         lambda i, ctx: {'params': {'count': 5}}, sync=True),
+]
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def reset_peak_rss() -> None:
+    """Start the process's peak RSS over from its current RSS, where Linux allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mib() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def failed(response: httpx.Response) -> bool:
+    """Whether the endpoint reported an error, in its status, JSON body or final stream event."""
+    if response.status_code >= 400:
+        return True
+    content_type = response.headers.get('content-type', '')
+    if 'json' in content_type and 'ndjson' not in content_type:
+        body = response.json()
+        return isinstance(body, dict) and (body.get('success') is False or bool(body.get('error')))
+    if 'ndjson' in content_type or 'event-stream' in content_type:
+        return '"success": false' in response.text[-2000:]
+    return False
+
+
+async def measure(client: httpx.AsyncClient, case: Case, ctx: Dict, requests: int, concurrency: int) -> Dict:
+    """One round of ``requests`` requests to the endpoint, after a warm-up request."""
+    counter = iter(range(requests + 1))
+
+    async def send(i: int):
+        kwargs = dict(case.request(i, ctx))
+        path = case.path.format(**kwargs.pop('path', {}))
+        start = time.perf_counter()
+        response = await client.request(case.method, path, **kwargs)
+        return time.perf_counter() - start, failed(response)
+
+    await send(next(counter))  # Warm-up: clients built, caches and connections opened
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            elapsed, error = await send(i)
+            latencies.append(elapsed)
+            errors += error
+
+    reset_peak_rss()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    return {'p50': statistics.median(latencies), 'p95': percentile(latencies, 0.95),
+            'rps': len(latencies) / wall, 'peak_mib': peak_rss_mib(), 'errors': errors,
+            'requests': len(latencies)}
+
+
+def regressions(result: Dict, base: Dict, tolerance: float) -> List[str]:
+    """How ``result`` is worse than its baseline ``base``, beyond ``tolerance`` and noise."""
+    found = []
+    # The tail of a few dozen requests is noisier than the median, so it gets twice the slack
+    for key, slack in (('p50', 1), ('p95', 2)):
+        if result[key] > base[key] * (1 + tolerance * slack) and result[key] - base[key] > MIN_SECONDS * slack:
+            found.append(f"{key} {result[key] / base[key] - 1:+.0%}")
+    if result['rps'] < base['rps'] * (1 - tolerance) and 1 / result['rps'] - 1 / base['rps'] > MIN_SECONDS:
+        found.append(f"req/s {result['rps'] / base['rps'] - 1:+.0%}")
+    if result['peak_mib'] - base['peak_mib'] > max(MIN_MIB, base['peak_mib'] * tolerance):
+        found.append(f"peak +{result['peak_mib'] - base['peak_mib']:.0f} MiB")
+    if result['errors'] > base['errors']:
+        found.append(f"errors {base['errors']} -> {result['errors']}")
+    return found
+
+
+async def run(app_main, args, cases: List[Case]):
+    """Measure ``cases`` in order, yielding each case with its result."""
+    workdir = tempfile.mkdtemp(prefix='bench_suite_')
+    model = FakeGenerativeModel(latency=args.gemini_latency, error_rate=args.gemini_error_rate,
+                                latency_per_token=args.gemini_latency_per_token)
+    mailbox = FakeMailbox(size=args.mailbox)
+    with FakeGmailServer(mailbox, latency=args.gmail_latency, error_rate=args.gmail_error_rate) as server:
+        shared = SharedResources(threads=app_main.WORKER_THREADS)
+
+        def make_clients(account):
+            return FakeClientRegistry(server, model, llm_cache=app_main.LLM_CACHE, shared=shared,
+                                      account=account.id,
+                                      gmail_concurrency=app_main.GMAIL_CONCURRENCY,
+                                      gemini_concurrency=app_main.GEMINI_CONCURRENCY,
+                                      on_retry_result=partial(app_main.save_retried_email, account))
+        accounts = app_main.app.state.accounts = AccountManager(workdir, make_clients,
+                                                                 fresh_for=app_main.COALESCE_FRESH_SECONDS)
+        app_main.app.state.sync = None
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://suite', timeout=300) as client:
+            await client.post('/api/refresh')
+            ctx = {'emails': (await client.get('/api/emails')).json()['emails']}
+            if not ctx['emails']:
+                raise RuntimeError('The first refresh stored no emails; lower the error rates')
+
+            for case in cases:
+                if case.sync and app_main.app.state.sync is None:
+                    sync = app_main.app.state.sync = app_main.make_sync_worker(accounts, 3600)
+                    sync.add_account('default')
+                    sync.start()
+                    await sync.sync_now('default')
+                    while sync.status('default')['state'] != 'idle':
+                        await asyncio.sleep(0.05)
+                rounds = [await measure(client, case, ctx, args.requests, args.concurrency)
+                          for _ in range(args.rounds)]
+                result = {key: statistics.median(r[key] for r in rounds) for key in rounds[0]}
+                result['requests'] = sum(r['requests'] for r in rounds)
+                yield case, result
+        if app_main.app.state.sync is not None:
+            app_main.app.state.sync.close()
+        accounts.close()
+        shared.close()
+
+
+async def main_async(app_main, args, cases: List[Case], baseline: Optional[Dict]) -> Dict[str, Dict]:
+    results = {}
+    print(f"{'endpoint':<27} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>8} {'peak MiB':>9} {'errors':>7}  vs baseline")
+    start = time.perf_counter()
+    async for case, result in run(app_main, args, cases):
+        results[case.name] = result
+        base = (baseline or {}).get('results', {}).get(case.name)
+        if base is None:
+            verdict = '-'
+        else:
+            verdict = '; '.join(regressions(result, base, args.tolerance)) or \
+                      f"ok (p95 {result['p95'] / base['p95'] - 1:+.0%})"
+        print(f"{case.name:<27} {result['p50'] * 1000:>8.1f} {result['p95'] * 1000:>8.1f} "
+              f"{result['rps']:>8.1f} {result['peak_mib']:>9.0f} {result['errors']:>7g}  {verdict}")
+    print(f"\n{len(results)} endpoints, {sum(r['requests'] for r in results.values())} requests "
+          f"in {time.perf_counter() - start:.1f} s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mailbox', type=int, default=200, help='threads in the fake mailbox')
+    parser.add_argument('--requests', type=int, default=30, help='measured requests per endpoint and round')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--gmail-latency', type=float, default=0.01, help='seconds per Gmail round trip')
+    parser.add_argument('--gmail-error-rate', type=float, default=0.0)
+    parser.add_argument('--gemini-latency', type=float, default=0.05, help='seconds per Gemini call')
+    parser.add_argument('--gemini-latency-per-token', type=float, default=0.0)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--only', help='run the endpoints whose name matches this regex')
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.35,
+                        help='how much worse than the baseline counts as a regression')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in (
+        'mailbox', 'requests', 'rounds', 'concurrency', 'gmail_latency', 'gmail_error_rate',
+        'gemini_latency', 'gemini_latency_per_token', 'gemini_error_rate')}
+    cases = [case for case in CASES if not args.only or re.search(args.only, case.name)]
+    baseline = None
+    if args.baseline.exists() and not args.save:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get('config') != config:
+            print(f"warning: {args.baseline} was saved with {baseline.get('config')}, not {config}")
+
+    os.environ.setdefault('BACKGROUND_SYNC_SECONDS', '0')
+    os.chdir(tempfile.mkdtemp(prefix='bench_suite_'))
+    import main as app_main
+
+    results = asyncio.run(main_async(app_main, args, cases, baseline))
+    if args.save:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        saved = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        if saved.get('config') != config:
+            saved = {}
+        saved = {'config': config, 'saved_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                 'results': {**saved.get('results', {}), **results}}
+        args.baseline.write_text(json.dumps(saved, indent=2, sort_keys=True))
+        print(f"baseline saved to {args.baseline}")
+    elif baseline is not None:
+        worse = [name for name, result in results.items() if name in baseline['results']
+                 and regressions(result, baseline['results'][name], args.tolerance)]
+        if worse:
+            print(f"regressions against {args.baseline}: {', '.join(worse)}")
+            sys.exit(1)
+        print(f"no regressions against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
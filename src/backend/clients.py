@@ -0,0 +1,174 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from gmail_api import GmailAPI
+from email_text import DEFAULT_BODY_TOKEN_BUDGET
+from gemini_api import GeminiAPI
+from llm_cache import LLMCache
+from metrics import Sample, labelled
+from pipeline import EmailPipeline, DEFAULT_GMAIL_CONCURRENCY, DEFAULT_GEMINI_CONCURRENCY
+from rate_limit import TokenBucket
+
+DEFAULT_WORKER_THREADS = 64
+
+
+class SharedResources:
+    """What the clients of every account draw on together.
+
+    One Gemini API key serves all mailboxes, so its request and token
+    budgets are shared; blocking Gmail and Gemini calls run on one pool of
+    ``threads`` worker threads instead of a pool per account.
+    """
+
+    def __init__(self, gemini_requests_per_minute: Optional[float] = None,
+                 gemini_tokens_per_minute: Optional[float] = None,
+                 threads: int = DEFAULT_WORKER_THREADS):
+        self.gemini_request_limiter = (TokenBucket(gemini_requests_per_minute / 60)
+                                       if gemini_requests_per_minute else None)
+        self.gemini_token_limiter = (TokenBucket(gemini_tokens_per_minute / 60)
+                                     if gemini_tokens_per_minute else None)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='clients')
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class ClientRegistry:
+    """One account's Gmail and Gemini clients, shared by every request for it.
+
+    Each client is built on first use: the Gmail service is authenticated and
+    its discovery document loaded once, and ``genai.configure`` runs once.
+    The Gmail access token is refreshed ahead of expiry whenever the client
+    is handed out. The Gmail quota is per mailbox, so each registry has its
+    own limiter; with ``shared`` the Gemini budgets and worker threads are
+    those of the whole process, otherwise the registry has its own.
+    """
+
+    def __init__(self, token_path: str, llm_cache: Optional[LLMCache] = None,
+                 gmail_concurrency: int = DEFAULT_GMAIL_CONCURRENCY,
+                 gemini_concurrency: int = DEFAULT_GEMINI_CONCURRENCY,
+                 batch_prompts: bool = False,
+                 gmail_units_per_second: Optional[float] = None,
+                 gemini_requests_per_minute: Optional[float] = None,
+                 gemini_tokens_per_minute: Optional[float] = None,
+                 on_retry_result: Optional[Callable[[Dict], None]] = None,
+                 shared: Optional[SharedResources] = None,
+                 account: str = 'default',
+                 body_token_budget: Optional[int] = DEFAULT_BODY_TOKEN_BUDGET):
+        self.token_path = token_path
+        self.llm_cache = llm_cache
+        self.gmail_concurrency = gmail_concurrency
+        self.gemini_concurrency = gemini_concurrency
+        self.batch_prompts = batch_prompts
+        self.gmail_units_per_second = gmail_units_per_second
+        self.gemini_requests_per_minute = gemini_requests_per_minute
+        self.gemini_tokens_per_minute = gemini_tokens_per_minute
+        self.on_retry_result = on_retry_result
+        self.shared = shared
+        self.account = account
+        self.body_token_budget = body_token_budget
+        self._lock = threading.Lock()
+        self._gmail: Optional[GmailAPI] = None
+        self._gemini: Optional[GeminiAPI] = None
+        self._pipeline: Optional[EmailPipeline] = None
+
+    def _new_gmail(self) -> GmailAPI:
+        gmail = GmailAPI(units_per_second=self.gmail_units_per_second)
+        gmail.authenticate(token_path=self.token_path)
+        return gmail
+
+    def _new_gemini(self) -> GeminiAPI:
+        return GeminiAPI(cache=self.llm_cache,
+                         requests_per_minute=self.gemini_requests_per_minute,
+                         tokens_per_minute=self.gemini_tokens_per_minute,
+                         body_token_budget=self.body_token_budget)
+
+    def gmail(self) -> GmailAPI:
+        with self._lock:
+            if self._gmail is None:
+                self._gmail = self._new_gmail()
+        self._gmail.refresh_token_if_needed()
+        return self._gmail
+
+    def gemini(self) -> GeminiAPI:
+        with self._lock:
+            if self._gemini is None:
+                gemini = self._new_gemini()
+                if self.shared is not None:
+                    gemini.request_limiter = self.shared.gemini_request_limiter
+                    gemini.token_limiter = self.shared.gemini_token_limiter
+                self._gemini = gemini
+        return self._gemini
+
+    def pipeline(self) -> EmailPipeline:
+        """Return the shared pipeline, so its concurrency limits hold across requests."""
+        gmail, gemini = self.gmail(), self.gemini()
+        with self._lock:
+            if self._pipeline is None:
+                self._pipeline = EmailPipeline(gmail, gemini,
+                                               gmail_concurrency=self.gmail_concurrency,
+                                               gemini_concurrency=self.gemini_concurrency,
+                                               batch_prompts=self.batch_prompts,
+                                               on_retry_result=self.on_retry_result,
+                                               executor=self.shared.executor if self.shared else None)
+        return self._pipeline
+
+    def usage(self) -> Dict:
+        """Quota this account has spent since the process started."""
+        gmail, gemini = self._gmail, self._gemini
+        gemini_usage = dict(gemini.usage) if gemini is not None else {
+            'requests': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'body_tokens_saved': 0}
+        return {
+            "gmail_units": gmail.units_used if gmail is not None else 0,
+            "gmail_limiter_wait_seconds": gmail.limiter.waited if gmail and gmail.limiter else 0.0,
+            "gemini_requests": gemini_usage['requests'],
+            "gemini_prompt_tokens": gemini_usage['prompt_tokens'],
+            "gemini_output_tokens": gemini_usage['output_tokens'],
+            "gemini_body_tokens_saved": gemini_usage['body_tokens_saved'],
+        }
+
+    def metrics(self) -> List[Sample]:
+        """Quota use, rate limiter waits and background retry counts of the clients built so far,
+        labelled with the account, for /metrics."""
+        samples = []
+        usage = self.usage()
+        samples += [
+            (labelled('intellimail_account_gmail_units_total', account=self.account), 'counter',
+             'Gmail quota units spent per account.', usage['gmail_units']),
+            (labelled('intellimail_account_gemini_requests_total', account=self.account), 'counter',
+             'Gemini model calls made per account.', usage['gemini_requests']),
+            (labelled('intellimail_account_gemini_tokens_total', account=self.account, kind='prompt'),
+             'counter', 'Gemini tokens used per account.', usage['gemini_prompt_tokens']),
+            (labelled('intellimail_account_gemini_tokens_total', account=self.account, kind='output'),
+             'counter', 'Gemini tokens used per account.', usage['gemini_output_tokens']),
+            (labelled('intellimail_account_gemini_body_tokens_saved_total', account=self.account), 'counter',
+             'Estimated prompt tokens body preprocessing saved per account.', usage['gemini_body_tokens_saved']),
+        ]
+        limiters = [('gmail', self._gmail.limiter if self._gmail else None)]
+        if self.shared is None:
+            limiters += [('gemini_requests', self._gemini.request_limiter if self._gemini else None),
+                         ('gemini_tokens', self._gemini.token_limiter if self._gemini else None)]
+        for name, limiter in limiters:
+            if limiter is not None:
+                samples.append((labelled(f'intellimail_{name}_limiter_wait_seconds_total', account=self.account),
+                                'counter', f'Seconds callers waited on the {name.replace("_", " ")} rate limiter.',
+                                limiter.waited))
+        retries = self._pipeline.retries if self._pipeline else None
+        if retries is not None:
+            stats = retries.stats()
+            samples += [
+                (labelled('intellimail_background_retry_pending', account=self.account), 'gauge',
+                 'Emails waiting for a background retry of their summary or draft.', stats['pending']),
+                (labelled('intellimail_background_retry_recovered_total', account=self.account), 'counter',
+                 'Emails whose failed fields a background retry recovered.', stats['recovered']),
+                (labelled('intellimail_background_retry_dropped_total', account=self.account), 'counter',
+                 'Emails background retries gave up on.', stats['dropped']),
+            ]
+        return samples
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pipeline is not None:
+                self._pipeline.close()
+                self._pipeline = None
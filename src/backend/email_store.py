@@ -0,0 +1,414 @@
+import base64
+import json
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+COLUMNS = ["id", "thread_id", "sender", "subject", "timestamp", "body", "summary", "replied", "draft"]
+# Connections per store at most, however many threads use it; with hundreds
+# of accounts, a connection per thread per store runs out of file descriptors.
+DEFAULT_POOL_SIZE = 4
+# Connections a store keeps open between operations; the others are closed
+IDLE_CONNECTIONS = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    sender TEXT NOT NULL DEFAULT '',
+    subject TEXT NOT NULL DEFAULT '',
+    timestamp INTEGER NOT NULL DEFAULT 0,
+    body TEXT NOT NULL DEFAULT '',
+    summary TEXT NOT NULL DEFAULT '',
+    replied INTEGER NOT NULL DEFAULT 0,
+    draft TEXT
+);
+CREATE INDEX IF NOT EXISTS emails_thread_id ON emails (thread_id);
+CREATE INDEX IF NOT EXISTS emails_timestamp_id ON emails (timestamp, id);
+CREATE INDEX IF NOT EXISTS emails_replied_timestamp ON emails (replied, timestamp);
+-- Only the emails still waiting for a summary or draft, see needs_generation
+CREATE INDEX IF NOT EXISTS emails_needs_generation ON emails (timestamp, id)
+    WHERE summary = '' OR (replied = 0 AND COALESCE(draft, '') = '');
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+-- Full-text index over the searchable columns, kept in step with emails by
+-- the triggers below. It refers to rows by rowid, so never VACUUM the
+-- database without rebuilding it.
+CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+    sender, subject, body, summary,
+    content='emails', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+    INSERT INTO emails_fts (rowid, sender, subject, body, summary)
+    VALUES (new.rowid, new.sender, new.subject, new.body, new.summary);
+END;
+CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+    INSERT INTO emails_fts (emails_fts, rowid, sender, subject, body, summary)
+    VALUES ('delete', old.rowid, old.sender, old.subject, old.body, old.summary);
+END;
+CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF sender, subject, body, summary ON emails BEGIN
+    INSERT INTO emails_fts (emails_fts, rowid, sender, subject, body, summary)
+    VALUES ('delete', old.rowid, old.sender, old.subject, old.body, old.summary);
+    INSERT INTO emails_fts (rowid, sender, subject, body, summary)
+    VALUES (new.rowid, new.sender, new.subject, new.body, new.summary);
+END;
+"""
+
+# bm25 weights of sender, subject, body and summary in search ranking
+SEARCH_WEIGHTS = (4.0, 3.0, 1.0, 2.0)
+# Wrap matched terms in search highlights. Control characters, not markdown
+# like "**", since summaries are markdown; they are stripped from stored text.
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+_HIGHLIGHT_MARKS = str.maketrans('', '', HIGHLIGHT_START + HIGHLIGHT_END)
+
+
+def fts_query(text: str) -> str:
+    """Turn user input into an FTS5 query matching every word.
+
+    Each word is quoted so FTS5 syntax in the input is taken literally; a
+    trailing ``*`` makes it a prefix query (``inv*`` matches "invoice").
+    """
+    terms = []
+    for token in text.split():
+        prefix = token.endswith('*')
+        word = token.rstrip('*').replace('"', '')
+        if re.search(r'\w', word):
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' AND '.join(terms)
+
+
+def _encode_cursor(key: Tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list) or len(key) != 2:
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+# ON CONFLICT clause for upsert_many(keep_generated=True)
+KEEP_GENERATED_CONFLICT = """
+ON CONFLICT (id) DO UPDATE SET
+    thread_id = excluded.thread_id,
+    sender = excluded.sender,
+    subject = excluded.subject,
+    timestamp = excluded.timestamp,
+    body = excluded.body,
+    summary = CASE WHEN excluded.summary = '' THEN emails.summary ELSE excluded.summary END,
+    replied = MAX(emails.replied, excluded.replied),
+    draft = CASE WHEN COALESCE(excluded.draft, '') = '' AND MAX(emails.replied, excluded.replied) = 0
+                 THEN emails.draft ELSE excluded.draft END
+"""
+
+
+class EmailStore:
+    """SQLite-backed store for processed emails.
+
+    The database runs in WAL mode so readers never block the writer. Each
+    operation borrows one of at most ``pool_size`` connections, and waits
+    while all are in use; only IDLE_CONNECTIONS stay open in between. Rows come back as
+    the same dicts the API has always returned (``timestamp`` as a string,
+    ``replied`` as a bool).
+    """
+
+    def __init__(self, path: Union[str, Path], legacy_json: Optional[Union[str, Path]] = None,
+                 pool_size: int = DEFAULT_POOL_SIZE):
+        self.path = str(path)
+        self.pool_size = pool_size
+        self._idle: queue.Queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            with conn:
+                if not conn.execute("SELECT 1 FROM meta WHERE key = 'fts_built'").fetchone():
+                    # Index the emails stored before the search index existed
+                    conn.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+                    conn.execute("INSERT INTO meta (key, value) VALUES ('fts_built', '1')")
+        if legacy_json is not None:
+            self._migrate_json(Path(legacy_json))
+
+    def _connect(self) -> sqlite3.Connection:
+        # Pooled connections move between threads, one operation at a time
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # INSERT OR REPLACE must fire the delete trigger that unindexes the old row
+        conn.execute("PRAGMA recursive_triggers=ON")
+        return conn
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        """A connection of the pool for one operation; never nest these."""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            finally:
+                if self._idle.qsize() < IDLE_CONNECTIONS:
+                    self._idle.put(conn)
+                else:
+                    conn.close()
+
+    def close(self) -> None:
+        """Close the store's connections once operations in flight are done with
+        theirs. The store stays usable and reconnects when used again."""
+        for _ in range(self.pool_size):
+            self._slots.acquire()
+        try:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+        finally:
+            for _ in range(self.pool_size):
+                self._slots.release()
+
+    def _migrate_json(self, json_path: Path) -> None:
+        """Import the old flat ``emails.json`` file once."""
+        with self._conn() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+                return
+            emails = []
+            if json_path.exists():
+                with open(json_path) as f:
+                    content = f.read().strip()
+                if content:
+                    emails = json.loads(content).get('emails', [])
+            with conn:
+                self._upsert(conn, emails)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', ?)", (str(json_path),))
+
+    @staticmethod
+    def _to_row(email: Dict) -> tuple:
+        return (
+            email['id'],
+            email.get('thread_id', email['id']),
+            (email.get('sender') or '').translate(_HIGHLIGHT_MARKS),
+            (email.get('subject') or '').translate(_HIGHLIGHT_MARKS),
+            int(email.get('timestamp') or 0),
+            (email.get('body') or '').translate(_HIGHLIGHT_MARKS),
+            (email.get('summary') or '').translate(_HIGHLIGHT_MARKS),
+            1 if email.get('replied') else 0,
+            email.get('draft'),
+        )
+
+    @staticmethod
+    def _to_email(row: sqlite3.Row) -> Dict:
+        email = dict(row)
+        if 'timestamp' in email:
+            email['timestamp'] = str(email['timestamp'])
+        if 'replied' in email:
+            email['replied'] = bool(email['replied'])
+        return email
+
+    def _upsert(self, conn: sqlite3.Connection, emails: Iterable[Dict],
+                keep_generated: bool = False) -> None:
+        sql = f"INSERT OR REPLACE INTO emails ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+        if keep_generated:
+            sql = sql.replace("INSERT OR REPLACE", "INSERT", 1) + KEEP_GENERATED_CONFLICT
+        conn.executemany(sql, (self._to_row(email) for email in emails))
+
+    def upsert_many(self, emails: Iterable[Dict], keep_generated: bool = False) -> None:
+        """Insert or replace emails by id in a single transaction.
+
+        With ``keep_generated`` a stored summary or draft is never replaced by
+        a blank one, and an email already marked replied stays replied, so a
+        failed or stale generation cannot wipe out a good result.
+        """
+        with self._conn() as conn, conn:
+            self._upsert(conn, emails, keep_generated)
+
+    def delete_many(self, email_ids: Iterable[str]) -> None:
+        with self._conn() as conn, conn:
+            conn.executemany("DELETE FROM emails WHERE id = ?", ((i,) for i in email_ids))
+
+    def get(self, email_id: str) -> Optional[Dict]:
+        with self._conn() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM emails WHERE id = ?", (email_id,)).fetchone()
+        return self._to_email(row) if row else None
+
+    def get_many(self, email_ids: Sequence[str]) -> Dict[str, Dict]:
+        """The stored emails among ``email_ids``, by id."""
+        if not email_ids:
+            return {}
+        with self._conn() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM emails WHERE id IN ({', '.join('?' * len(email_ids))})",
+                list(email_ids)).fetchall()
+        return {row['id']: self._to_email(row) for row in rows}
+
+    def ids(self) -> List[str]:
+        with self._conn() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM emails")]
+
+    def count(self) -> int:
+        with self._conn() as conn:
+            return conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def recent(self, limit: Optional[int] = None) -> List[Dict]:
+        """Return emails newest first, optionally only the first ``limit``."""
+        return list(self.iter_emails(limit=limit))
+
+    def iter_emails(self, limit: Optional[int] = None, chunk_size: int = 1000,
+                    replied: Optional[bool] = None, since: Optional[int] = None,
+                    until: Optional[int] = None, sender: Optional[str] = None,
+                    columns: Sequence[str] = COLUMNS) -> Iterator[Dict]:
+        """Yield emails newest first, ``chunk_size`` rows per query.
+
+        Optional filters: ``replied`` status, a ``since``/``until`` range of
+        epoch-millisecond timestamps (inclusive), and a case-insensitive
+        ``sender`` substring. Only ``columns`` are returned. Each chunk is a
+        separate keyset query on (timestamp, id), so no read transaction stays
+        open between chunks and the generator may be resumed from any thread.
+        """
+        where, params = self._filters(replied, since, until, sender)
+        select = ", ".join(dict.fromkeys(["id", "timestamp", *columns]))
+        last_key = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            clauses, args = list(where), list(params)
+            if last_key is not None:
+                clauses.append("(timestamp, id) < (?, ?)")
+                args.extend(last_key)
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            with self._conn() as conn:
+                rows = conn.execute(
+                    f"SELECT {select} FROM emails"
+                    f"{' WHERE ' + ' AND '.join(clauses) if clauses else ''}"
+                    " ORDER BY timestamp DESC, id DESC LIMIT ?", (*args, size)).fetchall()
+            for row in rows:
+                email = self._to_email(row)
+                yield {column: email[column] for column in columns}
+            if len(rows) < size:
+                break
+            last_key = (rows[-1]["timestamp"], rows[-1]["id"])
+            if remaining is not None:
+                remaining -= len(rows)
+
+    @staticmethod
+    def _filters(replied: Optional[bool], since: Optional[int], until: Optional[int],
+                 sender: Optional[str], table: str = '') -> Tuple[List[str], List]:
+        """WHERE clauses and parameters for the filters shared by listing and search."""
+        prefix = f"{table}." if table else ""
+        where, params = [], []
+        if replied is not None:
+            where.append(f"{prefix}replied = ?")
+            params.append(1 if replied else 0)
+        if since is not None:
+            where.append(f"{prefix}timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            where.append(f"{prefix}timestamp <= ?")
+            params.append(until)
+        if sender:
+            where.append(f"instr(lower({prefix}sender), lower(?)) > 0")
+            params.append(sender)
+        return where, params
+
+    def search(self, query: str, limit: int = 20, cursor: Optional[str] = None,
+               replied: Optional[bool] = None, since: Optional[int] = None,
+               until: Optional[int] = None, sort: str = 'rank') -> Dict:
+        """Full-text search over sender, subject, body and summary.
+
+        Every word must match; see fts_query for prefix queries. Results are
+        ranked by bm25 (``sort='rank'``) or newest first (``sort='date'``),
+        each with a ``highlight`` snippet, matches between HIGHLIGHT_START
+        and HIGHLIGHT_END. Pages are keyset-paginated:
+        pass the returned ``next_cursor`` to get the next page.
+        """
+        match = fts_query(query)
+        if not match:
+            return {"emails": [], "next_cursor": None}
+        where, params = self._filters(replied, since, until, None, table='e')
+        # Only filters and date order need the emails table; ranking alone runs on the index
+        join = " JOIN emails e ON e.rowid = f.rowid" if where or sort != 'rank' else ""
+        if sort == 'rank':
+            key, order, after = "f.score", "f.score, f.rowid", ">"
+        else:
+            key, order, after = "e.timestamp", "e.timestamp DESC, f.rowid DESC", "<"
+        if cursor:
+            where.append(f"({key}, f.rowid) {after} (?, ?)")
+            params.extend(_decode_cursor(cursor))
+        weights = ", ".join(str(weight) for weight in SEARCH_WEIGHTS)
+        with self._conn() as conn:
+            # Sort only the keys, then load the full rows of the page
+            keys = conn.execute(
+                f"SELECT {key}, f.rowid FROM (SELECT rowid, bm25(emails_fts, {weights}) AS score"
+                f" FROM emails_fts WHERE emails_fts MATCH ?) f{join}"
+                f"{' WHERE ' + ' AND '.join(where) if where else ''} "
+                f"ORDER BY {order} LIMIT ?", (match, *params, limit + 1)).fetchall()
+            page = keys[:limit]
+            placeholders = ', '.join('?' * len(page))
+            rows, highlights = {}, {}
+            if page:
+                rowids = [rowid for _, rowid in page]
+                rows = {row['rowid']: row for row in conn.execute(
+                    f"SELECT rowid, {', '.join(COLUMNS)} FROM emails WHERE rowid IN ({placeholders})",
+                    rowids)}
+                highlights = dict(conn.execute(
+                    f"SELECT rowid, snippet(emails_fts, -1, ?, ?, '...', 12) FROM emails_fts "
+                    f"WHERE emails_fts MATCH ? AND rowid IN ({placeholders})",
+                    (HIGHLIGHT_START, HIGHLIGHT_END, match, *rowids)))
+        emails = []
+        for _, rowid in page:
+            email = self._to_email(rows[rowid])
+            email.pop('rowid')
+            email['highlight'] = highlights.get(rowid, '')
+            emails.append(email)
+        next_cursor = None
+        if len(keys) > limit:
+            next_cursor = _encode_cursor(tuple(page[-1]))
+        return {"emails": emails, "next_cursor": next_cursor}
+
+    def unreplied(self, limit: int) -> List[Dict]:
+        """Return the ``limit`` newest emails not yet replied to."""
+        return list(self.iter_emails(limit=limit, replied=False))
+
+    def needs_generation(self, limit: int) -> List[Dict]:
+        """The ``limit`` newest emails missing a summary, or a draft while unreplied."""
+        with self._conn() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM emails"
+                " WHERE summary = '' OR (replied = 0 AND COALESCE(draft, '') = '')"
+                " ORDER BY timestamp DESC, id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._to_email(row) for row in rows]
+
+    def set_replied(self, email_id: str, replied: bool = True) -> bool:
+        """Flip one email's replied flag; returns False when the id is unknown."""
+        with self._conn() as conn, conn:
+            cursor = conn.execute(
+                "UPDATE emails SET replied = ? WHERE id = ?", (1 if replied else 0, email_id))
+        return cursor.rowcount > 0
+
+    def set_body(self, email_id: str, body: str) -> None:
+        with self._conn() as conn, conn:
+            conn.execute("UPDATE emails SET body = ? WHERE id = ?", (body, email_id))
+
+    def set_draft(self, email_id: str, draft: Optional[str]) -> None:
+        with self._conn() as conn, conn:
+            conn.execute("UPDATE emails SET draft = ? WHERE id = ?", (draft, email_id))
+
+    def mark_threads_replied(self, thread_ids: Iterable[str]) -> None:
+        """Mark every unreplied email in the given threads as replied and drop its draft."""
+        with self._conn() as conn, conn:
+            conn.executemany(
+                "UPDATE emails SET replied = 1, draft = NULL WHERE thread_id = ? AND replied = 0",
+                ((thread_id,) for thread_id in thread_ids))
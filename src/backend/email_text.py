@@ -0,0 +1,139 @@
+import re
+from urllib.parse import urlsplit
+
+from html_text import html_to_text
+
+# Estimated prompt tokens of an email body sent to the model; 0 for no limit
+DEFAULT_BODY_TOKEN_BUDGET = 1500
+TRUNCATED = '[...]'
+
+_HTML = re.compile(r'<(html|body|div|p|br|table|span|td)\b[^>]*>', re.I)
+_INVISIBLE = re.compile('[\u200b\u200c\u200d\u2060\ufeff\u034f\u00ad]')
+# Where the quoted history of a reply starts: the client's attribution line,
+# or an Outlook header block, with or without its separator
+_QUOTE_STARTS = [
+    re.compile(r'^>?\s*(On|Le|Am|El|Il|Op|Em)\s[^\n]{0,250}(\n[^\n]{0,120})?'
+               r'\s(wrote|a écrit|schrieb|escribió|ha scritto|schreef|escreveu)\s?:\s*$', re.M),
+    re.compile(r'^>?\s*Am\s[^\n]{0,120}\sschrieb\s[^\n]{0,250}:\s*$', re.M),
+    re.compile(r'^-{2,}\s*Original Message\s*-{2,}\s*$', re.M | re.I),
+    re.compile(r'^_{10,}\s*\n+\s*From:', re.M),
+    re.compile(r'^\*?From:\*?\s.+\n\*?(Sent|Date):\*?\s.+\n\*?(To|Subject):\*?\s', re.M),
+]
+_FORWARDED = re.compile(r'(-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)\s*$', re.I)
+_QUOTED_LINE = re.compile(r'^\s*>.*$\n?', re.M)
+_SIGNATURE = re.compile(r'^-- ?$', re.M)
+_DEVICE_LINE = re.compile(r'^\s*(Sent from my \w[\w ]{0,30}|Get Outlook for \w+|Sent from Mail for Windows'
+                          r'|Sent from Yahoo Mail[\w ]*)\s*$\n?', re.M | re.I)
+_DISCLAIMER = re.compile(r'^\W*(CONFIDENTIALITY NOTICE|DISCLAIMER|IMPORTANT NOTICE|'
+                         r'This (e-?mail|message|communication)\b[^\n]{0,80}\b(confidential|intended solely|'
+                         r'intended only|privileged))', re.M | re.I)
+_FOOTER_LINE = re.compile(r'^.*\b(unsubscribe|manage (your )?(email )?preferences|view (it |this email )?'
+                          r'(in|on) (your|a|the) (web )?browser|update your preferences|'
+                          r'you (are receiving|received) this (e-?mail|message|newsletter))\b.*$\n?', re.M | re.I)
+_CLOSING = re.compile(r'^(best|best regards|kind regards|warm regards|regards|many thanks|thanks|thank you|'
+                      r'cheers|sincerely|all the best|br)[,.!]?$', re.I)
+# A line of a signature block after the name: a link, address, phone number,
+# or a short title or postal line that does not read as a sentence
+_CONTACT_LINE = re.compile(r'https?://|www\.|@|\+?\d[\d ().-]{6,}\d|\b(tel|phone|mobile|cell|fax)\b', re.I)
+_SIGNATURE_DETAIL = re.compile(r'^[^?!]{1,60}(?<![.?!:])$')
+_NAME_LINE = re.compile(r'^[^\d?!:;@]{1,40}(?<![.,])$')
+_URL = re.compile(r'<?(https?://[^\s<>()"\']+)>?')
+# Lines after the closing that still look like a signature block, not more message
+SIGNATURE_LINES = 12
+URL_PATH_CHARS = 40
+
+
+def looks_like_html(text: str) -> bool:
+    return len(_HTML.findall(text[:5000])) >= 2
+
+
+def strip_quoted(text: str) -> str:
+    """The reply without the earlier messages it quotes; forwarded messages are kept."""
+    cut = len(text)
+    for pattern in _QUOTE_STARTS:
+        for match in pattern.finditer(text):
+            before = text[:match.start()].rstrip()
+            if _FORWARDED.search(before[-80:]):
+                continue
+            if before.strip():
+                cut = min(cut, match.start())
+            break
+    text = text[:cut]
+    without = _QUOTED_LINE.sub('', text)
+    return without if without.strip() else text
+
+
+def strip_signature(text: str) -> str:
+    """The message without its signature block, device tagline, legal footer or unsubscribe lines."""
+    match = _SIGNATURE.search(text)
+    if match and text[:match.start()].strip():
+        text = text[:match.start()]
+    match = _DISCLAIMER.search(text)
+    if match and match.start() > len(text) // 3:
+        text = text[:match.start()]
+    text = _DEVICE_LINE.sub('', text)
+    text = _FOOTER_LINE.sub('', text)
+    lines = text.rstrip().split('\n')
+    # Keep "Best,\nAnna" but drop the title, phone numbers and address after it
+    for i in range(len(lines) - 1, max(-1, len(lines) - SIGNATURE_LINES - 3), -1):
+        if _CLOSING.match(lines[i].strip()):
+            rest = [j for j in range(i + 1, len(lines)) if lines[j].strip()]
+            if rest and len(rest) <= SIGNATURE_LINES + 1 and _is_signature([lines[j] for j in rest]):
+                lines = lines[:rest[0] + 1]
+            break
+    return '\n'.join(lines)
+
+
+def _is_signature(lines: list) -> bool:
+    """Whether the lines after a closing are a name, then only title, phone,
+    address or link lines; "Thanks!" can also open a message's requests."""
+    name, *details = [line.strip() for line in lines]
+    if not _NAME_LINE.match(name) or len(name.split()) > 4:
+        return False
+    return all(_CONTACT_LINE.search(line) or _SIGNATURE_DETAIL.match(line) for line in details)
+
+
+def _short_url(match: re.Match) -> str:
+    parts = urlsplit(match.group(1))
+    path = parts.path.rstrip('/')
+    if len(path) > URL_PATH_CHARS:
+        path = path[:URL_PATH_CHARS] + '...'
+    return f"{parts.scheme}://{parts.netloc}{path}"
+
+
+def normalize_whitespace(text: str) -> str:
+    text = _INVISIBLE.sub('', text.replace('\r\n', '\n').replace('\r', '\n'))
+    lines = (re.sub(r'[ \t\f\v\xa0]+', ' ', line).strip() for line in text.split('\n'))
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def truncate(text: str, token_budget: int) -> str:
+    """The start of ``text``, where a reply's new content is, cut at a paragraph,
+    line or word boundary to fit ``token_budget`` estimated tokens."""
+    limit = token_budget * 4 - len(TRUNCATED) - 2
+    if not token_budget or len(text) // 4 + 1 <= token_budget:
+        return text
+    head = text[:limit]
+    for boundary in ('\n\n', '\n', '. ', ' '):
+        at = head.rfind(boundary)
+        if at > limit * 0.8:
+            head = head[:at + (1 if boundary == '. ' else 0)]
+            break
+    return f"{head.rstrip()}\n{TRUNCATED}"
+
+
+def prepare_body(text: str, token_budget: int = DEFAULT_BODY_TOKEN_BUDGET) -> str:
+    """An email body as the model should see it: HTML as text, without quoted
+    history, signature, footers, tracking query strings or extra whitespace,
+    and at most ``token_budget`` estimated tokens, keeping the newest content."""
+    if not text:
+        return text
+    if looks_like_html(text):
+        text = html_to_text(text)
+    text = normalize_whitespace(text)
+    text = strip_quoted(text)
+    text = strip_signature(text)
+    text = _URL.sub(_short_url, text)
+    text = normalize_whitespace(text)
+    return truncate(text, token_budget)
+
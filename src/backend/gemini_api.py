@@ -1,21 +1,29 @@
 
+import itertools
+import json
 import os
-from typing import Dict
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 import google.generativeai as genai
+from email_text import DEFAULT_BODY_TOKEN_BUDGET, prepare_body
+from llm_cache import LLMCache
+from metrics import BODY_TOKENS_SAVED, GEMINI_STREAMS_CANCELLED, GEMINI_TOKENS, PROVIDER_CALL_SECONDS, PROVIDER_ERRORS, RETRIES, timed
+from rate_limit import TokenBucket, backoff_delay, retry_after_seconds
 
-class GeminiAPI:
-    def __init__(self):
-        # Use Gemini API key from environment
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            raise RuntimeError("GEMINI_API_KEY not set in environment")
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel("gemini-2.0-flash")
-        
-    def summarize_email(self, email_content: str) -> Dict:
-        """Generate a simple, clear, bullet-point summary of the email content."""
-        prompt = f"""
+MODEL_NAME = "gemini-2.0-flash"
+# Published gemini-2.0-flash limits for paid tier 1; lower them for the free tier.
+GEMINI_REQUESTS_PER_MINUTE = 2000
+GEMINI_TOKENS_PER_MINUTE = 4000000
+# Quick retries inside one call; longer outages are left to the caller.
+MAX_MODEL_RETRIES = 2
+RETRYABLE_CODES = {429, 500, 503, 504}
+
+# Bump a template's version whenever its wording changes so cached results
+# produced by the old prompt are no longer served.
+SUMMARY_PROMPT_VERSION = "1"
+SUMMARY_PROMPT = """
         Summarize the following email in 3-5 easy-to-understand bullet points.
         Focus on clarity and relevance. Avoid technical jargon or verbosity.
         Highlight main topics, requests, action items, and deadlines (if any).
@@ -24,22 +32,9 @@ class GeminiAPI:
         Email:
         {email_content}
         """
-        try:
-            response = self.model.generate_content(prompt)
-            return {
-                "summary": response.text.strip(),
-                "success": True
-            }
-        except Exception as e:
-            return {
-                "summary": "",
-                "success": False,
-                "error": str(e)
-            }
-    
-    def generate_draft_reply(self, email_content: str) -> Dict:
-        """Generate a smart, human-sounding draft reply for the email."""
-        prompt = f"""
+
+DRAFT_PROMPT_VERSION = "1"
+DRAFT_PROMPT = """
         Write a professional, short, concise, and context-aware reply to the following email.
         The reply should:
         - Sound human and natural, not generic
@@ -50,18 +45,350 @@ class GeminiAPI:
         Email thread:
         {email_content}
         """
+
+BATCH_PROMPT_VERSION = "1"
+BATCH_PROMPT = """
+        You will get several emails as a JSON list of objects with "id", "needs_draft" and "content".
+        For every email:
+        - "summary": summarize it in 3-5 easy-to-understand bullet points. Focus on clarity and
+          relevance, avoid technical jargon, and highlight main topics, requests, action items and
+          deadlines (if any) in plain language suitable for a busy professional.
+        - "draft": only when "needs_draft" is true, write a professional, short, concise and
+          context-aware reply that sounds human and natural, addresses all points and questions,
+          starts with "Hi", and is ready to send as-is without any markdown. Otherwise use null.
+        Respond with one JSON object that maps every email id to {{"summary": ..., "draft": ...}}.
+
+        Emails (JSON):
+        {emails_json}
+        """
+# Rough prompt size limit for one batched request, and how many emails it may
+# hold, so the combined answer stays well inside the model's output limit.
+DEFAULT_BATCH_TOKEN_BUDGET = 8000
+MAX_BATCH_EMAILS = 10
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about four characters per token for English)."""
+    return len(text) // 4 + 1
+
+class GeminiAPI:
+    def __init__(self, cache: Optional[LLMCache] = None,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 body_token_budget: Optional[int] = DEFAULT_BODY_TOKEN_BUDGET):
+        """Model calls are limited to ``requests_per_minute`` and
+        ``tokens_per_minute`` (estimated prompt tokens) when those are set.
+
+        Email bodies are cleaned up by prepare_body and cut to
+        ``body_token_budget`` estimated tokens (0 for no limit) before they
+        reach a prompt; None sends them as they are."""
+        # Use Gemini API key from environment
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise RuntimeError("GEMINI_API_KEY not set in environment")
+        genai.configure(api_key=api_key)
+        self.model_name = MODEL_NAME
+        self.model = genai.GenerativeModel(self.model_name)
+        self.cache = cache
+        self.request_limiter = TokenBucket(requests_per_minute / 60) if requests_per_minute else None
+        self.token_limiter = TokenBucket(tokens_per_minute / 60) if tokens_per_minute else None
+        # Model calls and the tokens they used, for per-account accounting
+        self.body_token_budget = body_token_budget
+        self.usage = {'requests': 0, 'prompt_tokens': 0, 'output_tokens': 0, 'body_tokens_saved': 0}
+        self._usage_lock = threading.Lock()
+
+    def _acquire(self, prompt: str) -> None:
+        if self.request_limiter is not None:
+            self.request_limiter.acquire(1)
+        if self.token_limiter is not None:
+            self.token_limiter.acquire(estimate_tokens(prompt))
+
+    def _should_retry(self, e: Exception, attempt: int) -> bool:
+        """Count a failed attempt, and back off before the next one if it is worth retrying."""
+        code = getattr(e, 'code', None)
+        PROVIDER_ERRORS.inc(provider='gemini', code=code or type(e).__name__)
+        if code not in RETRYABLE_CODES or attempt == MAX_MODEL_RETRIES:
+            return False
+        RETRIES.inc(source='gemini')
+        delay = backoff_delay(attempt, retry_after_seconds(e))
+        if code == 429 and self.request_limiter is not None:
+            # Quota is shared, so every caller waits, not only this one
+            self.request_limiter.pause(delay)
+        else:
+            time.sleep(delay)
+        return True
+
+    def _call_model(self, prompt: str, **kwargs):
+        """generate_content under the rate limits, retrying 429s and 5xx with backoff."""
+        for attempt in range(MAX_MODEL_RETRIES + 1):
+            self._acquire(prompt)
+            try:
+                with timed(PROVIDER_CALL_SECONDS, provider='gemini', method='generate_content'):
+                    response = self.model.generate_content(prompt, **kwargs)
+                self._record_usage(response)
+                return response
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+
+    def _open_stream(self, prompt: str):
+        """A streaming generate_content, its first chunk (None if there is none)
+        and the iterator over the rest.
+
+        Errors usually surface with the first chunk, so it is read here, where
+        they are retried like _call_model's; once text has reached the caller
+        a failure is final.
+        """
+        for attempt in range(MAX_MODEL_RETRIES + 1):
+            self._acquire(prompt)
+            try:
+                with timed(PROVIDER_CALL_SECONDS, provider='gemini', method='generate_content_stream'):
+                    response = self.model.generate_content(prompt, stream=True)
+                    chunks = iter(response)
+                    first = next(chunks, None)
+                return response, first, chunks
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+
+    @staticmethod
+    def _close_stream(chunks) -> None:
+        """Stop reading a streaming response early.
+
+        This alone does not stop the model: the SDK has no public way to cancel
+        a stream, and its gRPC call is only cancelled when the response is
+        garbage collected unfinished. Callers must drop the response right after.
+        """
+        close = getattr(chunks, 'close', None)
+        if callable(close):
+            close()
+
+    def _record_usage(self, response) -> None:
+        """Count the call, and the prompt and output tokens the response reports using."""
+        usage = getattr(response, 'usage_metadata', None)
+        prompt = getattr(usage, 'prompt_token_count', 0) or 0
+        output = getattr(usage, 'candidates_token_count', 0) or 0
+        with self._usage_lock:
+            self.usage['requests'] += 1
+            self.usage['prompt_tokens'] += prompt
+            self.usage['output_tokens'] += output
+        if usage is not None:
+            GEMINI_TOKENS.inc(prompt, kind='prompt')
+            GEMINI_TOKENS.inc(output, kind='output')
+
+    def _prepare(self, email_content: str) -> Tuple[str, int]:
+        """The email body as it goes into a prompt, and the estimated tokens that saved."""
+        if self.body_token_budget is None or not email_content:
+            return email_content, 0
+        prepared = prepare_body(email_content, self.body_token_budget)
+        return prepared, max(0, estimate_tokens(email_content) - estimate_tokens(prepared))
+
+    def _record_saved(self, operation: str, before: int, saved: int) -> None:
+        """Log and count the tokens preprocessing kept out of one email's prompt."""
+        if not saved:
+            return
+        print(f"Preprocessed email for {operation}: ~{before} -> ~{before - saved} tokens ({saved} saved)")
+        with self._usage_lock:
+            self.usage['body_tokens_saved'] += saved
+        BODY_TOKENS_SAVED.inc(saved, operation=operation)
+
+    def _generate(self, operation: str, prompt_version: str, prompt: str,
+                  email_content: str, use_cache: bool, prepared: bool = False) -> Dict:
+        """Run a prompt through the model, consulting the cache first.
+
+        With ``use_cache`` False the cached entry is ignored but the fresh
+        result still replaces it. Failed generations are never cached.
+        ``prepared`` says the body has been preprocessed already.
+        """
+        before = estimate_tokens(email_content)
+        email_content, saved = (email_content, 0) if prepared else self._prepare(email_content)
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(operation, prompt_version, self.model_name, email_content)
+            if use_cache:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+        self._record_saved(operation, before, saved)
         try:
-            response = self.model.generate_content(prompt)
-            return {
-                "reply": response.text.strip(),
+            response = self._call_model(prompt.format(email_content=email_content))
+            result = {
+                operation: response.text.strip(),
                 "success": True
             }
         except Exception as e:
             return {
-                "reply": "",
+                operation: "",
                 "success": False,
                 "error": str(e)
             }
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    def _stream(self, operation: str, prompt_version: str, prompt: str, email_content: str,
+                use_cache: bool, cancelled: Optional[threading.Event]) -> Iterator[str]:
+        """Like _generate, but yields the text as the model writes it.
+
+        A cached result comes as one piece. Errors are raised rather than
+        returned. Once ``cancelled`` is set, or the caller stops iterating,
+        the model's stream is closed and the partial text is not cached.
+        """
+        before = estimate_tokens(email_content)
+        email_content, saved = self._prepare(email_content)
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(operation, prompt_version, self.model_name, email_content)
+            cached = self.cache.get(key) if use_cache else None
+            if cached is not None:
+                yield cached[operation]
+                return
+        self._record_saved(operation, before, saved)
+        response, first, chunks = self._open_stream(prompt.format(email_content=email_content))
+        parts, finished = [], False
+        try:
+            for chunk in itertools.chain([first] if first is not None else [], chunks):
+                if cancelled is not None and cancelled.is_set():
+                    GEMINI_STREAMS_CANCELLED.inc(operation=operation)
+                    return
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # A chunk without text, such as the final one carrying the finish reason
+                    continue
+                if text:
+                    parts.append(text)
+                    yield text
+            finished = True
+        except GeneratorExit:
+            GEMINI_STREAMS_CANCELLED.inc(operation=operation)
+            raise
+        finally:
+            if not finished:
+                self._close_stream(chunks)
+            self._record_usage(response)
+            # The last references to an unfinished call; releasing them cancels it
+            del response, chunks
+        if key is not None:
+            self.cache.put(key, {operation: ''.join(parts).strip(), "success": True})
+
+    def stream_summary(self, email_content: str, use_cache: bool = True,
+                       cancelled: Optional[threading.Event] = None) -> Iterator[str]:
+        """summarize_email, yielding the summary piece by piece as the model writes it."""
+        return self._stream("summary", SUMMARY_PROMPT_VERSION, SUMMARY_PROMPT,
+                            email_content, use_cache, cancelled)
+
+    def stream_draft_reply(self, email_content: str, use_cache: bool = True,
+                           cancelled: Optional[threading.Event] = None) -> Iterator[str]:
+        """generate_draft_reply, yielding the draft piece by piece as the model writes it."""
+        return self._stream("reply", DRAFT_PROMPT_VERSION, DRAFT_PROMPT,
+                            email_content, use_cache, cancelled)
+
+    def summarize_email(self, email_content: str, use_cache: bool = True) -> Dict:
+        """Generate a simple, clear, bullet-point summary of the email content."""
+        return self._generate("summary", SUMMARY_PROMPT_VERSION, SUMMARY_PROMPT,
+                              email_content, use_cache)
+
+    def generate_draft_reply(self, email_content: str, use_cache: bool = True) -> Dict:
+        """Generate a smart, human-sounding draft reply for the email."""
+        return self._generate("reply", DRAFT_PROMPT_VERSION, DRAFT_PROMPT,
+                              email_content, use_cache)
+
+    def split_batches(self, emails: List[Dict],
+                      token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET) -> List[List[Dict]]:
+        """Group emails for summarize_and_draft_many without exceeding ``token_budget``
+        or MAX_BATCH_EMAILS per request. An email over the budget gets a batch of its own."""
+        overhead = estimate_tokens(BATCH_PROMPT)
+        batches, current, used = [], [], overhead
+        for email in emails:
+            cost = estimate_tokens(email['content']) + 20
+            if current and (used + cost > token_budget or len(current) >= MAX_BATCH_EMAILS):
+                batches.append(current)
+                current, used = [], overhead
+            current.append(email)
+            used += cost
+        if current:
+            batches.append(current)
+        return batches
+
+    def _generate_batch(self, emails: List[Dict]) -> Dict[str, Dict]:
+        """Send one batched prompt and return the entries that parsed cleanly."""
+        payload = [{"id": e["id"], "needs_draft": bool(e.get("needs_draft")), "content": e["content"]}
+                   for e in emails]
+        try:
+            response = self._call_model(
+                BATCH_PROMPT.format(emails_json=json.dumps(payload)),
+                generation_config={"response_mime_type": "application/json"})
+            parsed = json.loads(response.text.strip().removeprefix("```json").strip("`\n "))
+        except Exception:
+            return {}
+        if not isinstance(parsed, dict):
+            return {}
+        results = {}
+        for email in emails:
+            entry = parsed.get(email["id"])
+            if not isinstance(entry, dict) or not isinstance(entry.get("summary"), str) \
+                    or not entry["summary"].strip():
+                continue
+            draft = entry.get("draft")
+            if email.get("needs_draft") and (not isinstance(draft, str) or not draft.strip()):
+                continue
+            results[email["id"]] = {
+                "summary": entry["summary"].strip(),
+                "reply": draft.strip() if email.get("needs_draft") else None,
+                "success": True
+            }
+        return results
+
+    def summarize_and_draft_many(self, emails: List[Dict], use_cache: bool = True,
+                                 token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET) -> Dict[str, Dict]:
+        """Summarize several emails, and draft replies where needed, in as few model calls as possible.
+
+        ``emails`` are dicts with ``id``, ``content`` and ``needs_draft``.
+        Returns ``{id: {"summary", "reply", "success"}}`` where ``reply`` is
+        None for emails that need no draft. Emails whose part of the batched
+        answer is missing or malformed are retried one by one like
+        summarize_email and generate_draft_reply, without preprocessing their
+        bodies again.
+        """
+        results = {}
+        pending = []
+        for email in emails:
+            before = estimate_tokens(email["content"])
+            content, saved = self._prepare(email["content"])
+            email = dict(email, content=content)
+            key = None
+            if self.cache is not None:
+                key = self.cache.make_key("batch", BATCH_PROMPT_VERSION, self.model_name,
+                                          json.dumps([email["content"], bool(email.get("needs_draft"))]))
+                cached = self.cache.get(key) if use_cache else None
+                if cached is not None:
+                    results[email["id"]] = cached
+                    continue
+            self._record_saved("batch", before, saved)
+            pending.append((email, key))
+
+        keys = {email["id"]: key for email, key in pending}
+        for batch in self.split_batches([email for email, _ in pending], token_budget):
+            answered = self._generate_batch(batch) if len(batch) > 1 else {}
+            for email in batch:
+                result = answered.get(email["id"])
+                if result is None:
+                    summary = self._generate("summary", SUMMARY_PROMPT_VERSION, SUMMARY_PROMPT,
+                                             email["content"], use_cache, prepared=True)
+                    reply = (self._generate("reply", DRAFT_PROMPT_VERSION, DRAFT_PROMPT,
+                                            email["content"], use_cache, prepared=True)
+                             if email.get("needs_draft") else None)
+                    results[email["id"]] = {
+                        "summary": summary.get("summary", ""),
+                        "reply": reply.get("reply", "") if reply else None,
+                        "success": summary["success"] and (reply is None or reply["success"])
+                    }
+                    continue
+                results[email["id"]] = result
+                if keys[email["id"]] is not None:
+                    self.cache.put(keys[email["id"]], result)
+        return results
 
 
 def main():
@@ -1,21 +1,128 @@
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from datetime import datetime, timedelta
+from email.utils import getaddresses
 from googleapiclient.discovery import build
-from typing import List, Dict
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+from typing import Collection, List, Dict, Optional
+import base64
+import httplib2
 import os
 import pickle
+import re
+import threading
+import time
+
+from html_text import html_to_text
+from metrics import PROVIDER_CALL_SECONDS, PROVIDER_ERRORS, RETRIES, timed
+from rate_limit import TokenBucket, backoff_delay, retry_after_seconds
 
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
           'https://www.googleapis.com/auth/gmail.send',
           'https://www.googleapis.com/auth/gmail.modify']
 
+# Gmail accepts up to 100 calls per batch, but recommends staying at 50 or
+# fewer to avoid rate limiting on the individual sub-requests.
+DEFAULT_BATCH_SIZE = 50
+MAX_BATCH_RETRIES = 3
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Quota units charged per call (https://developers.google.com/gmail/api/reference/quota).
+# Each user may spend 250 units per second, averaged over a minute.
+GMAIL_QUOTA_COSTS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.settings.sendAs.list': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.threads.get': 10,
+    'gmail.users.messages.send': 100,
+    'gmail.users.watch': 100,
+}
+DEFAULT_QUOTA_COST = 5
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+# Headers requested with format='metadata': what the list view shows, and
+# what reply detection reads from each message of a thread.
+METADATA_HEADERS = ['From', 'Subject']
+THREAD_METADATA_HEADERS = ['From']
+# Refresh the access token this long before it expires, so no request is the
+# one that has to pay for the refresh round trip.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# A push notification watch lasts about a week; renew it when this little is left.
+WATCH_RENEW_MARGIN = timedelta(days=1)
+# How long the user's address and sendAs aliases are trusted before refetching.
+IDENTITY_TTL_SECONDS = 3600
+
+def _decode_part(part: Dict) -> str:
+    """Decode a MIME part's inline data using the charset from its Content-Type."""
+    charset = 'utf-8'
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = re.search(r'charset="?([\w.:-]+)', header['value'], re.IGNORECASE)
+            if match:
+                charset = match.group(1)
+    data = base64.urlsafe_b64decode(part['body']['data'])
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def _walk_parts(part: Dict):
+    """Yield the leaf parts of a MIME tree, depth first, in document order."""
+    children = part.get('parts')
+    if children:
+        for child in children:
+            yield from _walk_parts(child)
+    else:
+        yield part
+
+
+def extract_body(payload: Dict) -> str:
+    """The text body of a Gmail message payload.
+
+    Walks nested multipart trees (mixed, related, alternative) and takes the
+    first inline text/plain part, falling back to the first text/html part
+    converted to text. Attachments, including text files, are skipped.
+    """
+    html = None
+    for part in _walk_parts(payload):
+        if part.get('filename') or not part.get('body', {}).get('data'):
+            continue
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/plain':
+            return _decode_part(part)
+        if mime_type == 'text/html' and html is None:
+            html = _decode_part(part)
+    return html_to_text(html) if html is not None else ''
+
+
+# Each worker thread's connections to Gmail, shared by all the mailboxes it serves
+_thread_http = threading.local()
+
+
 class GmailAPI:
-    def __init__(self):
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE,
+                 units_per_second: Optional[float] = None):
+        """``units_per_second`` caps the quota units spent per second; None means no limit."""
         self.creds = None
         self.service = None
-        
+        self.batch_size = batch_size
+        self.token_path = None
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._identity = None
+        self._identity_fetched = 0.0
+        self._identity_lock = threading.Lock()
+        self.identity_ttl = IDENTITY_TTL_SECONDS
+        self.limiter = TokenBucket(units_per_second) if units_per_second else None
+        # Quota units spent by this mailbox, for per-account accounting
+        self.units_used = 0
+        self._usage_lock = threading.Lock()
+        self._watch = None
+
     def authenticate(self, token_path: str = 'token.pickle'):
         """Authenticate with Gmail API using credentials from .env only."""
         creds_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
@@ -36,70 +143,355 @@ class GmailAPI:
             with open(token_path, 'wb') as token:
                 pickle.dump(self.creds, token)
 
+        self.token_path = token_path
         self.service = build('gmail', 'v1', credentials=self.creds)
-        
-    def get_recent_emails(self, max_results: int = 20) -> List[Dict]:
-        """Get recent emails from Gmail, including plain text body."""
-        results = self.service.users().messages().list(
-            userId='me', maxResults=max_results).execute()
-
-        messages = []
-        for msg in results.get('messages', []):
-            email = self.service.users().messages().get(
-                userId='me', id=msg['id'], format='full').execute()
-
-            headers = email['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), '')
-
-            # Try to get the plain text body
-            body = ''
-            payload = email.get('payload', {})
-            if 'parts' in payload:
-                for part in payload['parts']:
-                    if part.get('mimeType') == 'text/plain':
-                        data = part['body'].get('data')
-                        if data:
-                            import base64
-                            body = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                            break
-            elif payload.get('body', {}).get('data'):
-                import base64
-                body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='ignore')
-            if not body:
-                body = email.get('snippet', '')
-
-            messages.append({
-                'id': email['id'],
-                'thread_id': email['threadId'],
-                'subject': subject,
-                'sender': sender,
-                'timestamp': email['internalDate'],
-                'body': body
-            })
-
-        return messages
-    
-    def check_if_replied(self, thread_id: str) -> bool:
-        """Check if user has replied in the thread."""
-        thread = self.service.users().threads().get(
-            userId='me', id=thread_id).execute()
-        
-        user_email = self.service.users().getProfile(userId='me').execute()['emailAddress']
-        
-        for message in thread['messages'][1:]:  # Skip the first message
+
+    def refresh_token_if_needed(self, margin: timedelta = TOKEN_REFRESH_MARGIN) -> None:
+        """Refresh and save the access token if it expires within ``margin``."""
+        creds = self.creds
+        if creds is None or not creds.refresh_token or creds.expiry is None:
+            return
+        # google-auth keeps expiry as a naive UTC datetime
+        if creds.expiry - datetime.utcnow() > margin:
+            return
+        with self._refresh_lock:
+            if creds.expiry - datetime.utcnow() > margin:
+                return
+            creds.refresh(Request())
+            if self.token_path:
+                with open(self.token_path, 'wb') as token:
+                    pickle.dump(creds, token)
+
+    def _http(self):
+        """Return an HTTP transport owned by the calling thread.
+
+        httplib2 connections are not thread-safe, so callers running in worker
+        threads must not share the transport built into the service. The
+        connections themselves belong to the thread and are shared by every
+        mailbox it serves, so many accounts do not mean many open sockets.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = getattr(_thread_http, 'http', None)
+            if http is None:
+                http = _thread_http.http = httplib2.Http()
+            if self.creds is not None:
+                http = AuthorizedHttp(self.creds, http=http)
+            self._local.http = http
+        return http
+
+    @staticmethod
+    def _quota_cost(request) -> int:
+        return GMAIL_QUOTA_COSTS.get(getattr(request, 'methodId', None), DEFAULT_QUOTA_COST)
+
+    def _acquire(self, cost: int) -> None:
+        with self._usage_lock:
+            self.units_used += cost
+        if self.limiter is not None:
+            self.limiter.acquire(cost)
+
+    def _backoff(self, attempt: int, errors: List[Exception]) -> None:
+        """Wait before retrying ``errors``; a 429 pauses every caller, not just this one."""
+        retry_after = max((seconds for seconds in map(retry_after_seconds, errors)
+                           if seconds is not None), default=None)
+        delay = backoff_delay(attempt, retry_after)
+        throttled = any(isinstance(e, HttpError) and e.resp.status == 429 for e in errors)
+        RETRIES.inc(source='gmail')
+        if throttled and self.limiter is not None:
+            self.limiter.pause(delay)
+        else:
+            time.sleep(delay)
+
+    def _execute(self, request, retry_statuses=RETRYABLE_STATUSES) -> Dict:
+        """Execute one request under the quota limiter, retrying ``retry_statuses``."""
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            self._acquire(self._quota_cost(request))
+            try:
+                with timed(PROVIDER_CALL_SECONDS, provider='gmail', method=request.methodId):
+                    return request.execute(http=self._http())
+            except HttpError as e:
+                PROVIDER_ERRORS.inc(provider='gmail', code=e.resp.status)
+                if e.resp.status not in retry_statuses or attempt == MAX_BATCH_RETRIES:
+                    raise
+                self._backoff(attempt, [e])
+
+    def _send_batch(self, requests: List, indices: List[int], callback) -> None:
+        """Send ``requests[indices]`` as one batch call, charged the quota cost of
+        all of them, and send it again when the batch call itself fails with a
+        retryable status."""
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index in indices:
+                batch.add(requests[index], request_id=str(index))
+            self._acquire(sum(self._quota_cost(requests[index]) for index in indices))
+            try:
+                with timed(PROVIDER_CALL_SECONDS, provider='gmail', method='batch'):
+                    batch.execute(http=self._http())
+                return
+            except HttpError as e:
+                PROVIDER_ERRORS.inc(provider='gmail', code=e.resp.status)
+                if e.resp.status not in RETRYABLE_STATUSES or attempt == MAX_BATCH_RETRIES:
+                    raise
+                self._backoff(attempt, [e])
+
+    def _execute_batch(self, requests: List, batch_size: Optional[int] = None) -> List[Dict]:
+        """Execute requests as Gmail batch calls and return responses in request order.
+
+        Each batch is charged the quota cost of all its sub-requests. A batch
+        call that fails as a whole with a retryable status is sent again, and
+        of one that succeeds only the sub-requests that failed with a
+        retryable status are, with jittered exponential backoff between attempts.
+        """
+        batch_size = batch_size or self.batch_size
+        results: List[Optional[Dict]] = [None] * len(requests)
+        pending = list(range(len(requests)))
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            errors = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors[int(request_id)] = exception
+                    PROVIDER_ERRORS.inc(provider='gmail', code=getattr(
+                        getattr(exception, 'resp', None), 'status', type(exception).__name__))
+                else:
+                    results[int(request_id)] = response
+
+            for start in range(0, len(pending), batch_size):
+                self._send_batch(requests, pending[start:start + batch_size], callback)
+
+            if not errors:
+                break
+            for index, error in errors.items():
+                status = error.resp.status if isinstance(error, HttpError) else None
+                if status not in RETRYABLE_STATUSES or attempt == MAX_BATCH_RETRIES:
+                    raise error
+            pending = sorted(errors)
+            self._backoff(attempt, list(errors.values()))
+        return results
+
+    @staticmethod
+    def _parse_metadata(email: Dict) -> Dict:
+        """The list-view fields of a message resource fetched in any format."""
+        headers = email['payload']['headers']
+        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
+        sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+        return {
+            'id': email['id'],
+            'thread_id': email['threadId'],
+            'subject': subject,
+            'sender': sender,
+            'timestamp': email['internalDate'],
+            'snippet': email.get('snippet', ''),
+        }
+
+    def _parse_message(self, email: Dict) -> Dict:
+        """Convert a full Gmail message resource into the email dict used by the app."""
+        parsed = self._parse_metadata(email)
+        parsed['body'] = extract_body(email.get('payload', {})) or parsed['snippet']
+        return parsed
+
+    def list_message_ids(self, max_results: int = 20) -> List[str]:
+        """List the ids of the most recent messages, newest first."""
+        results = self._execute(self.service.users().messages().list(
+            userId='me', maxResults=max_results))
+        return [msg['id'] for msg in results.get('messages', [])]
+
+    def _get_resources(self, resource, ids: List[str], batch_size: Optional[int],
+                       format: str, metadata_headers: List[str],
+                       metadata_only: Collection[str] = ()) -> List[Dict]:
+        """Get messages or threads by id, batched, in the given order; those in
+        ``metadata_only`` with format='metadata' whatever ``format`` is."""
+        batch_size = batch_size or self.batch_size
+
+        def request(resource_id: str):
+            kwargs = {'format': 'metadata' if resource_id in metadata_only else format}
+            if kwargs['format'] == 'metadata':
+                kwargs['metadataHeaders'] = metadata_headers
+            return resource.get(userId='me', id=resource_id, **kwargs)
+
+        requests = [request(resource_id) for resource_id in ids]
+        if batch_size > 1:
+            return self._execute_batch(requests, batch_size)
+        return [self._execute(request) for request in requests]
+
+    def get_messages(self, message_ids: List[str], batch_size: Optional[int] = None,
+                     format: str = 'full', metadata_only: Collection[str] = ()) -> List[Dict]:
+        """Fetch and parse the given messages, in the given order.
+
+        Message gets are grouped into batch calls of ``batch_size``; a batch
+        size of 1 fetches each message with its own request. With
+        ``format='metadata'`` only the headers the list view shows are
+        downloaded and the emails have a ``snippet`` but no ``body``; so are
+        the messages in ``metadata_only``, e.g. those whose body is stored.
+        """
+        messages = self._get_resources(self.service.users().messages(), message_ids,
+                                       batch_size, format, METADATA_HEADERS, metadata_only)
+        return [self._parse_metadata(message) if format == 'metadata' or message['id'] in metadata_only
+                else self._parse_message(message) for message in messages]
+
+    def get_bodies(self, message_ids: List[str], batch_size: Optional[int] = None) -> List[str]:
+        """Fetch just the text bodies of the given messages, in the given order."""
+        return [email['body'] for email in self.get_messages(message_ids, batch_size)]
+
+    def get_recent_emails(self, max_results: int = 20, batch_size: Optional[int] = None,
+                          format: str = 'full') -> List[Dict]:
+        """Get recent emails from Gmail, including the text body unless ``format`` is 'metadata'."""
+        return self.get_messages(self.list_message_ids(max_results), batch_size, format)
+
+    def get_profile(self) -> Dict:
+        """Return the user's Gmail profile (emailAddress, historyId, ...)."""
+        return self._execute(self.service.users().getProfile(userId='me'))
+
+    def _fetch_identity(self) -> Dict:
+        aliases = [self.get_profile()['emailAddress']]
+        try:
+            alias_resp = self._execute(self.service.users().settings().sendAs().list(userId='me'))
+            for alias in alias_resp.get('sendAs', []):
+                if alias['sendAsEmail'] not in aliases:
+                    aliases.append(alias['sendAsEmail'])
+        except Exception:
+            pass
+        return {
+            'email': aliases[0],
+            'aliases': aliases,
+            'addresses': frozenset(alias.strip().lower() for alias in aliases),
+        }
+
+    def get_identity(self) -> Dict:
+        """Return the user's primary ``email``, all sendAs ``aliases`` and the
+        normalized set of ``addresses``, cached for ``identity_ttl`` seconds."""
+        with self._identity_lock:
+            if self._identity is None or time.monotonic() - self._identity_fetched > self.identity_ttl:
+                self._identity = self._fetch_identity()
+                self._identity_fetched = time.monotonic()
+            return self._identity
+
+    def invalidate_identity(self) -> None:
+        """Forget the cached identity, e.g. after the user adds a sendAs alias."""
+        with self._identity_lock:
+            self._identity = None
+
+    def get_send_as_aliases(self) -> List[str]:
+        """Return the addresses the user can send as, primary address first."""
+        return list(self.get_identity()['aliases'])
+
+    def is_own_address(self, header_value: str) -> bool:
+        """Whether any address in a From-style header belongs to the user."""
+        addresses = self.get_identity()['addresses']
+        return any(address.lower() in addresses
+                   for _, address in getaddresses([header_value]) if address)
+
+    def thread_has_reply(self, thread: Dict) -> bool:
+        """Whether the user sent any message after the first one in the thread."""
+        for message in thread.get('messages', [])[1:]:  # Skip the first message
             headers = message['payload']['headers']
-            from_header = next(h['value'] for h in headers if h['name'] == 'From')
-            if user_email in from_header:
+            from_header = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+            if self.is_own_address(from_header):
                 return True
-                
         return False
-    
+
+    def get_history_id(self) -> str:
+        """Return the mailbox's current historyId, the starting point for the next sync."""
+        return self.get_profile()['historyId']
+
+    def watch(self, topic_name: str, renew_margin: timedelta = WATCH_RENEW_MARGIN) -> Dict:
+        """Have Gmail publish inbox changes to the Cloud Pub/Sub topic ``topic_name``.
+
+        Gmail is only called again when the current watch expires within
+        ``renew_margin``, so this is cheap to call on every sync.
+        """
+        if self._watch is not None:
+            expires = datetime.fromtimestamp(int(self._watch['expiration']) / 1000)
+            if expires - datetime.now() > renew_margin:
+                return self._watch
+        self._watch = self._execute(self.service.users().watch(
+            userId='me', body={'topicName': topic_name, 'labelIds': ['INBOX']}))
+        return self._watch
+
+    @staticmethod
+    def read_history_id(history_path: str) -> Optional[str]:
+        """Return the historyId saved by the last sync, if any."""
+        if not os.path.exists(history_path):
+            return None
+        with open(history_path) as f:
+            return f.read().strip() or None
+
+    @staticmethod
+    def write_history_id(history_path: str, history_id: str) -> None:
+        with open(history_path, 'w') as f:
+            f.write(str(history_id))
+
+    def get_changes(self, start_history_id: str) -> Optional[Dict]:
+        """Return what changed in the mailbox since ``start_history_id``.
+
+        The result holds the new ``history_id``, the ids of ``added`` incoming
+        messages, the ``replied_threads`` the user sent a message in, and the
+        ids of messages ``removed`` by deletion or moving to trash/spam.
+        Returns None when Gmail no longer has history that far back, in which
+        case the caller must fall back to a full sync.
+        """
+        added = []
+        replied_threads = set()
+        removed = set()
+        history_id = start_history_id
+        history = self.service.users().history()
+        request = history.list(
+            userId='me', startHistoryId=start_history_id,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded'])
+        while request is not None:
+            try:
+                response = self._execute(request)
+            except HttpError as e:
+                if e.resp.status == 404:
+                    return None
+                raise
+            for record in response.get('history', []):
+                for item in record.get('messagesAdded', []):
+                    message = item['message']
+                    labels = message.get('labelIds', [])
+                    if 'SENT' in labels:
+                        replied_threads.add(message['threadId'])
+                    elif 'DRAFT' not in labels and message['id'] not in added:
+                        added.append(message['id'])
+                for item in record.get('messagesDeleted', []):
+                    removed.add(item['message']['id'])
+                for item in record.get('labelsAdded', []):
+                    if {'TRASH', 'SPAM'} & set(item.get('labelIds', [])):
+                        removed.add(item['message']['id'])
+            history_id = response.get('historyId', history_id)
+            request = history.list_next(request, response)
+
+        return {
+            'history_id': history_id,
+            'added': [message_id for message_id in added if message_id not in removed],
+            'replied_threads': sorted(replied_threads),
+            'removed': sorted(removed),
+        }
+
+    def get_threads(self, thread_ids: List[str], batch_size: Optional[int] = None,
+                    format: str = 'full') -> List[Dict]:
+        """Fetch several threads, batched like get_messages, in the given order.
+
+        ``format='metadata'`` leaves out the message bodies and keeps only the
+        From header, which is all reply detection reads.
+        """
+        return self._get_resources(self.service.users().threads(), thread_ids,
+                                   batch_size, format, THREAD_METADATA_HEADERS)
+
+    def check_if_replied(self, thread_id: str) -> bool:
+        """Check if user has replied in the thread."""
+        return self.check_if_replied_many([thread_id])[0]
+
+    def check_if_replied_many(self, thread_ids: List[str]) -> List[bool]:
+        """Check several threads for a reply from the user with batched thread gets."""
+        return [self.thread_has_reply(thread)
+                for thread in self.get_threads(thread_ids, format='metadata')]
+
     def send_reply(self, thread_id: str, message_text: str) -> bool:
         """Send a reply in the thread."""
         try:
             # Get the thread to reply to
-            thread = self.service.users().threads().get(userId='me', id=thread_id).execute()
+            thread = self._execute(self.service.users().threads().get(userId='me', id=thread_id))
             messages = thread.get('messages', [])
             if not messages:
                 return False
@@ -110,11 +502,9 @@ class GmailAPI:
             msg_id = last_msg['id']
 
             # Compose reply
-            import base64
             from email.mime.text import MIMEText
             from email.utils import formataddr
-            user_profile = self.service.users().getProfile(userId='me').execute()
-            user_email = user_profile['emailAddress']
+            user_email = self.get_identity()['email']
             mime_msg = MIMEText(message_text)
             mime_msg['To'] = to
             mime_msg['From'] = user_email
@@ -130,7 +520,9 @@ class GmailAPI:
                 'raw': raw,
                 'threadId': thread_id
             }
-            self.service.users().messages().send(userId='me', body=message).execute()
+            # Only a 429 is retried: after a 5xx the message may already have been sent
+            self._execute(self.service.users().messages().send(userId='me', body=message),
+                          retry_statuses={429})
             return True
         except Exception as e:
             print(f"Error sending reply: {e}")
@@ -140,6 +532,7 @@ class GmailAPI:
 # write a main function to test the GmailAPI class
 def main():
     import os
+    import sys
     from dotenv import load_dotenv
 
     load_dotenv()  # Load environment variables from .env file
@@ -158,8 +551,8 @@ def main():
         has_replied = gmail_api.check_if_replied(thread_id)
         print(f"Has replied to thread {thread_id}: {has_replied}")
 
-        # Send a reply if not already replied
-        if not has_replied:
+        # Send a reply if not already replied; only on request, as this is a real mailbox
+        if not has_replied and '--send-reply' in sys.argv:
             reply_text = "Thank you for your email! Let's discuss this further."
             success = gmail_api.send_reply(thread_id, reply_text)
             print(f"Reply sent successfully: {success}")
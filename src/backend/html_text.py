@@ -0,0 +1,46 @@
+import re
+from html.parser import HTMLParser
+
+# Tags that start a new line of text
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'table', 'blockquote', 'pre',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'ul', 'ol'}
+# Tags whose content is never shown
+SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.chunks.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """Readable plain text from an HTML email body: tags, scripts and styles
+    dropped, entities decoded, one line per block element."""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    text = ''.join(parser.chunks)
+    lines = (re.sub(r'[ \t\r\f\v\xa0]+', ' ', line).strip() for line in text.split('\n'))
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
@@ -1,18 +1,204 @@
-from fastapi import Request, APIRouter, Body, FastAPI
+from fastapi import Request, APIRouter, Body, Depends, FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
 import os
 from dotenv import load_dotenv
 import csv
 import json
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from io import StringIO
-from gmail_api import GmailAPI
-from gemini_api import GeminiAPI
+from gmail_api import GmailAPI, GMAIL_QUOTA_UNITS_PER_SECOND
+from gemini_api import GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE
+from email_store import EmailStore, COLUMNS
+from email_text import DEFAULT_BODY_TOKEN_BUDGET
+from llm_cache import LLMCache
+from pipeline import DEFAULT_GMAIL_CONCURRENCY, DEFAULT_GEMINI_CONCURRENCY, Emit, EmailPipeline
+from clients import DEFAULT_WORKER_THREADS, ClientRegistry, SharedResources
+from accounts import DEFAULT_ACCOUNT, Account, AccountManager, shard_of
+from metrics import REGISTRY as METRICS, STAGE_SECONDS, MetricsMiddleware, timed
+from sync_worker import DEFAULT_SYNC_CONCURRENCY, SyncWorker
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+import asyncio
+import base64
+import hmac
+import threading
+import zlib
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 
-app = FastAPI()
+DATA_DIR = Path("data")
+DATA_DIR.mkdir(exist_ok=True)
+GMAIL_CLIENT_ID = os.getenv("GMAIL_CLIENT_ID")
+GMAIL_CLIENT_SECRET = os.getenv("GMAIL_CLIENT_SECRET")
+GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+GMAIL_CONCURRENCY = int(os.getenv("GMAIL_CONCURRENCY", DEFAULT_GMAIL_CONCURRENCY))
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", DEFAULT_GEMINI_CONCURRENCY))
+# Pack several emails into each Gemini prompt instead of one prompt per email and task
+GEMINI_BATCH_PROMPTS = os.getenv("GEMINI_BATCH_PROMPTS", "0").lower() in ("1", "true", "yes")
+# Email bodies lose quoted history, signatures and footers and are cut to this
+# many estimated tokens (0 for no limit) before they reach Gemini
+GEMINI_BODY_TOKEN_BUDGET = (int(os.getenv("GEMINI_BODY_TOKEN_BUDGET", DEFAULT_BODY_TOKEN_BUDGET))
+                            if os.getenv("GEMINI_PREPROCESS_BODIES", "1").lower() in ("1", "true", "yes")
+                            else None)
+# Rate limits; 0 turns a limit off. The Gmail quota is per mailbox, the Gemini
+# budgets are shared by every account in the process.
+GMAIL_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", GMAIL_QUOTA_UNITS_PER_SECOND))
+GEMINI_RPM = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", GEMINI_REQUESTS_PER_MINUTE))
+GEMINI_TPM = float(os.getenv("GEMINI_TOKENS_PER_MINUTE", GEMINI_TOKENS_PER_MINUTE))
+# Worker threads for blocking Gmail and Gemini calls, shared by all accounts
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", DEFAULT_WORKER_THREADS))
+# Prometheus metrics at /metrics, and JSON trace spans per request; both can be switched at runtime
+METRICS.configure(enabled=os.getenv("METRICS_ENABLED", "1").lower() in ("1", "true", "yes"),
+                  tracing=os.getenv("TRACE_SPANS", "0").lower() in ("1", "true", "yes"))
+REFRESH_COUNT = 20
+# Sync and pre-compute summaries and drafts in the background every this many
+# seconds, so dashboard requests only read the store; 0 does all work in requests.
+BACKGROUND_SYNC_SECONDS = float(os.getenv("BACKGROUND_SYNC_SECONDS", 0))
+# Stored emails still missing a summary or draft that each background sync queues
+SYNC_BACKFILL_LIMIT = int(os.getenv("SYNC_BACKFILL_LIMIT", 200))
+# Background generation tasks taking turns between accounts, and accounts synced at once
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", max(1, GEMINI_CONCURRENCY // 2)))
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", DEFAULT_SYNC_CONCURRENCY))
+# Split the background sync of the accounts between SYNC_SHARDS processes, one per
+# core; this process syncs the accounts in shard SYNC_SHARD. Route each account's
+# requests to the process syncing it (see /api/accounts).
+SYNC_SHARDS = max(1, int(os.getenv("SYNC_SHARDS", 1)))
+SYNC_SHARD = int(os.getenv("SYNC_SHARD", 0))
+# Cloud Pub/Sub topic for Gmail push notifications to /api/gmail/push, and the
+# token that endpoint expects in its query string
+GMAIL_PUSH_TOPIC = os.getenv("GMAIL_PUSH_TOPIC")
+GMAIL_PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN")
+# Approximate size of each chunk streamed by /api/export
+EXPORT_CHUNK_BYTES = 64 * 1024
+LLM_CACHE = LLMCache(DATA_DIR / "llm_cache.db",
+                     max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000)),
+                     ttl=float(os.getenv("LLM_CACHE_TTL_SECONDS", 0)) or None)
+# Concurrent refresh/detect requests for an account share one run, and its result is reused for a few seconds
+COALESCE_FRESH_SECONDS = float(os.getenv("COALESCE_FRESH_SECONDS", 5))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open accounts as requests name them, with the Gemini budgets and worker
+    threads shared by all, and start the background sync when it is configured."""
+    shared = app.state.shared = SharedResources(gemini_requests_per_minute=GEMINI_RPM or None,
+                                                gemini_tokens_per_minute=GEMINI_TPM or None,
+                                                threads=WORKER_THREADS)
+    accounts = app.state.accounts = AccountManager(DATA_DIR, partial(make_clients, shared),
+                                                   fresh_for=COALESCE_FRESH_SECONDS)
+    app.state.sync = None
+    if BACKGROUND_SYNC_SECONDS:
+        sync = app.state.sync = make_sync_worker(accounts, BACKGROUND_SYNC_SECONDS)
+        for account_id in accounts.ids():
+            # Accounts never authorized would need a user at the browser to sync
+            if owns(account_id) and (account_id == DEFAULT_ACCOUNT or accounts.has_token(account_id)):
+                sync.add_account(account_id)
+        sync.start()
+    yield
+    if app.state.sync is not None:
+        app.state.sync.close()
+    accounts.close()
+    shared.close()
+
+
+def make_clients(shared: SharedResources, account: Account) -> ClientRegistry:
+    """The Gmail/Gemini clients of ``account``, on its own token and Gmail quota."""
+    return ClientRegistry(
+        token_path=account.token_path,
+        llm_cache=LLM_CACHE,
+        gmail_concurrency=GMAIL_CONCURRENCY,
+        gemini_concurrency=GEMINI_CONCURRENCY,
+        batch_prompts=GEMINI_BATCH_PROMPTS,
+        gmail_units_per_second=GMAIL_UNITS_PER_SECOND or None,
+        on_retry_result=partial(save_retried_email, account),
+        shared=shared,
+        account=account.id,
+        body_token_budget=GEMINI_BODY_TOKEN_BUDGET)
+
+
+def make_sync_worker(accounts: AccountManager, interval: float) -> SyncWorker:
+    """A background sync worker that keeps the stores of ``accounts`` synced and generated."""
+    return SyncWorker(sync=partial(_background_sync, accounts),
+                      load_pending=partial(_load_pending, accounts),
+                      generate=partial(_generate_stored, accounts),
+                      interval=interval,
+                      workers=SYNC_WORKERS,
+                      sync_concurrency=SYNC_CONCURRENCY)
+
+
+def owns(account_id: str) -> bool:
+    """Whether this process runs the background sync of ``account_id``."""
+    return shard_of(account_id, SYNC_SHARDS) == SYNC_SHARD
+
+
+def save_retried_email(account: Account, email: Dict) -> None:
+    """Store an email whose summary or draft was regenerated in the background."""
+    account.store.upsert_many([email], keep_generated=True)
+
+
+def collect_metrics():
+    """Gemini cache counters and client stats, read when /metrics is scraped."""
+    cache = LLM_CACHE.stats()
+    samples = [('intellimail_llm_cache_hits_total', 'counter', 'Gemini results served from the cache.',
+                cache['hits']),
+               ('intellimail_llm_cache_misses_total', 'counter', 'Gemini cache lookups that missed.',
+                cache['misses']),
+               ('intellimail_llm_cache_entries', 'gauge', 'Entries in the Gemini result cache.',
+                cache['size'])]
+    sync = getattr(app.state, 'sync', None)
+    if sync is not None:
+        status = sync.status()
+        samples += [('intellimail_sync_accounts', 'gauge', 'Accounts this process syncs in the background.',
+                     status['accounts']),
+                    ('intellimail_sync_queue_depth', 'gauge',
+                     'Emails waiting for background summary and draft generation.', status['queue_depth']),
+                    ('intellimail_sync_generated_total', 'counter',
+                     'Emails whose summary and draft were generated in the background.', status['generated']),
+                    ('intellimail_sync_errors_total', 'counter', 'Background syncs that failed.',
+                     status['sync_errors'])]
+    shared = getattr(app.state, 'shared', None)
+    if shared is not None:
+        for name, limiter in (('gemini_requests', shared.gemini_request_limiter),
+                              ('gemini_tokens', shared.gemini_token_limiter)):
+            if limiter is not None:
+                samples.append((f'intellimail_{name}_limiter_wait_seconds_total', 'counter',
+                                f'Seconds callers waited on the {name.replace("_", " ")} rate limiter.',
+                                limiter.waited))
+    accounts = getattr(app.state, 'accounts', None)
+    per_account = [sample for account in (accounts.opened() if accounts is not None else [])
+                   if account.clients is not None for sample in account.clients.metrics()]
+    # Samples of one metric must be listed together
+    return samples + sorted(per_account, key=lambda sample: sample[0].split('{', 1)[0])
+
+
+def get_account(request: Request,
+                account: Optional[str] = Query(None, description="Account id, instead of the X-Account header"),
+                x_account: Optional[str] = Header(None)) -> Account:
+    """FastAPI dependency returning the account a request is for: the ``account``
+    query parameter, else the X-Account header, else the default account."""
+    account_id = account or x_account or DEFAULT_ACCOUNT
+    try:
+        return request.app.state.accounts.get(account_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown account: {account_id}")
+
+
+def get_clients(account: Account = Depends(get_account)) -> ClientRegistry:
+    """FastAPI dependency returning the account's client registry."""
+    return account.clients
+
+
+def get_sync(request: Request, account: Account = Depends(get_account)) -> Optional[SyncWorker]:
+    """FastAPI dependency returning the background sync worker once it has synced the account, else None."""
+    sync = getattr(request.app.state, "sync", None)
+    return sync if sync is not None and sync.synced(account.id) else None
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -20,26 +206,41 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-DATA_DIR = Path("data")
-DATA_DIR.mkdir(exist_ok=True)
-GMAIL_CLIENT_ID = os.getenv("GMAIL_CLIENT_ID")
-GMAIL_CLIENT_SECRET = os.getenv("GMAIL_CLIENT_SECRET")
-GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+app.add_middleware(MetricsMiddleware)
+METRICS.register_collector(collect_metrics)
 
 @app.get("/")
 def root():
     """Health check endpoint"""
     return {"status": "ok"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus metrics: per-route and per-stage latency, provider calls, errors, retries, cache and tokens"""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/metrics/config")
+def get_metrics_config():
+    """Return whether metrics and trace spans are being recorded"""
+    return METRICS.configure()
+
+@app.post("/api/metrics/config")
+def set_metrics_config(enabled: Optional[bool] = Body(None), tracing: Optional[bool] = Body(None)):
+    """Turn metrics recording and JSON trace span logging on or off without a restart"""
+    return METRICS.configure(enabled=enabled, tracing=tracing)
+
 @app.get("/api/last5")
-def get_last_5_emails():
-    """Return last 5 emails from Gmail API"""
+def get_last_5_emails(include_body: bool = False,
+                      clients: ClientRegistry = Depends(get_clients)):
+    """Return last 5 emails from Gmail API.
+
+    Only headers and the snippet are downloaded unless ``include_body`` is
+    set; fetch a body on demand from /api/emails/{email_id}/body."""
     import traceback
     try:
-        gmail = GmailAPI()
-        user_file = DATA_DIR / "emails.json"
-        gmail.authenticate(token_path=str(user_file.with_suffix('.token')))
-        emails = gmail.get_recent_emails(max_results=5)
+        gmail = clients.gmail()
+        emails = gmail.get_recent_emails(max_results=5,
+                                         format='full' if include_body else 'metadata')
         return {"emails": emails}
     except Exception as e:
         tb = traceback.format_exc()
@@ -47,229 +248,553 @@ def get_last_5_emails():
         return {"emails": [], "error": str(e), "trace": tb}
 
 @app.get("/api/emails")
-def get_emails():
-    """Return all emails from emails.json"""
+def get_emails(account: Account = Depends(get_account)):
+    """Return all stored emails, newest first"""
     try:
-        user_file = DATA_DIR / "emails.json"
-        if not user_file.exists():
-            return {"emails": []}
-        with open(user_file) as f:
-            data = json.load(f)
-        return {"emails": data.get("emails", [])}
+        return {"emails": account.store.recent()}
     except Exception as e:
         return {"emails": [], "error": str(e)}
 
+@app.get("/api/emails/{email_id}/body")
+def get_email_body(email_id: str, account: Account = Depends(get_account)):
+    """Return one email's text body, downloading it from Gmail only if it is not stored yet"""
+    try:
+        email = account.store.get(email_id)
+        if email and email.get("body"):
+            return {"id": email_id, "body": email["body"], "cached": True}
+        body = account.clients.gmail().get_bodies([email_id])[0]
+        if email:
+            account.store.set_body(email_id, body)
+        return {"id": email_id, "body": body, "cached": False}
+    except Exception as e:
+        return {"id": email_id, "body": "", "error": str(e)}
+
+@app.get("/api/search")
+def search_emails(q: str = Query(..., min_length=1),
+                  limit: int = Query(20, ge=1, le=100),
+                  cursor: Optional[str] = None,
+                  replied: Optional[bool] = None,
+                  since: Optional[int] = Query(None, description="Earliest timestamp, epoch ms"),
+                  until: Optional[int] = Query(None, description="Latest timestamp, epoch ms"),
+                  sort: str = Query("rank", pattern="^(rank|date)$"),
+                  account: Account = Depends(get_account)):
+    """Full-text search of stored emails and their summaries.
+
+    Words ending in ``*`` match as prefixes. Pass ``next_cursor`` from a
+    response as ``cursor`` for the next page."""
+    try:
+        return account.store.search(q, limit=limit, cursor=cursor, replied=replied,
+                                    since=since, until=until, sort=sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        return {"emails": [], "next_cursor": None, "error": str(e)}
+
 @app.post("/api/generate-summary")
-async def generate_summary(email_id: str = Body(...), body: str = Body(...)):
+def generate_summary(email_id: str = Body(...), body: str = Body(...),
+                     clients: ClientRegistry = Depends(get_clients)):
     """Generate summary for an email using GeminiAI"""
     try:
-        gemini = GeminiAPI()
+        gemini = clients.gemini()
         summary_result = gemini.summarize_email(email_content=body)
         summary = summary_result.get('summary', '')
         return {"success": True, "summary": summary}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@app.post("/api/generate-summary/stream")
+async def generate_summary_stream(email_id: str = Body(...), body: str = Body(...),
+                                  format: str = Query("ndjson", pattern="^(ndjson|sse)$"),
+                                  clients: ClientRegistry = Depends(get_clients)):
+    """Streaming /api/generate-summary: the summary in "token" events as Gemini writes it,
+    then the whole summary in the done event. Generation stops if the client disconnects."""
+    async def work(emit):
+        def stream(cancelled):
+            return clients.gemini().stream_summary(body, cancelled=cancelled)
+        return {"summary": await _stream_text(stream, emit)}
+    return _event_stream(work, format)
+
+@app.get("/api/cache-stats")
+def cache_stats():
+    """Return hit and miss counters for the Gemini result cache"""
+    return LLM_CACHE.stats()
+
 @app.get("/api/gemini-test")
-def gemini_test():
+def gemini_test(clients: ClientRegistry = Depends(get_clients)):
     """Test Gemini API connectivity"""
     try:
-        gemini = GeminiAPI()
-        result = gemini.summarize_email("This is a test email for Gemini API connectivity. Please summarize it.")
+        gemini = clients.gemini()
+        result = gemini.summarize_email("This is a test email for Gemini API connectivity. Please summarize it.",
+                                        use_cache=False)
         return {"success": True, "result": result}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+async def _refresh(account: Account, emit: Optional[Emit] = None,
+                   generate: bool = True) -> List[Dict]:
+    """Sync the store with Gmail and return the newest stored emails.
+
+    Once a sync has been stored, only changes since its Gmail historyId are
+    fetched; the newest emails are re-listed in full when that history is
+    missing or has expired. With ``generate`` False new emails are stored
+    without a summary or draft, for the background worker to fill in.
+    """
+    store, history_file = account.store, account.history_file
+    gmail = await asyncio.to_thread(account.clients.gmail)
+    pipeline = await asyncio.to_thread(account.clients.pipeline)
+    start_history_id = GmailAPI.read_history_id(history_file)
+    changes = None
+    if start_history_id and store.count():
+        with timed(STAGE_SECONDS, stage='history'):
+            changes = await asyncio.to_thread(gmail.get_changes, start_history_id)
+
+    if changes is None:
+        # Take the historyId first so changes made during the sync are not missed
+        history_id = await asyncio.to_thread(gmail.get_history_id)
+        processed = await pipeline.run(REFRESH_COUNT, emit=emit, generate=generate, stored=store.get_many)
+        with timed(STAGE_SECONDS, stage='store'):
+            await asyncio.to_thread(_store_processed, store, processed)
+    else:
+        known = set(await asyncio.to_thread(store.ids))
+        new_emails = await pipeline.process(
+            [message_id for message_id in changes['added'] if message_id not in known], emit=emit,
+            generate=generate)
+        with timed(STAGE_SECONDS, stage='store'):
+            await asyncio.to_thread(_store_processed, store, new_emails)
+            await asyncio.to_thread(store.delete_many, changes['removed'])
+            await asyncio.to_thread(store.mark_threads_replied, changes['replied_threads'])
+        history_id = changes['history_id']
+
+    GmailAPI.write_history_id(history_file, history_id)
+    return await asyncio.to_thread(store.recent, REFRESH_COUNT)
+
+def _store_processed(store: EmailStore, emails: List[Dict]) -> None:
+    """Store pipeline results. Emails still waiting on a background retry are
+    stored with their failed fields blank, so they survive a restart once the
+    historyId moves past them; the retry fills those fields in later."""
+    store.upsert_many(emails, keep_generated=True)
+
+async def _background_sync(accounts: AccountManager, account_id: str) -> None:
+    """Bring an account's new mail into its store for the sync worker, and keep its push notification watch alive."""
+    account = await asyncio.to_thread(accounts.get, account_id)
+    await _refresh(account, generate=False)
+    if GMAIL_PUSH_TOPIC:
+        gmail = await asyncio.to_thread(account.clients.gmail)
+        await asyncio.to_thread(gmail.watch, GMAIL_PUSH_TOPIC)
+
+def _load_pending(accounts: AccountManager, account_id: str) -> List[Dict]:
+    """An account's stored emails still missing a summary or draft, except those already waiting on a retry."""
+    account = accounts.get(account_id)
+    retries = account.clients.pipeline().retries
+    return [email for email in account.store.needs_generation(SYNC_BACKFILL_LIMIT)
+            if retries is None or email['id'] not in retries]
+
+async def _generate_stored(accounts: AccountManager, account_id: str, email: Dict) -> bool:
+    """Generate and store a stored email's missing summary and draft; False if any failed."""
+    account = await asyncio.to_thread(accounts.get, account_id)
+    pipeline = await asyncio.to_thread(account.clients.pipeline)
+    # It may have changed, or been generated by a request, since it was queued
+    email = await asyncio.to_thread(account.store.get, email['id'])
+    if email is None or not EmailPipeline.missing_fields(email):
+        return True
+    if not email['body']:
+        bodies = await pipeline.gmail_call(pipeline.gmail.get_bodies, [email['id']])
+        email['body'] = bodies[0]
+    email = await pipeline.complete(email)
+    await asyncio.to_thread(_store_processed, account.store, [email])
+    return not email.get('pending')
+
+async def _precomputed(sync: SyncWorker, account: Account, count: int,
+                       replied_draft: Optional[str] = None) -> List[Dict]:
+    """The account's ``count`` newest stored emails, without generating anything.
+
+    Emails still missing a summary or draft are listed under ``pending`` and
+    moved to the front of the background queue. Replied emails get
+    ``replied_draft`` as their draft when it is given.
+    """
+    emails = await asyncio.to_thread(account.store.recent, count)
+    for email in emails:
+        missing = EmailPipeline.missing_fields(email)
+        if missing:
+            email["pending"] = missing
+        if email["replied"] and replied_draft is not None:
+            email["draft"] = replied_draft
+    sync.add(account.id, [email for email in emails if email.get("pending")], urgent=True)
+    return emails
+
+async def _shared_refresh(account: Account, emit: Optional[Emit] = None) -> List[Dict]:
+    """_refresh, joining a refresh of the account already running or just finished instead of starting another."""
+    return await account.flights.run(("refresh",), lambda emit: _refresh(account, emit), emit)
+
 @app.post("/api/refresh")
-async def refresh_emails():
-    """Fetch new emails, summarize, detect replies, and generate drafts"""
+async def refresh_emails(account: Account = Depends(get_account),
+                         sync: Optional[SyncWorker] = Depends(get_sync)):
+    """Fetch new emails, summarize, detect replies, and generate drafts.
+    With the background sync running, new emails are stored right away and
+    their summaries and drafts follow in the background."""
     try:
-        user_file = DATA_DIR / "emails.json"
-        gmail = GmailAPI()
-        gmail.authenticate(token_path=str(user_file.with_suffix('.token')))
-        gemini = GeminiAPI()
-
-        # Fetch recent emails
-        emails = gmail.get_recent_emails(max_results=20)
-        processed = []
-        for email in emails:
-            # Summarize using full body
-            summary_result = gemini.summarize_email(email_content=email.get('body', email.get('subject', '')))
-            summary = summary_result.get('summary', '')
-            # Detect reply
-            replied = gmail.check_if_replied(email['thread_id'])
-            # Generate draft if not replied
-            draft = None
-            if not replied:
-                draft_result = gemini.generate_draft_reply(email_content=email.get('body', email.get('subject', '')))
-                draft = draft_result.get('reply', '')
-            processed.append({
-                **email,
-                'summary': summary,
-                'replied': replied,
-                'draft': draft
-            })
-
-        # Save to user file
-        with open(user_file, 'w') as f:
-            json.dump({'emails': processed}, f)
-
+        if sync is not None:
+            await sync.sync_now(account.id)
+            return {"success": True, "emails": await _precomputed(sync, account, REFRESH_COUNT)}
+        processed = await _shared_refresh(account)
         return {"success": True, "emails": processed}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@app.post("/api/refresh/stream")
+async def refresh_emails_stream(format: str = Query("ndjson", pattern="^(ndjson|sse)$"),
+                                account: Account = Depends(get_account),
+                                sync: Optional[SyncWorker] = Depends(get_sync)):
+    """Streaming /api/refresh: new emails as they are processed, then the stored emails in the final event"""
+    async def work(emit):
+        if sync is not None:
+            await sync.sync_now(account.id)
+            return {"emails": await _precomputed(sync, account, REFRESH_COUNT)}
+        return {"emails": await _shared_refresh(account, emit)}
+    return _event_stream(work, format)
+
+@app.get("/api/sync/status")
+def sync_status(request: Request, account: Account = Depends(get_account)):
+    """The account's background sync state: whether it is syncing or generating, queue depth and counters"""
+    sync = getattr(request.app.state, "sync", None)
+    if sync is None or account.id not in sync:
+        return {"running": False}
+    return sync.status(account.id)
+
+def _push_account(accounts: AccountManager, sync: Optional[SyncWorker], address: Optional[str]) -> str:
+    """The account a push notification for mailbox ``address`` is about: the
+    account with that id, else the synced account whose Gmail address it is,
+    else the default account."""
+    ids = accounts.ids()
+    if not address or address in ids:
+        return address or DEFAULT_ACCOUNT
+    for account_id in ids:
+        if sync is None or account_id not in sync:
+            continue
+        try:
+            gmail = accounts.get(account_id).clients.gmail()
+            if address.strip().lower() in gmail.get_identity()['addresses']:
+                return account_id
+        except Exception as e:
+            print(f"Could not read the Gmail address of account {account_id}: {e}")
+    return DEFAULT_ACCOUNT
+
+def _sync_unavailable(sync: Optional[SyncWorker], account_id: str) -> Optional[Dict]:
+    """The error response when ``account_id`` is not synced in the background by this process, else None."""
+    if sync is None:
+        return {"success": False, "error": "Background sync is off; set BACKGROUND_SYNC_SECONDS"}
+    if account_id not in sync and not owns(account_id):
+        return {"success": False, "error": f"Account {account_id} is synced by shard "
+                                          f"{shard_of(account_id, SYNC_SHARDS)}, not this process"}
+    if account_id not in sync:
+        return {"success": False, "error": f"Account {account_id} is not synced in the background"}
+    return None
+
+@app.post("/api/sync")
+def trigger_sync(request: Request, account: Account = Depends(get_account)):
+    """Start a background sync of the account now instead of at the next interval"""
+    sync = getattr(request.app.state, "sync", None)
+    error = _sync_unavailable(sync, account.id)
+    if error is not None:
+        return error
+    sync.trigger(account.id)
+    return {"success": True}
+
+@app.post("/api/gmail/push")
+async def gmail_push(request: Request, token: Optional[str] = None, account: Optional[str] = None):
+    """Cloud Pub/Sub push endpoint for Gmail notifications: a change in a mailbox triggers its sync.
+
+    The account is the ``account`` query parameter, else the one whose Gmail
+    address is the mailbox in the notification. The notification only says
+    the mailbox changed; the sync fetches what changed from the stored
+    historyId as usual."""
+    if GMAIL_PUSH_TOKEN and not hmac.compare_digest(token or "", GMAIL_PUSH_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid push token")
+    sync = getattr(request.app.state, "sync", None)
+    if account is None:
+        address = None
+        try:
+            message = (await request.json()).get("message", {})
+            address = json.loads(base64.b64decode(message.get("data", ""))).get("emailAddress")
+        except Exception:
+            pass
+        account = await asyncio.to_thread(_push_account, request.app.state.accounts, sync, address)
+    error = _sync_unavailable(sync, account)
+    if error is not None:
+        return error
+    sync.trigger(account)
+    return {"success": True}
+
+@app.get("/api/accounts")
+def list_accounts(request: Request):
+    """Every account, with the shard that syncs it and the quota spent by those open in this process"""
+    accounts: AccountManager = request.app.state.accounts
+    sync = getattr(request.app.state, "sync", None)
+    opened = {account.id: account for account in accounts.opened()}
+    return {"accounts": [{
+        "id": account_id,
+        "shard": shard_of(account_id, SYNC_SHARDS),
+        "synced_here": sync is not None and account_id in sync,
+        "usage": opened[account_id].clients.usage() if account_id in opened else None,
+    } for account_id in accounts.ids()], "shards": SYNC_SHARDS, "shard": SYNC_SHARD}
+
+@app.post("/api/accounts")
+def create_account(request: Request, id: str = Body(..., embed=True)):
+    """Create an account's namespace; its first Gmail request runs the OAuth consent flow"""
+    try:
+        account = request.app.state.accounts.get(id, create=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    sync = getattr(request.app.state, "sync", None)
+    if sync is not None and owns(account.id):
+        sync.add_account(account.id)
+    return {"success": True, "id": account.id}
+
+@app.get("/api/account")
+def get_account_usage(request: Request, account: Account = Depends(get_account)):
+    """The account's quota use since the process started, and its background sync state"""
+    sync = getattr(request.app.state, "sync", None)
+    return {"id": account.id, "usage": account.clients.usage(),
+            "sync": sync.status(account.id) if sync is not None and account.id in sync else None}
+
 @app.get("/api/unreplied-emails")
-async def get_unreplied_emails():
+def get_unreplied_emails(account: Account = Depends(get_account)):
     """Return last 5 unreplied emails with AI-generated drafts"""
     try:
-        user_file = DATA_DIR / "emails.json"
-        if not user_file.exists():
-            return {"emails": []}
-        with open(user_file) as f:
-            data = json.load(f)
-        emails = data.get("emails", [])
-        # Filter unreplied and sort by timestamp descending, then take last 5
-        unreplied = [email for email in emails if not email.get("replied")]
-        unreplied = sorted(unreplied, key=lambda e: int(e.get("timestamp", 0)), reverse=True)[:5]
-        gemini = GeminiAPI()
+        clients = account.clients
+        unreplied = account.store.unreplied(limit=5)
         for email in unreplied:
             # Only generate draft if not present
             if not email.get("draft"):
-                draft_result = gemini.generate_draft_reply(email_content=email.get("body", email.get("subject", "")))
+                draft_result = clients.gemini().generate_draft_reply(email_content=email.get("body") or email.get("subject", ""))
                 email["draft"] = draft_result.get("reply", "")
+                if email["draft"]:
+                    account.store.set_draft(email["id"], email["draft"])
         return {"emails": unreplied}
     except Exception as e:
         return {"emails": [], "error": str(e)}
 
 @app.post("/api/reply")
-async def send_reply(email_id: str = Body(...), reply_text: str = Body(...)):
+def send_reply(email_id: str = Body(...), reply_text: str = Body(...),
+               account: Account = Depends(get_account)):
     """Send a reply and update replied status"""
     try:
-        user_file = DATA_DIR / "emails.json"
-        gmail = GmailAPI()
-        gmail.authenticate(token_path=str(user_file.with_suffix('.token')))
+        gmail = account.clients.gmail()
         # Send reply
         sent = gmail.send_reply(thread_id=email_id, message_text=reply_text)
         if not sent:
             return {"success": False, "error": "Failed to send reply via Gmail API"}
-        # Update JSON
-        if user_file.exists():
-            with open(user_file) as f:
-                data = json.load(f)
-            for email in data.get('emails', []):
-                if email['id'] == email_id:
-                    email['replied'] = True
-            with open(user_file, 'w') as f:
-                json.dump(data, f)
+        account.store.set_replied(email_id)
+        # Results from before the reply would still show the email as unreplied
+        account.flights.forget()
         return {"success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.post("/api/generate-draft")
-async def generate_draft(email_id: str = Body(...), body: str = Body(...)):
-    """Generate a draft reply using GeminiAI"""
+def generate_draft(email_id: str = Body(...), body: str = Body(...), use_cache: bool = Body(False),
+                   clients: ClientRegistry = Depends(get_clients)):
+    """Generate a draft reply using GeminiAI, bypassing the cached draft unless use_cache is set"""
     try:
-        gemini = GeminiAPI()
-        draft_result = gemini.generate_draft_reply(email_content=body)
+        gemini = clients.gemini()
+        draft_result = gemini.generate_draft_reply(email_content=body, use_cache=use_cache)
         draft = draft_result.get('reply', '')
         return {"success": True, "draft": draft}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@app.post("/api/generate-draft/stream")
+async def generate_draft_stream(email_id: str = Body(...), body: str = Body(...), use_cache: bool = Body(False),
+                                format: str = Query("ndjson", pattern="^(ndjson|sse)$"),
+                                clients: ClientRegistry = Depends(get_clients)):
+    """Streaming /api/generate-draft: the draft in "token" events as Gemini writes it, then
+    the whole draft in the done event. Generation stops if the client disconnects."""
+    async def work(emit):
+        def stream(cancelled):
+            return clients.gemini().stream_draft_reply(body, use_cache=use_cache, cancelled=cancelled)
+        return {"draft": await _stream_text(stream, emit)}
+    return _event_stream(work, format)
+
 @app.post("/api/save-emails")
-async def save_emails(request: Request):
-    """Save emails from frontend to emails.json"""
+async def save_emails(request: Request, account: Account = Depends(get_account)):
+    """Save emails from frontend into the store, replacing stored rows with the same id.
+    Blank summaries and drafts never overwrite stored ones."""
     try:
         data = await request.json()
         emails = data.get("emails", [])
-        user_file = DATA_DIR / "emails.json"
-        with open(user_file, "w") as f:
-            json.dump({"emails": emails}, f)
+        await asyncio.to_thread(account.store.upsert_many, emails, keep_generated=True)
         return {"success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 @app.get("/api/export")
-async def export_emails():
-    """Export emails to CSV"""
-    user_file = DATA_DIR / "emails.json"
-    output = StringIO()
-    writer = csv.DictWriter(output, fieldnames=["id", "thread_id", "sender", "subject", "timestamp", "body", "summary", "replied", "draft"])
-    writer.writeheader()
-    emails = []
-    if user_file.exists():
+def export_emails(replied: Optional[bool] = None,
+                  since: Optional[int] = Query(None, description="Earliest timestamp, epoch ms"),
+                  until: Optional[int] = Query(None, description="Latest timestamp, epoch ms"),
+                  sender: Optional[str] = None,
+                  columns: Optional[str] = Query(None, description="Comma-separated column names"),
+                  gzip: bool = False,
+                  account: Account = Depends(get_account)):
+    """Stream emails as CSV, optionally filtered and gzip-compressed.
+
+    Rows are read from the store in chunks and written out as they go, so
+    memory stays flat however many emails are exported.
+    """
+    fields = [c.strip() for c in columns.split(",") if c.strip()] if columns else COLUMNS
+    if not fields:
+        raise HTTPException(status_code=400, detail="No columns given")
+    unknown = [c for c in fields if c not in COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+
+    def rows():
+        output = StringIO()
+        writer = csv.DictWriter(output, fieldnames=fields)
+        writer.writeheader()
+        empty = True
         try:
-            with open(user_file) as f:
-                content = f.read().strip()
-                if content:
-                    data = json.loads(content)
-                    emails = data.get('emails', [])
+            for email in account.store.iter_emails(replied=replied, since=since, until=until,
+                                                   sender=sender, columns=fields):
+                empty = False
+                writer.writerow(email)
+                if output.tell() >= EXPORT_CHUNK_BYTES:
+                    yield output.getvalue()
+                    output.seek(0)
+                    output.truncate()
         except Exception as e:
-            # If file is invalid, just export header with error message row
-            writer.writerow({"id": "", "thread_id": "", "sender": "", "subject": "", "timestamp": "", "body": f"Error: {str(e)}", "summary": "", "replied": "", "draft": ""})
-            output.seek(0)
-            return StreamingResponse(output, media_type="text/csv", headers={"Content-Disposition": "attachment; filename=emails.csv"})
-    if not emails:
-        writer.writerow({"id": "", "thread_id": "", "sender": "", "subject": "", "timestamp": "", "body": "No emails found.", "summary": "", "replied": "", "draft": ""})
-    else:
-        for email in emails:
-            writer.writerow(email)
-    output.seek(0)
-    return StreamingResponse(output, media_type="text/csv", headers={"Content-Disposition": "attachment; filename=emails.csv"})
+            # If the store can't be read, end the export with an error message row
+            writer.writerow(_message_row(fields, f"Error: {str(e)}"))
+        else:
+            if empty:
+                writer.writerow(_message_row(fields, "No emails found."))
+        yield output.getvalue()
+
+    def compressed():
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+        for chunk in rows():
+            data = compressor.compress(chunk.encode("utf-8"))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    if gzip:
+        return StreamingResponse(compressed(), media_type="application/gzip",
+                                 headers={"Content-Disposition": "attachment; filename=emails.csv.gz"})
+    return StreamingResponse(rows(), media_type="text/csv",
+                             headers={"Content-Disposition": "attachment; filename=emails.csv"})
+
+def _message_row(fields: List[str], message: str) -> Dict:
+    """A CSV row carrying only a status message, in the body column when exported."""
+    column = "body" if "body" in fields else fields[0]
+    return {**{field: "" for field in fields}, column: message}
 
-from fastapi import Query
+async def _detect(account: Account, count: int, emit: Optional[Emit] = None) -> List[Dict]:
+    """Run the pipeline over the account's ``count`` newest emails, sharing the run with identical concurrent requests."""
+    async def work(emit):
+        pipeline = await asyncio.to_thread(account.clients.pipeline)
+        return await pipeline.run(count, replied_draft='', emit=emit, stored=account.store.get_many)
+    return await account.flights.run(("detect", count), work, emit)
 
 @app.get("/api/unreplied-detect")
-def get_unreplied_detect(count: int = Query(5, ge=1, le=50)):
-    """Return recent emails (count), each with replied status, AI summary, and AI draft for unreplied."""
+async def get_unreplied_detect(count: int = Query(5, ge=1, le=50),
+                               account: Account = Depends(get_account),
+                               sync: Optional[SyncWorker] = Depends(get_sync)):
+    """Return recent emails (count), each with replied status, AI summary, and AI draft for unreplied.
+    With the background sync running, these come straight from the store."""
     try:
-        gmail = GmailAPI()
-        gemini = GeminiAPI()
-        user_file = DATA_DIR / "emails.json"
-        gmail.authenticate(token_path=str(user_file.with_suffix('.token')))
-        emails = gmail.get_recent_emails(max_results=count)
-        user_profile = gmail.service.users().getProfile(userId='me').execute()
-        user_email = user_profile['emailAddress']
-        aliases = [user_email]
-        try:
-            alias_resp = gmail.service.users().settings().sendAs().list(userId='me').execute()
-            for alias in alias_resp.get('sendAs', []):
-                if alias['sendAsEmail'] not in aliases:
-                    aliases.append(alias['sendAsEmail'])
-        except Exception:
-            pass
-        result = []
-        for email in emails:
-            thread = gmail.service.users().threads().get(userId='me', id=email['thread_id']).execute()
-            replied = False
-            for msg in thread['messages'][1:]:
-                headers = msg['payload']['headers']
-                from_header = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-                if any(alias in from_header for alias in aliases):
-                    replied = True
-                    break
-            email_out = dict(email)
-            email_out['replied'] = replied
-            # Always generate AI summary
-            try:
-                summary_result = gemini.summarize_email(email_content=email.get('body', email.get('subject', '')))
-                email_out['summary'] = summary_result.get('summary', '')
-            except Exception:
-                email_out['summary'] = ''
-            if not replied:
-                # Generate AI draft
-                try:
-                    draft_result = gemini.generate_draft_reply(email_content=email.get('body', email.get('subject', '')))
-                    email_out['draft'] = draft_result.get('reply', '')
-                except Exception:
-                    email_out['draft'] = ''
-            else:
-                email_out['draft'] = ''
-            result.append(email_out)
+        if sync is not None:
+            return {"emails": await _precomputed(sync, account, count, replied_draft='')}
+        result = await _detect(account, count)
         return {"emails": result}
     except Exception as e:
         return {"emails": [], "error": str(e)}
 
+@app.get("/api/unreplied-detect/stream")
+async def get_unreplied_detect_stream(count: int = Query(5, ge=1, le=50),
+                                      format: str = Query("ndjson", pattern="^(ndjson|sse)$"),
+                                      account: Account = Depends(get_account),
+                                      sync: Optional[SyncWorker] = Depends(get_sync)):
+    """Streaming /api/unreplied-detect: each email's metadata as soon as it is fetched,
+    then its summary and draft as updates, then a final done event"""
+    async def work(emit):
+        if sync is not None:
+            emails = await _precomputed(sync, account, count, replied_draft='')
+            for index, email in enumerate(emails):
+                await emit({"type": "email", "index": index, "email": email})
+            return {"count": len(emails)}
+        emails = await _detect(account, count, emit)
+        return {"count": len(emails)}
+    return _event_stream(work, format)
+
+
+async def _stream_text(stream: Callable[[threading.Event], Iterator[str]], emit: Emit) -> str:
+    """Run ``stream`` in a worker thread and emit each piece of text it yields as a "token" event.
+
+    Returns the whole text. When this is cancelled, because the client went
+    away, the event ``stream`` was handed is set so it stops early, and the
+    producer task is cancelled so an error it ends with is never left unretrieved.
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    pieces: asyncio.Queue = asyncio.Queue()
+
+    def put(item: Optional[str]) -> None:
+        try:
+            loop.call_soon_threadsafe(pieces.put_nowait, item)
+        except RuntimeError:
+            pass  # The loop is gone; nobody is listening
+
+    def produce() -> None:
+        try:
+            for text in stream(cancelled):
+                put(text)
+        finally:
+            put(None)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(produce))
+    parts = []
+    try:
+        while (text := await pieces.get()) is not None:
+            parts.append(text)
+            await emit({"type": "token", "text": text})
+        await producer
+    finally:
+        # The thread stops at its next chunk; how it ends is no longer wanted
+        cancelled.set()
+        producer.cancel()
+    return ''.join(parts).strip()
+
+
+def _event_stream(work: Callable[[Emit], Awaitable[Dict]], format: str) -> StreamingResponse:
+    """Stream the events ``work`` emits as NDJSON lines or Server-Sent Events.
+
+    The stream ends with a ``done`` event carrying ``success`` and whatever
+    ``work`` returned (or the error). If the client disconnects, the work is
+    cancelled.
+    """
+    def encode(event: Dict) -> str:
+        if format == "sse":
+            return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        return json.dumps(event) + "\n"
+
+    async def events():
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(work(queue.put))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (event := await queue.get()) is not None:
+                yield encode(event)
+            try:
+                done = {"type": "done", "success": True, **task.result()}
+            except Exception as e:
+                done = {"type": "done", "success": False, "error": str(e)}
+            yield encode(done)
+        finally:
+            task.cancel()
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
 
 # Main entry point to run the FastAPI application
 if __name__ == "__main__":
@@ -0,0 +1,322 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Latency buckets in seconds, from a cache hit up to a slow model call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# (name, type, help, value) samples produced at scrape time, see register_collector;
+# the name may carry labels, see labelled
+Sample = Tuple[str, str, str, float]
+
+
+class MetricsRegistry:
+    """Prometheus-style metrics with a runtime switch.
+
+    ``enabled`` turns recording into counters and histograms on and off;
+    ``tracing`` separately turns per-request trace spans on and off. Both
+    can be changed while the app is running.
+    """
+
+    def __init__(self, enabled: bool = True, tracing: bool = False):
+        self.enabled = enabled
+        self.tracing = tracing
+        self._metrics: List['_Metric'] = []
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def register(self, metric: '_Metric') -> None:
+        self._metrics.append(metric)
+
+    def register_collector(self, collect: Callable[[], Iterable[Sample]]) -> None:
+        """Add a callable that reports values other objects already keep, read at scrape time."""
+        self._collectors.append(collect)
+
+    def configure(self, enabled: Optional[bool] = None, tracing: Optional[bool] = None) -> Dict:
+        if enabled is not None:
+            self.enabled = enabled
+        if tracing is not None:
+            self.tracing = tracing
+        return {"enabled": self.enabled, "tracing": self.tracing}
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        for collect in self._collectors:
+            try:
+                samples = list(collect())
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            for name, kind, help, value in samples:
+                family = name.split('{', 1)[0]
+                if family not in described:
+                    described.add(family)
+                    lines.append(f"# HELP {family} {help}")
+                    lines.append(f"# TYPE {family} {kind}")
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labelled(name: str, **labels) -> str:
+    """``name`` with ``labels`` attached, for collector samples of one metric split by label."""
+    return name + _label_text(tuple(labels), tuple(labels.values()))
+
+
+def _label_text(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 registry: MetricsRegistry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = registry
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple([labels.get(name, '') for name in self.labels])
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A value that only goes up, one per label combination."""
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+        return [f"{self.name}{_label_text(self.labels, key)} {_number(value)}"
+                for key, value in values]
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets, with their sum and count."""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: MetricsRegistry = REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def totals(self, **labels) -> Tuple[float, int]:
+        """(sum, count) of the observations with these labels."""
+        state = self._values.get(self._key(labels))
+        return (state[1], state[2]) if state else (0.0, 0)
+
+    def series(self) -> Dict[Tuple[str, ...], Tuple[float, int]]:
+        """(sum, count) for every label combination observed so far."""
+        with self._lock:
+            return {key: (state[1], state[2]) for key, state in self._values.items()}
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(((key, ([*state[0]], state[1], state[2]))
+                             for key, state in self._values.items()),
+                            key=lambda item: tuple(map(str, item[0])))
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip((*map(_number, self.buckets), '+Inf'), counts):
+                cumulative += bucket_count
+                label = _label_text(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{label} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+class Trace:
+    """Timed spans recorded during one request, logged as a JSON line when it ends."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.spans: List[Dict] = []
+        self.finished = False
+
+    def add_span(self, name: str, labels: Dict, start: float, duration: float,
+                 error: Optional[str]) -> None:
+        # Background work may outlive the request; its spans are not part of this trace
+        if self.finished:
+            return
+        span = {"name": name, **labels,
+                "start_ms": round((start - self._start) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3)}
+        if error:
+            span["error"] = error
+        self.spans.append(span)
+
+    def finish(self, **fields) -> Dict:
+        self.finished = True
+        record = {"trace_id": self.trace_id, "name": self.name, **fields,
+                  "start": self.started,
+                  "duration_ms": round((time.perf_counter() - self._start) * 1000, 3),
+                  "spans": self.spans}
+        print(json.dumps(record), flush=True)
+        return record
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('trace', default=None)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed, **self.labels)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(self.histogram.name, self.labels, self.start, elapsed,
+                           exc_type.__name__ if exc_type else None)
+        return False
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timed(histogram: Histogram, **labels):
+    """Context manager observing the duration of its block in ``histogram``,
+    and adding it as a span to the current trace, if any. Costs next to
+    nothing when metrics and tracing are both off."""
+    if not histogram.registry.enabled and _current_trace.get() is None:
+        return _NO_TIMER
+    return _Timer(histogram, labels)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by route, and tracing it when tracing is on.
+
+    Streaming responses are timed until their last chunk is sent.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry = REGISTRY):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not (self.registry.enabled or self.registry.tracing):
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        trace = Trace(f"{scope['method']} {scope['path']}") if self.registry.tracing else None
+        token = _current_trace.set(trace)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_trace.reset(token)
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            HTTP_REQUEST_SECONDS.observe(elapsed, method=scope['method'], route=route,
+                                         status=str(status))
+            if trace is not None:
+                trace.finish(route=route, status=status)
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'intellimail_http_request_seconds', 'HTTP request latency by route, until the last byte is sent.',
+    ['method', 'route', 'status'])
+STAGE_SECONDS = Histogram(
+    'intellimail_stage_seconds', 'Time spent in each stage of a refresh or detect run, '
+    'including waits for a concurrency slot.', ['stage'])
+PROVIDER_CALL_SECONDS = Histogram(
+    'intellimail_provider_call_seconds', 'Latency of each Gmail and Gemini API attempt.',
+    ['provider', 'method'])
+PROVIDER_ERRORS = Counter(
+    'intellimail_provider_errors_total', 'Failed Gmail and Gemini API attempts by status code.',
+    ['provider', 'code'])
+RETRIES = Counter(
+    'intellimail_retries_total', 'Gmail and Gemini calls retried after a backoff, and background '
+    'retries of failed summaries and drafts.', ['source'])
+COALESCED = Counter(
+    'intellimail_coalesced_total', 'Calls that joined an identical run in flight, or reused '
+    'a result still fresh, instead of doing the work again.', ['work', 'how'])
+GEMINI_TOKENS = Counter(
+    'intellimail_gemini_tokens_total', 'Gemini tokens used, from the response usage metadata.', ['kind'])
+GEMINI_STREAMS_CANCELLED = Counter(
+    'intellimail_gemini_streams_cancelled_total', 'Streaming generations stopped before the end '
+    'because the client went away.', ['operation'])
+BODY_TOKENS_SAVED = Counter(
+    'intellimail_gemini_body_tokens_saved_total', 'Estimated prompt tokens preprocessing removed from '
+    'email bodies: quoted history, signatures, footers and the part over the token budget.', ['operation'])
+
@@ -0,0 +1,303 @@
+import asyncio
+import contextvars
+import math
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Looks up the already stored emails among some message ids, by id
+StoredLookup = Callable[[List[str]], Dict[str, Dict]]
+
+from gmail_api import GmailAPI
+from gemini_api import GeminiAPI
+from metrics import STAGE_SECONDS, timed
+from retry_queue import RetryQueue
+from single_flight import SingleFlight
+
+DEFAULT_GMAIL_CONCURRENCY = 4
+DEFAULT_GEMINI_CONCURRENCY = 8
+
+# Receives progress events from a pipeline run, see EmailPipeline.run
+Emit = Callable[[Dict], Awaitable[None]]
+
+
+class EmailPipeline:
+    """Fetch, summarize and draft replies for recent emails concurrently.
+
+    Gmail and Gemini calls are blocking, so each runs in a worker thread behind
+    its own semaphore. Messages are fetched in chunks so Gemini can start on the
+    first emails while Gmail is still fetching the rest. With ``batch_prompts``
+    each chunk's summaries and drafts are requested in as few multi-email
+    prompts as fit the token budget instead of one prompt per email and task.
+
+    A summary or draft that fails comes back blank, with its field listed
+    under ``pending``. With ``on_retry_result`` set, those fields are also
+    retried in the background and the completed email is passed to it.
+    """
+
+    def __init__(self, gmail: GmailAPI, gemini: GeminiAPI,
+                 gmail_concurrency: int = DEFAULT_GMAIL_CONCURRENCY,
+                 gemini_concurrency: int = DEFAULT_GEMINI_CONCURRENCY,
+                 batch_prompts: bool = False,
+                 on_retry_result: Optional[Callable[[Dict], None]] = None,
+                 executor: Optional[Executor] = None):
+        self.gmail = gmail
+        self.gemini = gemini
+        self.gmail_concurrency = gmail_concurrency
+        self.batch_prompts = batch_prompts
+        self._gmail_sem = asyncio.Semaphore(gmail_concurrency)
+        self._gemini_sem = asyncio.Semaphore(gemini_concurrency)
+        # Pipelines of many accounts can share one executor instead of each owning threads
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=gmail_concurrency + gemini_concurrency)
+        # Identical summaries and drafts requested by overlapping runs share one model call
+        self._generations = SingleFlight()
+        self.retries = (RetryQueue(self._generate_fields, on_retry_result)
+                        if on_retry_result is not None else None)
+
+    async def _run(self, sem: asyncio.Semaphore, func: Callable, *args):
+        async with sem:
+            loop = asyncio.get_running_loop()
+            # Carry the request's trace into the worker thread
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self._executor, partial(context.run, func, *args))
+
+    async def gmail_call(self, func: Callable, *args):
+        """Run a blocking Gmail call under the Gmail concurrency limit."""
+        return await self._run(self._gmail_sem, func, *args)
+
+    async def gemini_call(self, func: Callable, *args):
+        """Run a blocking Gemini call under the Gemini concurrency limit."""
+        return await self._run(self._gemini_sem, func, *args)
+
+    async def _generate(self, operation: str, func: Callable, body: str) -> Dict:
+        """Run a Gemini generation, or join the identical one already running.
+
+        Joining happens before taking a Gemini slot, so a duplicate never
+        queues behind other work only to repeat a call that just finished.
+        """
+        async def work(emit):
+            return await self.gemini_call(func, body)
+        return await self._generations.run((operation, body), work)
+
+    async def _summarize(self, body: str) -> Optional[str]:
+        """The summary, or None if it could not be generated."""
+        try:
+            with timed(STAGE_SECONDS, stage='summary'):
+                result = await self._generate('summary', self.gemini.summarize_email, body)
+        except Exception:
+            return None
+        return result.get('summary', '') if result.get('success') else None
+
+    async def _draft(self, body: str) -> Optional[str]:
+        """The draft reply, or None if it could not be generated."""
+        try:
+            with timed(STAGE_SECONDS, stage='draft'):
+                result = await self._generate('draft', self.gemini.generate_draft_reply, body)
+        except Exception:
+            return None
+        return result.get('reply', '') if result.get('success') else None
+
+    async def _generate_fields(self, email: Dict, fields: List[str]) -> Dict[str, Optional[str]]:
+        """Generate the named fields (``summary``, ``draft``) of one email, for the retry queue."""
+        content = email.get('body', email.get('subject', ''))
+        steps = {'summary': self._summarize, 'draft': self._draft}
+        values = await asyncio.gather(*(steps[field](content) for field in fields))
+        return dict(zip(fields, values))
+
+    @staticmethod
+    def missing_fields(email: Dict) -> List[str]:
+        """The generated fields ``email`` still lacks: its summary, and its draft while unreplied."""
+        return ['summary'] * (not email.get('summary')) + \
+               ['draft'] * (not email.get('replied') and not email.get('draft'))
+
+    async def complete(self, email: Dict) -> Dict:
+        """Generate whichever of the summary and draft ``email`` is missing.
+
+        Fields that fail come back blank and listed under ``pending``, and are
+        retried in the background, as in a run.
+        """
+        fields = self.missing_fields(email)
+        if not fields:
+            return email
+        values = await self._generate_fields(email, fields)
+        email = {**email, **{field: value for field, value in values.items() if value is not None}}
+        return self._finish(email, [field for field, value in values.items() if value is None])
+
+    def _finish(self, email: Dict, failed: List[str]) -> Dict:
+        """Blank out failed fields, mark them pending and queue them for a retry."""
+        for field in failed:
+            email[field] = ''
+        if failed:
+            email['pending'] = failed
+            if self.retries is not None:
+                self.retries.add(email, failed)
+        return email
+
+    async def _process_email(self, index: int, email: Dict, thread: Dict,
+                             replied_draft: Optional[str], emit: Optional[Emit]) -> Dict:
+        replied = self.gmail.thread_has_reply(thread)
+        content = email.get('body', email.get('subject', ''))
+        if emit is not None:
+            await emit({'type': 'email', 'index': index, 'email': {**email, 'replied': replied}})
+
+        async def update(field: str, step: Awaitable[Optional[str]]) -> Optional[str]:
+            value = await step
+            if emit is not None:
+                event = {'type': 'update', 'id': email['id'], field: value or ''}
+                if value is None:
+                    event['pending'] = True
+                await emit(event)
+            return value
+
+        if replied:
+            summary, draft = await update('summary', self._summarize(content)), replied_draft
+        else:
+            summary, draft = await asyncio.gather(update('summary', self._summarize(content)),
+                                                  update('draft', self._draft(content)))
+        failed = ['summary'] * (summary is None) + ['draft'] * (not replied and draft is None)
+        return self._finish({**email, 'summary': summary, 'replied': replied, 'draft': draft}, failed)
+
+    async def _process_stored(self, index: int, email: Dict, thread: Dict, stored: Dict,
+                              replied_draft: Optional[str], emit: Optional[Emit]) -> Dict:
+        """An email already stored with its summary and draft: its body and
+        those are reused, and only its headers and replied status refreshed."""
+        replied = self.gmail.thread_has_reply(thread)
+        result = {**email, 'body': stored['body'], 'summary': stored['summary'], 'replied': replied,
+                  'draft': replied_draft if replied else stored['draft']}
+        if emit is not None:
+            await emit({'type': 'email', 'index': index, 'email': dict(result)})
+        return result
+
+    async def _process_batched(self, indices: List[int], emails: List[Dict], threads: List[Dict],
+                               replied_draft: Optional[str], emit: Optional[Emit]) -> List[Dict]:
+        results = []
+        for index, email, thread in zip(indices, emails, threads):
+            replied = self.gmail.thread_has_reply(thread)
+            results.append({**email, 'replied': replied})
+            if emit is not None:
+                await emit({'type': 'email', 'index': index, 'email': dict(results[-1])})
+
+        async def run_batch(batch: List[Dict]) -> Dict[str, Dict]:
+            try:
+                with timed(STAGE_SECONDS, stage='batch'):
+                    answers = await self.gemini_call(self.gemini.summarize_and_draft_many, batch)
+            except Exception:
+                answers = {}
+            if emit is not None:
+                for item in batch:
+                    answer = answers.get(item['id'], {})
+                    update = {'type': 'update', 'id': item['id'], 'summary': answer.get('summary', '')}
+                    if item['needs_draft']:
+                        update['draft'] = answer.get('reply') or ''
+                    if not answer.get('success'):
+                        update['pending'] = True
+                    await emit(update)
+            return answers
+
+        items = [{'id': email['id'],
+                  'content': email.get('body', email.get('subject', '')),
+                  'needs_draft': not email['replied']} for email in results]
+        answers = {}
+        for batch_answers in await asyncio.gather(*(
+                run_batch(batch) for batch in self.gemini.split_batches(items))):
+            answers.update(batch_answers)
+        for email in results:
+            answer = answers.get(email['id'], {})
+            email['summary'] = answer.get('summary', '')
+            email['draft'] = replied_draft if email['replied'] else (answer.get('reply') or '')
+            failed = []
+            if not answer.get('success'):
+                failed = ['summary'] * (not email['summary']) + \
+                         ['draft'] * (not email['replied'] and not email['draft'])
+            self._finish(email, failed)
+        return results
+
+    async def _process_fetched(self, indices: List[int], emails: List[Dict], threads: List[Dict],
+                               emit: Optional[Emit]) -> List[Dict]:
+        """Fetched emails with their replied status only, leaving the summary and draft blank."""
+        results = []
+        for index, email, thread in zip(indices, emails, threads):
+            results.append({**email, 'replied': self.gmail.thread_has_reply(thread),
+                            'summary': '', 'draft': ''})
+            if emit is not None:
+                await emit({'type': 'email', 'index': index, 'email': dict(results[-1])})
+        return results
+
+    async def _process_chunk(self, start: int, message_ids: List[str],
+                             replied_draft: Optional[str], emit: Optional[Emit],
+                             generate: bool = True, stored: Optional[StoredLookup] = None) -> List[Dict]:
+        done = {}
+        if stored is not None:
+            done = {message_id: email for message_id, email
+                    in (await asyncio.to_thread(stored, message_ids)).items()
+                    if email['body'] and not self.missing_fields(email)}
+        # Emails already stored with their summary and draft need their headers, not their body again
+        with timed(STAGE_SECONDS, stage='messages'):
+            emails = await self.gmail_call(partial(self.gmail.get_messages, metadata_only=done),
+                                           message_ids)
+        # Reply detection only needs each thread's From headers, not the bodies
+        with timed(STAGE_SECONDS, stage='threads'):
+            threads = await self.gmail_call(partial(self.gmail.get_threads, format='metadata'),
+                                            [email['thread_id'] for email in emails])
+        indexed = list(zip(range(start, start + len(emails)), emails, threads))
+        known = [item for item in indexed if item[1]['id'] in done]
+        new = [item for item in indexed if item[1]['id'] not in done]
+        indices, emails, threads = (list(column) for column in zip(*new)) if new else ([], [], [])
+        if not generate:
+            fresh = self._process_fetched(indices, emails, threads, emit)
+        elif self.batch_prompts:
+            fresh = self._process_batched(indices, emails, threads, replied_draft, emit)
+        else:
+            fresh = asyncio.gather(*(
+                self._process_email(index, email, thread, replied_draft, emit)
+                for index, email, thread in zip(indices, emails, threads)))
+        fresh, reused = await asyncio.gather(fresh, asyncio.gather(*(
+            self._process_stored(index, email, thread, done[email['id']], replied_draft, emit)
+            for index, email, thread in known)))
+        results = dict(zip(indices, fresh))
+        results.update(zip([index for index, _, _ in known], reused))
+        return [results[index] for index, _, _ in indexed]
+
+    async def run(self, count: int, replied_draft: Optional[str] = None,
+                  emit: Optional[Emit] = None, generate: bool = True,
+                  stored: Optional[StoredLookup] = None) -> List[Dict]:
+        """Process the ``count`` most recent emails, newest first.
+
+        Emails the user already answered get ``replied_draft`` instead of a
+        generated draft. If ``emit`` is given it is awaited with progress
+        events as work completes: an ``email`` event with the message metadata
+        and its ``index`` in the result, then one ``update`` event each for
+        the summary and the draft. With ``generate`` False the emails are
+        only fetched and checked for replies, with a blank summary and draft.
+        Emails ``stored`` finds with their body, summary and draft are not
+        downloaded in full or generated again; they come with the stored ones.
+        """
+        with timed(STAGE_SECONDS, stage='list'):
+            message_ids = await self.gmail_call(self.gmail.list_message_ids, count)
+        return await self.process(message_ids, replied_draft, emit, generate, stored)
+
+    async def process(self, message_ids: List[str], replied_draft: Optional[str] = None,
+                      emit: Optional[Emit] = None, generate: bool = True,
+                      stored: Optional[StoredLookup] = None) -> List[Dict]:
+        """Process the given messages like ``run``, keeping their order."""
+        if not message_ids:
+            return []
+        # Load the user's addresses off the event loop; reply detection reads them
+        with timed(STAGE_SECONDS, stage='identity'):
+            await self.gmail_call(self.gmail.get_identity)
+        chunk_size = min(self.gmail.batch_size,
+                         math.ceil(len(message_ids) / self.gmail_concurrency))
+        chunks = await asyncio.gather(*(
+            self._process_chunk(start, message_ids[start:start + chunk_size], replied_draft, emit,
+                                generate, stored)
+            for start in range(0, len(message_ids), chunk_size)
+        ))
+        return [email for chunk in chunks for email in chunk]
+
+    def close(self) -> None:
+        """Stop background retries and release the worker threads without waiting for them."""
+        if self.retries is not None:
+            self.retries.close()
+        if self._owns_executor:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,99 @@
+import random
+import re
+import threading
+import time
+from typing import Optional
+
+# Exponential backoff starts here and never waits longer than the cap.
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 32.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every caller of one provider.
+
+    ``rate`` tokens are added per second up to ``capacity``. A call costing
+    more than the capacity waits for a full bucket and then goes into debt,
+    so later callers wait for it to be paid back. ``pause`` stops everyone
+    after the provider has said it is overloaded, so a 429 makes all callers
+    back off together instead of each retrying on its own.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, cost: float = 1) -> float:
+        """Block until ``cost`` tokens are available and take them; returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                needed = min(cost, self.capacity)
+                if now >= self._paused_until and self._tokens >= needed:
+                    self._tokens -= cost
+                    self.waited += waited
+                    return waited
+                delay = max(self._paused_until - now, (needed - self._tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Hold back every caller for ``seconds`` and drop the accumulated burst."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._refill(now)
+            self._tokens = min(self._tokens, 0)
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None,
+                  base: float = BACKOFF_BASE_SECONDS, cap: float = BACKOFF_MAX_SECONDS) -> float:
+    """Seconds to wait before retry number ``attempt`` (0-based).
+
+    Exponential backoff with full jitter, so callers that failed together do
+    not retry together. A server-provided ``retry_after`` is a lower bound.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+_RETRY_IN = re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE)
+_RETRY_DELAY = re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)', re.IGNORECASE)
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """The wait a provider asked for in its error, if it gave one.
+
+    Reads a Retry-After header from googleapiclient errors (``resp``) or
+    HTTP responses attached to the error, and falls back to the retry delay
+    Gemini puts in its quota error messages.
+    """
+    for headers in (getattr(error, 'resp', None),
+                    getattr(getattr(error, 'response', None), 'headers', None)):
+        if headers is None:
+            continue
+        try:
+            value = headers.get('retry-after') or headers.get('Retry-After')
+        except AttributeError:
+            continue
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass  # An HTTP date; the jittered backoff will do
+    message = str(error)
+    match = _RETRY_IN.search(message) or _RETRY_DELAY.search(message)
+    return float(match.group(1)) if match else None
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import RETRIES
+from rate_limit import backoff_delay
+
+# Background retries start slower than the in-call ones and give up after this many.
+RETRY_BASE_SECONDS = 15.0
+RETRY_MAX_SECONDS = 600.0
+MAX_RETRY_ATTEMPTS = 6
+
+# Generates the listed fields of an email; a None value means that field failed again
+Work = Callable[[Dict, List[str]], Awaitable[Dict[str, Optional[str]]]]
+
+
+class RetryQueue:
+    """Per-email background retries of summaries and drafts that failed.
+
+    Instead of saving a blank, the pipeline hands the email and its failed
+    fields to ``add``. A single worker task regenerates them, one email at a
+    time so the retries never pile onto a provider that is already throttling,
+    and hands the completed email to ``on_result`` (a blocking call, run in a
+    thread). After ``max_attempts`` the email is handed over with whatever it
+    has, so it is not lost.
+    """
+
+    def __init__(self, work: Work, on_result: Callable[[Dict], None],
+                 max_attempts: int = MAX_RETRY_ATTEMPTS,
+                 base_delay: float = RETRY_BASE_SECONDS, max_delay: float = RETRY_MAX_SECONDS):
+        self.work = work
+        self.on_result = on_result
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._entries: Dict[str, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.recovered = 0
+        self.dropped = 0
+
+    def _delay(self, attempt: int) -> float:
+        return backoff_delay(attempt, base=self.base_delay, cap=self.max_delay)
+
+    def add(self, email: Dict, fields: List[str]) -> None:
+        """Schedule ``fields`` of ``email`` to be generated again. Call from the event loop."""
+        entry = self._entries.get(email['id'])
+        if entry is not None:
+            entry['fields'] = sorted(set(entry['fields']) | set(fields))
+            entry['email'] = {**entry['email'], **email}
+        else:
+            self._entries[email['id']] = {'email': dict(email), 'fields': list(fields),
+                                          'attempt': 0, 'due': time.monotonic() + self._delay(0)}
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._wakeup.set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, email_id: str) -> bool:
+        return email_id in self._entries
+
+    def stats(self) -> Dict:
+        return {"pending": len(self._entries), "recovered": self.recovered, "dropped": self.dropped}
+
+    async def _run(self) -> None:
+        while self._entries:
+            email_id, entry = min(self._entries.items(), key=lambda item: item[1]['due'])
+            wait = entry['due'] - time.monotonic()
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._retry(email_id, entry)
+
+    async def _retry(self, email_id: str, entry: Dict) -> None:
+        RETRIES.inc(source='background')
+        try:
+            values = await self.work(entry['email'], entry['fields'])
+        except Exception:
+            values = {}
+        for field in list(entry['fields']):
+            if values.get(field) is not None:
+                entry['email'][field] = values[field]
+                entry['fields'].remove(field)
+        entry['attempt'] += 1
+        if entry['fields'] and entry['attempt'] < self.max_attempts:
+            entry['due'] = time.monotonic() + self._delay(entry['attempt'])
+            return
+        del self._entries[email_id]
+        if entry['fields']:
+            self.dropped += 1
+            print(f"Giving up on {', '.join(entry['fields'])} for email {email_id} "
+                  f"after {entry['attempt']} retries")
+        else:
+            self.recovered += 1
+        email = {k: v for k, v in entry['email'].items() if k != 'pending'}
+        for field in entry['fields']:
+            email[field] = email.get(field) or ''
+        try:
+            await asyncio.to_thread(self.on_result, email)
+        except Exception as e:
+            print(f"Could not save retried email {email_id}: {e}")
+
+    def close(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
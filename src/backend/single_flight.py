@@ -0,0 +1,87 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from metrics import COALESCED
+
+# Receives the events a run emits
+Emit = Callable[[Dict], Awaitable[None]]
+
+
+class _Flight:
+    """One run of shared work: its task and the events it has emitted so far."""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Future] = None
+        self.events: List[Dict] = []
+        self.listeners: List[Emit] = []
+
+    async def emit(self, event: Dict) -> None:
+        self.events.append(event)
+        for listener in list(self.listeners):
+            try:
+                await listener(event)
+            except Exception as e:
+                # One broken listener must not fail the run for everyone else
+                print(f"Dropping event listener: {e}")
+                self.listeners.remove(listener)
+
+    async def replay(self, emit: Emit) -> None:
+        """Send ``emit`` every event so far, then each new one as it happens."""
+        sent = 0
+        while sent < len(self.events):
+            await emit(self.events[sent])
+            sent += 1
+        # No await between the last check and subscribing, so nothing is missed
+        self.listeners.append(emit)
+
+
+class SingleFlight:
+    """Coalesce concurrent runs of the same async work.
+
+    The first caller for a key starts ``work``; callers arriving while it
+    runs get the same result instead of starting their own, and are sent
+    the events emitted so far before the live ones. A successful result is
+    reused for ``fresh_for`` seconds after the run ends, with its events
+    replayed. The run is shielded, so a caller that goes away does not
+    cancel it for the others.
+    """
+
+    def __init__(self, fresh_for: float = 0.0):
+        self.fresh_for = fresh_for
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._results: Dict[Hashable, Tuple[float, _Flight]] = {}
+
+    async def run(self, key: Tuple, work: Callable[[Emit], Awaitable], emit: Optional[Emit] = None):
+        """Result of ``work(emit)`` for ``key``, shared with concurrent callers of the same key."""
+        fresh = self._results.get(key)
+        if fresh is not None and fresh[0] > time.monotonic():
+            COALESCED.inc(work=key[0], how='fresh')
+            flight = fresh[1]
+        else:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                flight.task = asyncio.ensure_future(self._fly(key, flight, work))
+            else:
+                COALESCED.inc(work=key[0], how='joined')
+        if emit is not None:
+            await flight.replay(emit)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            if emit in flight.listeners:
+                flight.listeners.remove(emit)
+
+    async def _fly(self, key: Tuple, flight: _Flight, work: Callable[[Emit], Awaitable]):
+        try:
+            result = await work(flight.emit)
+        finally:
+            del self._flights[key]
+        if self.fresh_for:
+            self._results[key] = (time.monotonic() + self.fresh_for, flight)
+        return result
+
+    def forget(self) -> None:
+        """Drop the fresh results, after a change that makes them stale; runs in flight carry on."""
+        self._results.clear()
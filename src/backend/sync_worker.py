@@ -0,0 +1,303 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from single_flight import SingleFlight
+
+DEFAULT_SYNC_SECONDS = 300.0
+DEFAULT_GENERATE_WORKERS = 4
+DEFAULT_SYNC_CONCURRENCY = 4
+# Classes of queued emails, served in this order
+URGENT, BACKGROUND = 0, 1
+
+
+class _AccountQueue:
+    """One account's emails waiting for generation, and its sync state and counters."""
+
+    def __init__(self, account_id: str):
+        self.id = account_id
+        # (urgent first, unreplied first, newest first, insertion order, id); stale entries are skipped
+        self.heap: List[Tuple[int, bool, int, int, str]] = []
+        self.queued: Dict[str, Tuple[int, Dict]] = {}
+        self.in_progress: Set[str] = set()
+        self.order = itertools.count()
+        # The line this account is waiting in for a worker, if any
+        self.line: Optional[int] = None
+        self.next_sync: Optional[float] = None
+        self.syncing = False
+        self.resync = False
+        self.syncs = 0
+        self.sync_errors = 0
+        self.triggers = 0
+        self.generated = 0
+        self.failed = 0
+        self.last_sync: Optional[float] = None
+        self.last_sync_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def add(self, email: Dict, urgent: bool) -> None:
+        email_id = email['id']
+        queued = self.queued.get(email_id)
+        if email_id in self.in_progress or (queued is not None and not urgent):
+            return
+        order = next(self.order)
+        self.queued[email_id] = (order, email)
+        heapq.heappush(self.heap, (URGENT if urgent else BACKGROUND, bool(email.get('replied')),
+                                   -int(email.get('timestamp') or 0), order, email_id))
+
+    def peek(self) -> Optional[Tuple]:
+        """The entry to generate next, dropping stale ones; None when nothing is queued."""
+        while self.heap:
+            entry = self.heap[0]
+            queued = self.queued.get(entry[-1])
+            if queued is not None and queued[0] == entry[3]:
+                return entry
+            heapq.heappop(self.heap)
+        return None
+
+    def pop(self) -> Tuple[str, Dict]:
+        email_id = heapq.heappop(self.heap)[-1]
+        self.in_progress.add(email_id)
+        return email_id, self.queued.pop(email_id)[1]
+
+
+class SyncWorker:
+    """Keeps accounts' stores in step with Gmail, with summaries and drafts generated ahead of requests.
+
+    Each account added is synced every ``interval`` seconds, or as soon as
+    ``trigger`` is called for it (by the Gmail push webhook, for instance),
+    with at most ``sync_concurrency`` syncs running at once. ``sync`` brings
+    an account's new mail into its store, and the emails ``load_pending``
+    then reports as missing a summary or draft go into the account's own
+    priority queue, unreplied before replied and newest first.
+
+    ``workers`` tasks drain the queues by awaiting ``generate`` on each
+    email, taking turns between accounts one email at a time, so a mailbox
+    with a huge backlog gets the same share as one with a single new email.
+    Accounts with urgent emails, rows a user is waiting on, take their turns
+    first. ``generate`` returns False when a field could not be generated.
+    """
+
+    def __init__(self, sync: Callable[[str], Awaitable[None]],
+                 load_pending: Callable[[str], List[Dict]],
+                 generate: Callable[[str, Dict], Awaitable[bool]],
+                 interval: float = DEFAULT_SYNC_SECONDS,
+                 workers: int = DEFAULT_GENERATE_WORKERS,
+                 sync_concurrency: int = DEFAULT_SYNC_CONCURRENCY):
+        self.sync = sync
+        self.load_pending = load_pending
+        self.generate = generate
+        self.interval = interval
+        self.workers = workers
+        self.sync_concurrency = sync_concurrency
+        self._accounts: Dict[str, _AccountQueue] = {}
+        # Accounts waiting for a worker, one line per class; stale entries are skipped
+        self._lines: Tuple[Deque[str], Deque[str]] = (deque(), deque())
+        # (due time, account id) of the next syncs; stale entries are skipped
+        self._due: List[Tuple[float, str]] = []
+        self._ready = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._sync_slots = asyncio.Semaphore(sync_concurrency)
+        self._syncs = SingleFlight()
+        self._tasks: List[asyncio.Task] = []
+        self._sync_tasks: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        """Start syncing and generating on the running event loop."""
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._sync_loop())]
+        self._tasks += [loop.create_task(self._generate_loop()) for _ in range(self.workers)]
+
+    def close(self) -> None:
+        for task in self._tasks + list(self._sync_tasks):
+            task.cancel()
+        self._tasks = []
+
+    def add_account(self, account_id: str) -> None:
+        """Start keeping ``account_id`` synced, beginning with a sync as soon as possible."""
+        if account_id not in self._accounts:
+            self._accounts[account_id] = queue = _AccountQueue(account_id)
+            self._plan(queue, 0)
+
+    def __contains__(self, account_id: str) -> bool:
+        return account_id in self._accounts
+
+    def __len__(self) -> int:
+        return sum(len(queue.queued) for queue in self._accounts.values())
+
+    def synced(self, account_id: str) -> bool:
+        """Whether the account has completed a sync, so its store can be served as it is."""
+        queue = self._accounts.get(account_id)
+        return queue is not None and queue.last_sync is not None
+
+    def trigger(self, account_id: str) -> None:
+        """Sync the account as soon as possible instead of waiting for the next interval."""
+        queue = self._accounts[account_id]
+        queue.triggers += 1
+        if queue.syncing:
+            # The running sync may have already read past the change
+            queue.resync = True
+        else:
+            self._plan(queue, 0)
+
+    def add(self, account_id: str, emails: Iterable[Dict], urgent: bool = False) -> None:
+        """Queue an account's emails for generation; ``urgent`` ones, such as rows a user is waiting on, go first."""
+        queue = self._accounts[account_id]
+        for email in emails:
+            queue.add(email, urgent)
+        self._schedule(queue)
+
+    async def sync_now(self, account_id: str) -> None:
+        """Sync the account, or join its sync already running, and queue what is left to generate."""
+        queue = self._accounts[account_id]
+        await self._syncs.run(('sync', account_id), lambda emit: self._sync_once(queue))
+
+    async def _sync_once(self, queue: _AccountQueue) -> None:
+        queue.syncing = True
+        start = time.monotonic()
+        try:
+            await self.sync(queue.id)
+            pending = await asyncio.to_thread(self.load_pending, queue.id)
+        except Exception as e:
+            queue.sync_errors += 1
+            queue.last_error = str(e)
+            print(f"Background sync failed for account {queue.id}: {e}")
+            raise
+        finally:
+            queue.syncing = False
+            if queue.resync:
+                queue.resync = False
+                self._plan(queue, 0)
+        self.add(queue.id, pending)
+        queue.syncs += 1
+        queue.last_sync = time.time()
+        queue.last_sync_seconds = time.monotonic() - start
+        queue.last_error = None
+
+    def _plan(self, queue: _AccountQueue, delay: float) -> None:
+        """Sync the account in ``delay`` seconds, unless a sync is already planned sooner."""
+        due = time.monotonic() + delay
+        if queue.next_sync is not None and queue.next_sync <= due:
+            return
+        queue.next_sync = due
+        heapq.heappush(self._due, (due, queue.id))
+        self._wakeup.set()
+
+    async def _sync_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._due and self._due[0][0] <= now:
+                due, account_id = heapq.heappop(self._due)
+                queue = self._accounts.get(account_id)
+                if queue is None or queue.next_sync != due:
+                    continue
+                queue.next_sync = None
+                task = loop.create_task(self._scheduled_sync(queue))
+                self._sync_tasks.add(task)
+                task.add_done_callback(self._sync_tasks.discard)
+            timeout = self._due[0][0] - now if self._due else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _scheduled_sync(self, queue: _AccountQueue) -> None:
+        try:
+            async with self._sync_slots:
+                await self.sync_now(queue.id)
+        except Exception:
+            pass
+        finally:
+            self._plan(queue, self.interval)
+
+    def _schedule(self, queue: _AccountQueue) -> None:
+        """Put an account with queued emails at the back of the line its most urgent email belongs in."""
+        entry = queue.peek()
+        if entry is None:
+            return
+        line = entry[0]
+        if queue.line is not None and queue.line <= line:
+            return
+        queue.line = line
+        self._lines[line].append(queue.id)
+        self._ready.set()
+
+    def _next(self) -> Optional[_AccountQueue]:
+        """The account whose turn it is, taken out of its line."""
+        for line, waiting in enumerate(self._lines):
+            while waiting:
+                queue = self._accounts.get(waiting.popleft())
+                if queue is None or queue.line != line:
+                    continue
+                queue.line = None
+                if queue.peek() is not None:
+                    return queue
+        return None
+
+    async def _generate_loop(self) -> None:
+        while True:
+            queue = self._next()
+            if queue is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            email_id, email = queue.pop()
+            # Back of the line for its next email, behind every other account waiting
+            self._schedule(queue)
+            try:
+                done = await self.generate(queue.id, email)
+            except Exception as e:
+                print(f"Background generation failed for email {email_id} of account {queue.id}: {e}")
+                done = False
+            finally:
+                queue.in_progress.discard(email_id)
+            if done:
+                queue.generated += 1
+            else:
+                queue.failed += 1
+
+    def status(self, account_id: Optional[str] = None) -> Dict:
+        """Job state and queue depth of one account, or totals over all accounts, for /api/sync/status."""
+        if account_id is None:
+            queues = list(self._accounts.values())
+            return {
+                "running": bool(self._tasks),
+                "interval": self.interval,
+                "accounts": len(queues),
+                "syncing": sum(queue.syncing for queue in queues),
+                "queue_depth": sum(len(queue.queued) for queue in queues),
+                "in_progress": sum(len(queue.in_progress) for queue in queues),
+                "syncs": sum(queue.syncs for queue in queues),
+                "sync_errors": sum(queue.sync_errors for queue in queues),
+                "generated": sum(queue.generated for queue in queues),
+                "failed": sum(queue.failed for queue in queues),
+            }
+        queue = self._accounts[account_id]
+        if queue.syncing:
+            state = 'syncing'
+        elif queue.queued or queue.in_progress:
+            state = 'generating'
+        else:
+            state = 'idle'
+        return {
+            "running": bool(self._tasks),
+            "state": state,
+            "interval": self.interval,
+            "queue_depth": len(queue.queued),
+            "in_progress": len(queue.in_progress),
+            "syncs": queue.syncs,
+            "sync_errors": queue.sync_errors,
+            "triggers": queue.triggers,
+            "generated": queue.generated,
+            "failed": queue.failed,
+            "last_sync_at": queue.last_sync,
+            "last_sync_seconds": queue.last_sync_seconds,
+            "next_sync_in": (max(0.0, queue.next_sync - time.monotonic())
+                             if queue.next_sync is not None and not queue.syncing else None),
+            "last_error": queue.last_error,
+        }
@@ -1,5 +1,5 @@
 
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import axios from 'axios';
 
 type Email = {
@@ -12,6 +12,35 @@ type Email = {
   summary?: string;
   replied?: boolean;
   draft?: string;
+  highlight?: string;
+};
+
+// Search highlights wrap matched words in \x02 ... \x03, which never occur in stored text
+const renderHighlight = (text: string) =>
+  text.split(/\x02([^\x03]*)\x03/).map((part, i) => (i % 2 ? <mark key={i}>{part}</mark> : part));
+
+// The mailbox to show, from ?account= in the page URL; the default account when absent
+const ACCOUNT = new URLSearchParams(window.location.search).get('account') || '';
+const accountHeaders: Record<string, string> = ACCOUNT ? { 'X-Account': ACCOUNT } : {};
+if (ACCOUNT) axios.defaults.headers.common['X-Account'] = ACCOUNT;
+
+// Calls onEvent with every NDJSON event of a streaming response, as it arrives
+const readEvents = async (res: Response, onEvent: (event: any) => void) => {
+  if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop() ?? '';
+    for (const line of lines) {
+      if (line.trim()) onEvent(JSON.parse(line));
+    }
+  }
+  if (buffer.trim()) onEvent(JSON.parse(buffer));
 };
 
 const Dashboard = () => {
@@ -19,17 +48,41 @@ const Dashboard = () => {
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
   const [csvUrl, setCsvUrl] = useState('');
+  const [query, setQuery] = useState('');
+  const [searching, setSearching] = useState(false);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  // Drafts being written, by email id; aborting one stops its generation on the server
+  const [drafting, setDrafting] = useState<Record<string, boolean>>({});
+  const draftRequests = useRef<Record<string, AbortController>>({});
 
 
   const [count, setCount] = useState(5);
+  // Rows stream in from /api/unreplied-detect/stream as NDJSON events:
+  // "email" (metadata + position), "update" (summary or draft), then "done".
   const fetchEmails = async (customCount?: number) => {
     setLoading(true);
     setError('');
+    setSearching(false);
+    setEmails([]);
+    const rows: (Email | undefined)[] = [];
+    const applyEvent = (event: any) => {
+      if (event.type === 'email') {
+        rows[event.index] = { ...rows[event.index], ...event.email };
+      } else if (event.type === 'update') {
+        const index = rows.findIndex(e => e?.id === event.id);
+        if (index >= 0) {
+          const { type, id, ...fields } = event;
+          rows[index] = { ...rows[index]!, ...fields };
+        }
+      } else if (event.type === 'done' && !event.success) {
+        throw new Error(event.error);
+      }
+      setEmails(rows.filter((e): e is Email => !!e));
+    };
     try {
-      const res = await axios.get(`/api/unreplied-detect?count=${customCount ?? count}`);
-      let emails: Email[] = res.data.emails || [];
-      setEmails(emails);
-      await axios.post('/api/save-emails', { emails });
+      const res = await fetch(`/api/unreplied-detect/stream?count=${customCount ?? count}`, { headers: accountHeaders });
+      await readEvents(res, applyEvent);
+      await axios.post('/api/save-emails', { emails: rows.filter((e): e is Email => !!e) });
     } catch (err) {
       setError('Failed to fetch emails.');
     }
@@ -37,24 +90,68 @@ const Dashboard = () => {
   };
 
 
+  const searchEmails = async (cursor?: string) => {
+    if (!query.trim()) return;
+    setLoading(true);
+    setError('');
+    try {
+      const res = await axios.get('/api/search', { params: { q: query, cursor } });
+      if (res.data.error) throw new Error(res.data.error);
+      setEmails(prev => (cursor ? [...prev, ...res.data.emails] : res.data.emails));
+      setNextCursor(res.data.next_cursor);
+      setSearching(true);
+    } catch (err) {
+      setError('Search failed.');
+    }
+    setLoading(false);
+  };
+
+  const clearSearch = () => {
+    setQuery('');
+    setSearching(false);
+    setNextCursor(null);
+    fetchEmails();
+  };
+
   const exportCSV = () => {
-    setCsvUrl('/api/export');
+    setCsvUrl(ACCOUNT ? `/api/export?account=${encodeURIComponent(ACCOUNT)}` : '/api/export');
     setTimeout(() => setCsvUrl(''), 1000);
   };
 
+  // The draft fills in as /api/generate-draft/stream sends "token" events; "done" has the whole draft
   const generateDraft = async (email: Email) => {
-    setLoading(true);
+    const controller = new AbortController();
+    draftRequests.current[email.id] = controller;
+    setDrafting(prev => ({ ...prev, [email.id]: true }));
     setError('');
+    const setDraft = (update: (draft: string) => string) =>
+      setEmails(prev => prev.map(e => e.id === email.id ? { ...e, draft: update(e.draft || '') } : e));
+    setDraft(() => '');
     try {
-      const res = await axios.post('/api/generate-draft', { email_id: email.id, body: email.body || email.subject });
-      const draft = res.data.draft;
-      setEmails(prev => prev.map(e => e.id === email.id ? { ...e, draft } : e));
+      const res = await fetch('/api/generate-draft/stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', ...accountHeaders },
+        body: JSON.stringify({ email_id: email.id, body: email.body || email.subject }),
+        signal: controller.signal,
+      });
+      await readEvents(res, event => {
+        if (event.type === 'token') {
+          setDraft(draft => draft + event.text);
+        } else if (event.type === 'done') {
+          if (!event.success) throw new Error(event.error);
+          setDraft(() => event.draft);
+        }
+      });
     } catch (err) {
-      setError('Failed to generate draft.');
+      if (!controller.signal.aborted) setError('Failed to generate draft.');
     }
-    setLoading(false);
+    delete draftRequests.current[email.id];
+    setDrafting(prev => ({ ...prev, [email.id]: false }));
   };
 
+  // Leaving the page stops the drafts still being written
+  useEffect(() => () => Object.values(draftRequests.current).forEach(c => c.abort()), []);
+
 
   useEffect(() => {
     fetchEmails();
@@ -63,7 +160,7 @@ const Dashboard = () => {
 
   return (
     <div style={{ width: '100vw', minHeight: '100vh', margin: 0, padding: 0, fontFamily: 'Arial, sans-serif', background: '#f8f8f8', display: 'flex', flexDirection: 'column', alignItems: 'center' }}>
-      <h2>Smart Email Assistant Dashboard</h2>
+      <h2>Smart Email Assistant Dashboard{ACCOUNT && ` — ${ACCOUNT}`}</h2>
       <div style={{ display: 'flex', gap: 16, marginBottom: 8, alignItems: 'center' }}>
         <label style={{ fontWeight: 600 }}>
           Number of emails:
@@ -109,6 +206,20 @@ const Dashboard = () => {
         >
           Export CSV
         </button>
+        <form
+          onSubmit={e => { e.preventDefault(); searchEmails(); }}
+          style={{ display: 'flex', gap: 8 }}
+        >
+          <input
+            type="search"
+            placeholder="Search emails (inv* for prefixes)"
+            value={query}
+            onChange={e => setQuery(e.target.value)}
+            style={{ width: 240, padding: 4 }}
+          />
+          <button type="submit" disabled={loading || !query.trim()}>Search</button>
+          {searching && <button type="button" onClick={clearSearch} disabled={loading}>Clear</button>}
+        </form>
       </div>
       {csvUrl && <iframe src={csvUrl} style={{ display: 'none' }} title="csv-export" />}
       <div style={{ marginTop: 30 }}>
@@ -130,15 +241,24 @@ const Dashboard = () => {
               {emails.map(email => (
                 <tr key={email.id}>
                   <td style={{ border: '1px solid #ccc', padding: 8 }}>{email.sender}</td>
-                  <td style={{ border: '1px solid #ccc', padding: 8 }}>{email.subject}</td>
+                  <td style={{ border: '1px solid #ccc', padding: 8 }}>
+                    {email.subject}
+                    {email.highlight && (
+                      <div style={{ color: '#666', fontSize: 12, marginTop: 4 }}>{renderHighlight(email.highlight)}</div>
+                    )}
+                  </td>
                   <td style={{ border: '1px solid #ccc', padding: 8, whiteSpace: 'pre-wrap' }}>{email.summary || <span style={{color:'#aaa'}}>No summary</span>}</td>
                   <td style={{ border: '1px solid #ccc', padding: 8 }}>{email.replied ? 'Yes' : 'No'}</td>
-                  <td style={{ border: '1px solid #ccc', padding: 8, whiteSpace: 'pre-wrap' }}>{email.draft ? email.draft : <span style={{color:'#aaa'}}>No draft</span>}</td>
+                  <td style={{ border: '1px solid #ccc', padding: 8, whiteSpace: 'pre-wrap' }}>{email.draft || drafting[email.id] ? <>{email.draft}{drafting[email.id] && '\u258d'}</> : <span style={{color:'#aaa'}}>No draft</span>}</td>
                   <td style={{ border: '1px solid #ccc', padding: 8 }}>
                     {email.replied ? (
-                      <button onClick={() => generateDraft(email)} disabled={loading || !!email.draft}>
-                        {email.draft ? 'Draft Ready' : 'Generate Draft'}
-                      </button>
+                      drafting[email.id] ? (
+                        <button onClick={() => draftRequests.current[email.id]?.abort()}>Stop</button>
+                      ) : (
+                        <button onClick={() => generateDraft(email)} disabled={loading || !!email.draft}>
+                          {email.draft ? 'Draft Ready' : 'Generate Draft'}
+                        </button>
+                      )
                     ) : (
                       <span style={{ color: '#aaa' }}>Auto</span>
                     )}
@@ -148,6 +268,11 @@ const Dashboard = () => {
             </tbody>
           </table>
         )}
+        {searching && nextCursor && (
+          <div style={{ textAlign: 'center', marginTop: 12 }}>
+            <button onClick={() => searchEmails(nextCursor)} disabled={loading}>Load more</button>
+          </div>
+        )}
       </div>
     </div>
   );